@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+Benchmarks for the FCP client, which run against the simulated node of
+fcp3.testing instead of a Freenet node.
+
+Measures the round trip time of small requests through the manager
+thread of fcp3.node.FCPNode, and compares it with the select/queue
+polling loop used before.
+
+Measures the throughput of many small inserts, sent one by one and in
+batches, and of many requests in flight at once on a node with latency.
+
+Also measures the peak memory of streaming a large put and get from and
+to files, the throughput of the FCP message parser on a large
+ListPersistentRequests reply, and the time to parse freesitemgr state
+files with 1k to 1M file records, and the time of getattr and getdir
+calls of freenetfs with 1k to 1M files in its tree.
+
+Usage: python3 benchmark.py [number of requests]
+"""
+
+import contextlib
+import json
+import os
+import queue
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fcp3 as fcp
+from fcp3.freenetfs import FreenetBaseFS
+from fcp3.node import FCPNode, FCPMessageParser, pollTimeout, CRITICAL
+from fcp3.pseudopythonparser import Parser
+
+
+@contextlib.contextmanager
+def fakeNode(*args):
+    """
+    Runs fcp3.testing.FakeNode with the given commandline arguments in
+    a separate process, so it neither competes for the GIL nor adds its
+    store to the memory of this process, and yields its port.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    proc = subprocess.Popen([sys.executable, "-m", "fcp3.testing",
+                             "--port", str(port)] + list(args),
+                            stdout=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        yield port
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+class PollingFCPNode(FCPNode):
+    """
+    FCPNode with the former manager loop, which alternated between a
+    select on the node socket and a blocking get on the request queue.
+    """
+    def _mgrThread(self):
+        log = self._log
+        self.shutdownLock.acquire()
+        try:
+            while self.running:
+                if self._msgIncoming():
+                    self._rxChunk()
+                while self._rxMessages:
+                    self._on_rxMsg(self._rxMessages.popleft())
+                try:
+                    req = self.clientReqQueue.get(True, pollTimeout)
+                    self._on_clientReq(req)
+                except queue.Empty:
+                    pass
+        except Exception:
+            log(CRITICAL, "_mgrThread: manager thread crashed")
+        self.shutdownLock.release()
+
+
+def measure(nodeclass, port, count, namesitefile):
+    """
+    Returns the round trip times of count sequential GenerateSSK
+    requests, taken when the manager thread delivers the reply. This
+    excludes the wait() latency of the calling thread.
+
+    Requests are spaced by a random pause, so they hit the manager
+    thread at arbitrary points of its loop, as independent callers do.
+    """
+    node = nodeclass(host="127.0.0.1", port=port, verbosity=fcp.SILENT,
+                     namesitefile=namesitefile)
+    done = threading.Event()
+    def callback(status, value):
+        done.set()
+    try:
+        times = []
+        for i in range(count + 1):
+            time.sleep(random.uniform(0, 2 * pollTimeout))
+            done.clear()
+            start = time.perf_counter()
+            id = node._getUniqueId()
+            node._submitCmd(id, "GenerateSSK", Identifier=id,
+                            callback=callback, **{"async": True})
+            done.wait()
+            times.append(time.perf_counter() - start)
+        return times[1:] # the first request warms up
+    finally:
+        node.shutdown()
+
+
+def measureParser(nrequests, chunksize=65536):
+    """
+    Returns the time needed to parse a ListPersistentRequests reply with
+    nrequests PersistentGet messages, fed in chunks of chunksize bytes.
+    """
+    lines = []
+    for i in range(nrequests):
+        lines.extend(["PersistentGet", "Identifier=id%d" % i,
+                      "URI=CHK@abc/file%d" % i, "Verbosity=0",
+                      "ReturnType=direct", "PersistenceType=forever",
+                      "Global=true", "PriorityClass=2", "MaxRetries=-1",
+                      "EndMessage"])
+    lines.extend(["EndListPersistentRequests", "EndMessage", ""])
+    raw = "\n".join(lines).encode("utf-8")
+    parser = FCPMessageParser()
+    start = time.perf_counter()
+    messages = []
+    for i in range(0, len(raw), chunksize):
+        messages.extend(parser.feed(raw[i:i + chunksize]))
+    elapsed = time.perf_counter() - start
+    assert len(messages) == nrequests + 1
+    return elapsed, len(raw)
+
+
+def measureStateFile(nrecords):
+    """
+    Returns the time needed to parse a freesitemgr state file with
+    nrecords file records, as written by SiteState.save() when the
+    records are not kept in a database, and its size in bytes.
+    """
+    records = [{"path": "/home/user/site/dir%d/file%d.html" % (i % 100, i),
+                "name": "dir%d/file%d.html" % (i % 100, i),
+                "mimetype": "text/html",
+                "hash": "%040x" % i,
+                "sizebytes": i,
+                "mtimens": 1600000000000000000 + i,
+                "inode": i,
+                "uri": "CHK@%043d,%043d,AAMC--8/file%d.html" % (i, i, i),
+                "id": "freesitemgr|site|dir%d/file%d.html" % (i % 100, i),
+                "state": "idle",
+                "target": "separate",
+                "chkname": "file%d.html" % i}
+               for i in range(nrecords)]
+    text = "\n".join([
+        "# freesitemgr state file for freesite 'site'",
+        'name = "site"',
+        "updateInProgress = False",
+        'mimeTypeMatch = [',
+        '  {',
+        '    "*.txt": "text/plain"',
+        '  }',
+        ']',
+        "# Detailed site contents",
+        "files = " + json.JSONEncoder(indent=2).encode(records),
+        ""])
+    del records
+    start = time.perf_counter()
+    data = Parser().parse(text)
+    elapsed = time.perf_counter() - start
+    assert len(data["files"]) == nrecords
+    return elapsed, len(text)
+
+
+def measureFreenetfs(port, nentries, ncalls=100000, perdir=1000):
+    """
+    Builds a freenetfs tree with nentries files, perdir to a directory,
+    returns the time needed to build it and the mean times of a getattr
+    of a random file and of a getdir of a random directory.
+    """
+    fs = FreenetBaseFS("/mnt", fcpHost="127.0.0.1", fcpPort=port,
+                       verbosity=fcp.SILENT)
+    try:
+        start = time.perf_counter()
+        fs.addToCache(path="/usr/bench", isdir=True, perm=0o755)
+        dirs = ["/usr/bench/dir%d" % i
+                for i in range((nentries + perdir - 1) // perdir)]
+        for i in range(nentries):
+            if i % perdir == 0:
+                fs.addToCache(path=dirs[i // perdir], isdir=True, perm=0o755)
+            fs.addToCache(path="%s/file%d" % (dirs[i // perdir], i),
+                          isreg=True, perm=0o644)
+        build = time.perf_counter() - start
+        paths = ["%s/file%d" % (dirs[i // perdir], i)
+                 for i in random.choices(range(nentries), k=ncalls)]
+        start = time.perf_counter()
+        for path in paths:
+            fs.getattr(path)
+        getattr = (time.perf_counter() - start) / ncalls
+        paths = random.choices(dirs, k=ncalls // 10)
+        start = time.perf_counter()
+        for path in paths:
+            fs.getdir(path)
+        getdir = (time.perf_counter() - start) / len(paths)
+        return build, getattr, getdir
+    finally:
+        fs.node.shutdown()
+
+
+def measureStreaming(port, size, namesitefile):
+    """
+    Puts size bytes from a file and gets them back into a file, returns
+    the growth of the peak RSS in bytes for each of both.
+    """
+    node = FCPNode(host="127.0.0.1", port=port, verbosity=fcp.SILENT,
+                   namesitefile=namesitefile)
+    def peak():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        with tempfile.TemporaryFile() as f:
+            f.truncate(size)
+            before = peak()
+            uri = node.put("CHK@", data=f, mimetype="application/octet-stream")
+            putGrowth = peak() - before
+        with tempfile.TemporaryFile() as f:
+            before = peak()
+            node.get(uri, stream=f)
+            getGrowth = peak() - before
+            assert f.tell() == size
+        return putGrowth, getGrowth
+    finally:
+        node.shutdown()
+
+
+def measureThroughput(port, count, namesitefile, batch=False):
+    """
+    Returns the time to complete count inserts of 1 KiB, submitted one
+    by one, or in one batch.
+    """
+    node = FCPNode(host="127.0.0.1", port=port, verbosity=fcp.SILENT,
+                   namesitefile=namesitefile)
+    try:
+        data = os.urandom(1024)
+        start = time.perf_counter()
+        if batch:
+            with node.batch() as group:
+                for i in range(count):
+                    node.put("CHK@", data=data, **{"async": True})
+            group.wait()
+        else:
+            jobs = [node.put("CHK@", data=data, **{"async": True})
+                    for i in range(count)]
+            node.waitAll(jobs)
+        return time.perf_counter() - start
+    finally:
+        node.shutdown()
+
+
+def measureInFlight(port, count, namesitefile):
+    """
+    Returns the time to complete count GenerateSSK requests which are
+    all in flight at once.
+    """
+    node = FCPNode(host="127.0.0.1", port=port, verbosity=fcp.SILENT,
+                   namesitefile=namesitefile)
+    try:
+        start = time.perf_counter()
+        jobs = []
+        for i in range(count):
+            id = node._getUniqueId()
+            jobs.append(node._submitCmd(id, "GenerateSSK", Identifier=id,
+                                        **{"async": True}))
+        node.waitAll(jobs)
+        return time.perf_counter() - start
+    finally:
+        node.shutdown()
+
+
+def report(name, times):
+    print("%-16s n=%d mean=%.3fms median=%.3fms max=%.3fms" % (
+        name, len(times),
+        1000 * statistics.mean(times),
+        1000 * statistics.median(times),
+        1000 * max(times)))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if sys.argv[1:] else 50
+    namesitefile = os.path.join(tempfile.mkdtemp(), ".freenames")
+
+    with fakeNode() as port:
+        report("selector", measure(FCPNode, port, count, namesitefile))
+        report("polling", measure(PollingFCPNode, port, count, namesitefile))
+
+        inserts = 100 * count
+        for batch in (False, True):
+            elapsed = measureThroughput(port, inserts, namesitefile, batch)
+            print("%-16s %d inserts of 1 KiB in %.3fs (%.0f/s)" % (
+                "batched" if batch else "unbatched", inserts, elapsed,
+                inserts / elapsed))
+
+        size = 256 * 1024 * 1024
+        putGrowth, getGrowth = measureStreaming(port, size, namesitefile)
+        print("%-16s %d MiB: peak RSS growth put %.1f MiB, get %.1f MiB" % (
+            "streaming", size // 1024 // 1024,
+            putGrowth / 1024 / 1024, getGrowth / 1024 / 1024))
+
+        for nentries in (1000, 10000, 100000, 1000000):
+            build, getattr, getdir = measureFreenetfs(port, nentries)
+            print("%-16s %d files built in %.3fs, getattr %.2fus, "
+                  "getdir %.2fus" % ("freenetfs", nentries, build,
+                                     1e6 * getattr, 1e6 * getdir))
+
+    latency = 0.05
+    with fakeNode("--latency", str(latency)) as port:
+        elapsed = measureInFlight(port, 10 * count, namesitefile)
+        print("%-16s %d requests with %dms latency in %.3fs" % (
+            "in flight", 10 * count, 1000 * latency, elapsed))
+
+    elapsed, size = measureParser(10000)
+    print("%-16s %d messages, %d bytes in %.3fs (%.1f MiB/s)" % (
+        "parser", 10001, size, elapsed, size / elapsed / 1024 / 1024))
+
+    for nrecords in (1000, 10000, 100000, 1000000):
+        elapsed, size = measureStateFile(nrecords)
+        print("%-16s %d records, %d bytes in %.3fs (%.1f MiB/s)" % (
+            "state file", nrecords, size, elapsed,
+            size / elapsed / 1024 / 1024))
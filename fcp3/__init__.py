@@ -1,6 +1,6 @@
 import sys, os
 
-from .node import FCPNode, JobTicket
+from .node import FCPNode, FCPNodePool, JobTicket, pooledNode
 from .node import ConnectionRefused, FCPException, FCPGetFailed, \
                  FCPPutFailed, FCPProtocolError
 
@@ -25,8 +25,8 @@ if not isDoze:
     from . import freenetfs
 
 
-__all__ = ['node', 'sitemgr', 'xmlrpc',
-           'FCPNode', 'JobTicket',
+__all__ = ['node', 'sitemgr', 'xmlrpc', 'aio', 'testing', 'chk',
+           'FCPNode', 'FCPNodePool', 'JobTicket', 'pooledNode',
            'ConnectionRefused', 'FCPException', 'FCPPutFailed',
            'FCPProtocolError',
            'get', 'put', 'genkey', 'invertkey', 'redirect', 'names',
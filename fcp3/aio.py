@@ -0,0 +1,663 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+An asyncio client for FCP v2.
+
+AsyncFCPNode drives a single FCP connection from an asyncio event loop,
+without any threads. It shares the message handling of fcp3.node.FCPNode,
+so requests behave the same way, but instead of blocking, each request
+coroutine returns an AsyncJobTicket. A ticket is awaited for the result
+of the job, and iterated with 'async for' over its pending messages:
+
+    async def main():
+        async with AsyncFCPNode() as node:
+            job = await node.get("KSK@gpl.txt")
+            async for msg in job:
+                print(msg['header'])
+            mimetype, data, msg = await job
+
+Thus one event loop can keep thousands of requests in flight over one
+connection.
+
+Namesite lookups are not available here: uris must be freenet keys.
+"""
+
+import asyncio
+import os
+import stat
+import sys
+import time
+
+from .node import FCPNode, JobTicket, FCPMessageParser
+from .node import FCPNodeFailure, FCPNodeTimeout, FCPProtocolError
+from .node import defaultFCPHost, defaultFCPPort, defaultVerbosity
+from .node import expectedVersion, rxBufferSize, readdir, ONE_YEAR
+from .node import FileData, JobTable
+from .node import CRITICAL, ERROR, INFO, DETAIL, DEBUG
+
+
+class AsyncJobTicket(JobTicket):
+    """
+    A JobTicket for the asyncio client
+
+    Awaiting the ticket returns the result of the job, or raises the
+    exception it failed with. Iterating over it with 'async for' yields
+    the pending messages received for the job, until it is complete.
+
+    Attributes of interest, in addition to those of JobTicket:
+        - future - the asyncio future which receives the result
+    """
+
+    def __init__(self, node, id, cmd, kw, **opts):
+        """
+        You should never instantiate an AsyncJobTicket object yourself
+        """
+        JobTicket.__init__(self, node, id, cmd, kw, **opts)
+        self.future = node.loop.create_future()
+        self.progress = asyncio.Queue()
+        self.timeoutHandle = None
+
+        # route pending messages to the progress queue as well
+        userCallback = self.callback
+        def callback(status, value):
+            if status == 'pending':
+                self.progress.put_nowait(value)
+            userCallback(status, value)
+        self.callback = callback
+
+
+    def __await__(self):
+        return self.future.__await__()
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        msg = await self.progress.get()
+        if msg is None:
+            # leave the end marker for any other iterator
+            self.progress.put_nowait(None)
+            raise StopAsyncIteration
+        return msg
+
+
+    def _putResult(self, result):
+        """
+        Called by the node to indicate job is complete, and resolve
+        the future with the result
+        """
+        JobTicket._putResult(self, result)
+        if self.timeoutHandle is not None:
+            self.timeoutHandle.cancel()
+        if not self.future.done():
+            if isinstance(result, Exception):
+                self.future.set_exception(result)
+            else:
+                self.future.set_result(result)
+        self.progress.put_nowait(None)
+
+
+    def _timedOut(self):
+        """
+        Fails the job once its timeout has passed
+        """
+        self.node.jobs.pop(self.id, None)
+        self._putResult(FCPNodeTimeout(
+            header="Command '%s' took too long for node response" % self.cmd))
+
+
+
+class AsyncFCPNode:
+    """
+    Represents an interface to a freenet node via its FCP port, for use
+    from asyncio coroutines.
+
+    The request methods are coroutines which send the request to the node
+    and return an AsyncJobTicket, without waiting for the node's answer.
+
+    Use it as an async context manager, or call connect() before sending
+    requests and shutdown() when done.
+    """
+
+    nodeIsAlive = False
+
+    nodeVersion = None
+    nodeFCPVersion = None
+    nodeBuild = None
+    nodeRevision = None
+    nodeExtBuild = None
+    nodeExtRevision = None
+    nodeIsTestnet = None
+    compressionCodecs = FCPNode.compressionCodecs
+
+    # the message handling is shared with the threaded client
+    _on_rxMsg = FCPNode._on_rxMsg
+    _registerJob = FCPNode._registerJob
+    _failUpload = FCPNode._failUpload
+    _untaggedJob = FCPNode._untaggedJob
+    _encodeMsgParts = FCPNode._encodeMsgParts
+    _getOpts = FCPNode._getOpts
+    _putOpts = FCPNode._putOpts
+    _resolveUri = FCPNode._resolveUri
+    _rxStream = FCPNode._rxStream
+    _logRxMsg = FCPNode._logRxMsg
+    _parseNodeHello = FCPNode._parseNodeHello
+    _parseCompressionCodecs = FCPNode._parseCompressionCodecs
+    _getUniqueId = FCPNode._getUniqueId
+    _log = FCPNode._log
+    defaultCompressionCodecsString = FCPNode.defaultCompressionCodecsString
+    listenGlobal = FCPNode.listenGlobal
+    getAllJobs = FCPNode.getAllJobs
+    getGlobalJobs = FCPNode.getGlobalJobs
+    getPersistentJobs = FCPNode.getPersistentJobs
+    getTransientJobs = FCPNode.getTransientJobs
+    getJobsWithPrefix = FCPNode.getJobsWithPrefix
+    getPendingJobs = FCPNode.getPendingJobs
+    getCompleteJobs = FCPNode.getCompleteJobs
+    ignoreGlobal = FCPNode.ignoreGlobal
+    getVerbosity = FCPNode.getVerbosity
+    setVerbosity = FCPNode.setVerbosity
+
+
+    def __init__(self, **kw):
+        """
+        Create a connection object, which connects on connect()
+
+        Keywords:
+            - name - name of client to use with reqs, defaults to random
+            - host - hostname, defaults to environment variable FCP_HOST, and
+              if this doesn't exist, then defaultFCPHost
+            - port - port number, defaults to environment variable FCP_PORT, and
+              if this doesn't exist, then defaultFCPPort
+            - logfile - a pathname or writable file object, to which log messages
+              should be written, defaults to stdout unless logfunc is specified
+            - logfunc - a function to which log messages should be written
+            - verbosity - how detailed the log messages should be
+        """
+        env = os.environ
+        self.name = kw.get('name', self._getUniqueId())
+        self.host = kw.get('host', env.get("FCP_HOST", defaultFCPHost))
+        self.port = int(kw.get('port', env.get("FCP_PORT", defaultFCPPort)))
+        self.connectionidentifier = None
+        self.testedDDA = {}
+
+        logfile = kw.get('logfile', None)
+        logfunc = kw.get('logfunc', None)
+        if(None == logfile and None == logfunc):
+            logfile = sys.stdout
+        if(None != logfile and not hasattr(logfile, 'write')):
+            # might be a pathname
+            if not isinstance(logfile, str):
+                raise Exception("Bad logfile '%s', must be pathname or file object" % logfile)
+            logfile = open(logfile, "a")
+        self.logfile = logfile
+        self.logfunc = logfunc
+        self.verbosity = kw.get('verbosity', defaultVerbosity)
+
+        self.jobs = JobTable() # keyed by request ID
+        self._untaggedJobs = [] # jobs of untaggedCommands, in sending order
+        self._rxParser = FCPMessageParser(getStream=self._rxStream)
+        self._rxMessages = []
+        self._rxTask = None
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self._txLock = None # keeps the messages of concurrent commands apart
+
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+
+    async def __aexit__(self, type, value, traceback):
+        await self.shutdown()
+
+
+    async def connect(self):
+        """
+        Connects to the node, performs the FCP handshake and starts
+        receiving messages
+        """
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        except Exception as e:
+            raise type(e)(
+                "Failed to connect to %s:%s - %s" % (
+                    self.host, self.port, e)).with_traceback(
+                        sys.exc_info()[2])
+
+        self._txLock = asyncio.Lock()
+        await self._txMsg("ClientHello",
+                          Name=self.name,
+                          ExpectedVersion=expectedVersion)
+        while not self._rxMessages:
+            await self._rxChunk()
+        self._parseNodeHello(self._rxMessages.pop(0))
+        self.nodeIsAlive = True
+
+        self._rxTask = self.loop.create_task(self._rxLoop())
+
+
+    async def shutdown(self):
+        """
+        Stops receiving messages and closes the connection
+        """
+        self.nodeIsAlive = False
+        if self._rxTask is not None:
+            self._rxTask.cancel()
+            try:
+                await self._rxTask
+            except asyncio.CancelledError:
+                pass
+            self._rxTask = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+
+    # basic FCP primitives
+
+    async def genkey(self, **kw):
+        """
+        Generates an SSK keypair, keywords as for FCPNode.genkey
+
+        Returns a future for the (public, private) uri tuple
+        """
+        id = kw.pop("id", None)
+        if not id:
+            id = self._getUniqueId()
+        name = kw.get("name", None)
+        usk = kw.get("usk", False)
+
+        job = await self._submitCmd(id, "GenerateSSK", Identifier=id, **kw)
+
+        async def keys():
+            pub, priv = await job
+            if name:
+                pub = pub + name
+                priv = priv + name
+                if usk:
+                    pub = pub.replace("SSK@", "USK@")+"/0"
+                    priv = priv.replace("SSK@", "USK@")+"/0"
+            return pub, priv
+        return self.loop.create_task(keys())
+
+
+    async def get(self, uri, **kw):
+        """
+        Requests a key, keywords as for FCPNode.get
+
+        Returns a job ticket for the result
+        """
+        self._log(INFO, "get: uri=%s" % uri)
+        id, opts = self._getOpts(uri, **kw)
+        if 'Filename' in opts:
+            await self.testDDA(Directory=os.path.dirname(opts['Filename']),
+                               WantWriteDirectory=True)
+        return await self._submitCmd(id, "ClientGet", **opts)
+
+
+    async def put(self, uri="CHK@", **kw):
+        """
+        Inserts a key, keywords as for FCPNode.put
+
+        Returns a job ticket for the result
+        """
+        if 'dir' in kw:
+            return await self.putdir(uri, **kw)
+
+        id, opts = self._putOpts(uri, **kw)
+        if kw.get('Global', False):
+            self.listenGlobal()
+        return await self._submitCmd(id, "ClientPut", **opts)
+
+
+    async def genchk(self, **kw):
+        """
+        Determines the CHK under which a data item would be inserted,
+        keywords as for FCPNode.genchk
+
+        Returns a job ticket for the result
+        """
+        return await self.put(chkonly=True, **kw)
+
+
+    async def putdir(self, uri, **kw):
+        """
+        Inserts a freesite, keywords as for FCPNode.putdir
+
+        In filebyfile mode, up to maxconcurrent files are inserted at once,
+        and the freesite manifest only redirects to them.
+
+        Returns a job ticket for the manifest insert
+        """
+        log = self._log
+        dir = kw['dir']
+        log(INFO, "putdir: uri=%s dir=%s" % (uri, dir))
+
+        sitename = kw.get('name', 'freesite')
+        version = kw.get('version', 0)
+        maxretries = kw.get('maxretries', 3)
+        priority = kw.get('priority', 4)
+        Verbosity = kw.get('Verbosity', 0)
+        filebyfile = kw.get('filebyfile', False)
+        maxConcurrent = kw.get('maxconcurrent', 10)
+        codecs = kw.get('Codecs', self.defaultCompressionCodecsString())
+
+        if kw.get('globalqueue', False) or kw.get('Global', False):
+            globalMode = True
+            persistence = "forever"
+            self.listenGlobal()
+        else:
+            globalMode = False
+            persistence = "connection"
+
+        id = kw.pop("id", None)
+        if not id:
+            id = self._getUniqueId()
+
+        # derive final URI for insert
+        uriFull = uri + sitename + "/"
+        if kw.get('usk', False):
+            uriFull += "%d/" % int(version)
+            uriFull = uriFull.replace("SSK@", "USK@")
+            while uriFull.endswith("/"):
+                uriFull = uriFull[:-1]
+
+        manifestDict = kw.get('manifest', None)
+        if manifestDict:
+            manifest = []
+            for relpath, attrDict in list(manifestDict.items()):
+                if attrDict['changed'] or (relpath == "index.html"):
+                    attrDict['relpath'] = relpath
+                    attrDict['fullpath'] = os.path.join(dir, relpath)
+                    manifest.append(attrDict)
+        else:
+            manifest = readdir(dir)
+
+        fileLines = []
+        if filebyfile:
+            slots = asyncio.Semaphore(maxConcurrent)
+
+            async def insert(filerec):
+                async with slots:
+                    log(INFO, "Launching insert of %s" % filerec['relpath'])
+                    # sent from the file in chunks, like FCPNode.putdir
+                    job = await self.put("CHK@",
+                                         file=filerec['fullpath'],
+                                         direct=True,
+                                         mimetype=filerec['mimetype'],
+                                         Verbosity=Verbosity,
+                                         priority=priority,
+                                         Global=globalMode,
+                                         persistence=persistence)
+                    try:
+                        return await job
+                    except Exception as e:
+                        log(ERROR, "File %s failed to insert: %s" % (
+                            filerec['relpath'], e))
+                        return None
+
+            uris = await asyncio.gather(*[insert(r) for r in manifest])
+            for filerec, fileuri in zip(manifest, uris):
+                if fileuri:
+                    fileLines.append(["Name=%s" % filerec['relpath'],
+                                      "UploadFrom=redirect",
+                                      "TargetURI=%s" % fileuri])
+            log(INFO, "All raw files now inserted (or failed)")
+        else:
+            for filerec in manifest:
+                fileLines.append(["Name=%s" % filerec['relpath'],
+                                  "UploadFrom=disk",
+                                  "Filename=%s" % filerec['fullpath']])
+
+        msgLines = ["ClientPutComplexDir",
+                    "Identifier=%s" % id,
+                    "Verbosity=%s" % Verbosity,
+                    "MaxRetries=%s" % maxretries,
+                    "PriorityClass=%s" % priority,
+                    "URI=%s" % uriFull,
+                    "Codecs=%s" % codecs,
+                    "Persistence=%s" % persistence,
+                    "Global=%s" % ("true" if globalMode else "false"),
+                    "DefaultName=index.html",
+                    ]
+        for n, lines in enumerate(fileLines):
+            msgLines.extend("Files.%d.%s" % (n, line) for line in lines)
+        msgLines.append("EndMessage")
+
+        return await self._submitCmd(
+            id, "ClientPutComplexDir",
+            rawcmd="\n".join(msgLines) + "\n",
+            Global=globalMode,
+            persistence=persistence,
+            callback=kw.get('callback', None))
+
+
+    async def listpeers(self, **kw):
+        """
+        Gets the list of peers from the node, keywords as for
+        FCPNode.listpeers
+
+        Returns a job ticket for the result
+        """
+        return await FCPNode.listpeers(self, **kw)
+
+
+    async def fcpPluginMessage(self, **kw):
+        """
+        Sends an FCPPluginMessage, keywords as for
+        FCPNode.fcpPluginMessage
+
+        Returns a job ticket for the FCPPluginReply message contents
+        """
+        return await FCPNode.fcpPluginMessage(self, **kw)
+
+
+    async def testDDA(self, **kw):
+        """
+        Tests for Direct Disk Access capability on a directory, keywords
+        as for FCPNode.testDDA
+
+        Returns the result of the test, rather than a job ticket
+        """
+        DDAkey = (kw["Directory"], kw.get("WantReadDirectory", False), kw.get("WantWriteDirectory", False))
+        try:
+            return self.testedDDA[DDAkey]
+        except KeyError:
+            pass # we actually have to test this dir.
+        try:
+            job = await self._submitCmd(self._getUniqueId(), "TestDDARequest", **kw)
+            requestResult = await job
+        except FCPProtocolError as e:
+            self._log(DETAIL, str(e))
+            return False
+        writeFilename = None
+        kw = {}
+        kw['Directory'] = requestResult['Directory']
+        if 'ReadFilename' in requestResult:
+            readFilename = requestResult['ReadFilename']
+            try:
+                with open(readFilename, 'rb') as readFile:
+                    readFileContents = readFile.read().decode('utf-8')
+            except FileNotFoundError:
+                readFileContents = ''
+            kw['ReadFilename'] = readFilename
+            kw['ReadContent'] = readFileContents
+
+        if 'WriteFilename' in requestResult and 'ContentToWrite' in requestResult:
+            writeFilename = requestResult['WriteFilename']
+            contentToWrite = requestResult['ContentToWrite'].encode('utf-8')
+            try:
+                with open(writeFilename, "w+b") as writeFile:
+                    writeFile.write(contentToWrite)
+                writeFileMode = os.stat(writeFilename).st_mode
+                os.chmod(writeFilename, writeFileMode | stat.S_IREAD | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            except FileNotFoundError:
+                pass
+
+        job = await self._submitCmd(self._getUniqueId(), "TestDDAResponse", **kw)
+        responseResult = await job
+        if writeFilename is not None:
+            try:
+                os.remove(writeFilename)
+            except OSError:
+                pass
+        self.testedDDA[DDAkey] = responseResult
+        return responseResult
+
+
+    def namesiteLookup(self, domain, **kw):
+        """
+        Namesites are not supported by the asyncio client, so every
+        lookup fails
+        """
+        return None
+
+
+    # low level node comms methods
+
+    async def _submitCmd(self, id, cmd, **kw):
+        """
+        Sends a command to the node, and returns its AsyncJobTicket
+
+        Arguments and keywords as for FCPNode._submitCmd, except that
+        'async' and 'waituntilsent' are ignored: the command has always
+        been handed to the transport when this returns, and the transport
+        has drained below its high-water mark.
+        """
+        if not self.nodeIsAlive:
+            raise FCPNodeFailure("%s:%s: node closed connection" % (cmd, id))
+
+        if not "Identifier" in kw and not "identifier" in kw:
+            kw["Identifier"] = id
+
+        if self.verbosity >= DEBUG:
+            self._log(DEBUG, "_submitCmd: id=" + repr(id) + ", cmd=" + repr(cmd) + ", **" + repr(kw))
+
+        kw.pop('async', None)
+        kw.pop('waituntilsent', None)
+        followRedirect = kw.pop('followRedirect', True)
+        stream = kw.pop('stream', None)
+        keepjob = kw.pop('keep', False)
+        timeout = kw.pop('timeout', ONE_YEAR)
+        if "kwdict" in kw:
+            kw.update(kw.pop("kwdict"))
+        job = AsyncJobTicket(
+            self, id, cmd, kw,
+            verbosity=self.verbosity, logger=self._log, keep=keepjob,
+            stream=stream)
+        job.followRedirect = followRedirect
+
+        if cmd == 'ClientGet' and 'URI' in kw:
+            job.uri = kw['URI']
+
+        if cmd == 'ClientPut' and 'Metadata.ContentType' in kw:
+            job.mimetype = kw['Metadata.ContentType']
+
+        async with self._txLock:
+            # registered in sending order, for replies without identifier
+            self._registerJob(job)
+            await self._txMsg(cmd, **kw)
+        job.timeQueued = int(time.time())
+
+        if cmd in ['WatchGlobal', "RemovePersistentRequest"]:
+            # the node does not answer these
+            job._putResult(None)
+        else:
+            job.timeoutHandle = self.loop.call_later(timeout, job._timedOut)
+            await self._checkUpload(job)
+        return job
+
+
+    async def _checkUpload(self, job):
+        """
+        Fails a job whose FileData payload could not be sent as it was
+        announced, as FCPNode._checkUpload does
+        """
+        data = job.kw.get('Data')
+        if not isinstance(data, FileData) or data.error is None:
+            return
+        async with self._txLock:
+            await self._txMsg("RemovePersistentRequest",
+                              Global=job.isGlobal and "true" or "false",
+                              Identifier=job.id)
+        self._failUpload(job, data.error)
+
+
+    async def _txMsg(self, msgType, **kw):
+        """
+        low level message send, arguments as for FCPNode._txMsg
+
+        Payloads are written a chunk at a time, waiting for the transport
+        to drain after each, so it never buffers more than about one chunk.
+        """
+        raw, data, length = self._encodeMsgParts(msgType, **kw)
+        self.writer.write(raw)
+        if data is None:
+            pass
+        elif isinstance(data, FileData):
+            # the transport may keep what it cannot send right away,
+            # so it gets copies of the reused chunk buffer
+            for chunk in data.chunks():
+                self.writer.write(bytes(chunk))
+                await self.writer.drain()
+        elif hasattr(data, 'read'):
+            while length:
+                chunk = data.read(min(length, rxBufferSize))
+                if not chunk:
+                    raise FCPNodeFailure("%s: data ended %d bytes early" % (
+                        msgType, length))
+                self.writer.write(chunk)
+                length -= len(chunk)
+                await self.writer.drain()
+        else:
+            self.writer.write(data)
+        await self.writer.drain()
+
+
+    async def _rxChunk(self):
+        """
+        Reads what the node has sent so far, and queues the messages
+        which are complete now
+        """
+        chunk = await self.reader.read(rxBufferSize)
+        if not chunk:
+            self.nodeIsAlive = False
+            raise FCPNodeFailure("FCP socket closed by node")
+        for msg in self._rxParser.feed(chunk):
+            if self.verbosity >= DETAIL:
+                self._logRxMsg(msg)
+            self._rxMessages.append(msg)
+
+
+    async def _rxLoop(self):
+        """
+        Dispatches the messages from the node to their jobs, until the
+        connection is shut down or lost
+        """
+        try:
+            while True:
+                messages = self._rxMessages
+                self._rxMessages = []
+                for msg in messages:
+                    self._on_rxMsg(msg)
+                await self._rxChunk()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.nodeIsAlive = False
+            self._log(CRITICAL, "_rxLoop: connection to node failed: %s" % e)
+            # send the exception to all waiting jobs
+            for id, job in list(self.jobs.items()):
+                job._putResult(e)
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+Computes the CHKs of small inserts without a node
+
+A CHK is derived from the data alone, so the node does not need to see
+the data to name it. This module follows the node's encoding of a CHK
+block, AES-256 in CTR mode with SHA-256 hashes, and of the metadata
+which redirects to a block with a MIME type.
+
+Only data which fits into one block and is inserted without compression
+is handled here: the node's Java compressors cannot be reproduced byte
+for byte, and larger data needs the node's splitfile FEC. compute_chk()
+returns None for everything else, so callers fall back to genchk.
+
+>>> uri = compute_chk(b"Hello")
+>>> uri.startswith("CHK@") and uri.endswith(",AAMA--8")
+True
+>>> compute_chk(b"Hello") == uri
+True
+>>> compute_chk(b"Hello", "text/plain").endswith(",AAMC--8")
+True
+>>> compute_chk(b"Hello", compression="GZIP") is None
+True
+>>> compute_chk(bytes(blockSize + 1)) is None
+True
+"""
+
+import hashlib
+import hmac
+import random
+import struct
+
+
+# the size of the payload of a CHK block
+blockSize = 32768
+
+# the crypto algorithm of CHKs, AES-256 in CTR mode with SHA-256
+cryptoAlgorithm = 3
+
+# the hash algorithm in the header of a block
+blockHashAlgorithm = 1
+
+# the compression codec number of uncompressed data
+noCompression = -1
+
+# the MIME type of data without metadata
+defaultMimetype = "application/octet-stream"
+
+# what the metadata of a redirect starts with
+metadataMagic = 0xf053b2842d91482b
+simpleRedirect = 0
+flagsTopSize = 256
+flagsHashes = 512
+sha256HashType = 4
+compatibilityMode = 6
+
+_b64chars = ("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+             "0123456789~-")
+
+
+def b64encode(raw):
+    """
+    Encodes bytes in the base64 variant of freenet keys, without padding
+
+    >>> b64encode(bytes([0, 3, 2, 255, 255]))
+    'AAMC--8'
+    """
+    bits = int.from_bytes(raw, "big")
+    nbits = len(raw) * 8
+    pad = -nbits % 6
+    bits <<= pad
+    nchars = (nbits + pad) // 6
+    return "".join(_b64chars[(bits >> (6 * (nchars - 1 - i))) & 63]
+                   for i in range(nchars))
+
+
+def b64decode(text):
+    """
+    Decodes the base64 variant of freenet keys
+
+    >>> list(b64decode("AAMC--8"))
+    [0, 3, 2, 255, 255]
+    """
+    bits = 0
+    for c in text:
+        bits = (bits << 6) | _b64chars.index(c)
+    nbytes = len(text) * 6 // 8
+    return (bits >> (len(text) * 6 - nbytes * 8)).to_bytes(nbytes, "big")
+
+
+def _xtime(a):
+    a <<= 1
+    return a ^ 0x11b if a & 0x100 else a
+
+
+def _makeTables():
+    """
+    Computes the AES S-box and the tables of the combined SubBytes,
+    ShiftRows and MixColumns steps of an encryption round
+    """
+    exp = [0] * 256
+    log = [0] * 256
+    x = 1
+    for i in range(255):
+        exp[i] = x
+        log[x] = i
+        x ^= _xtime(x)
+    sbox = [0] * 256
+    for a in range(256):
+        inv = exp[(255 - log[a]) % 255] if a else 0
+        s = inv
+        for shift in range(1, 5):
+            s ^= ((inv << shift) | (inv >> (8 - shift))) & 0xff
+        sbox[a] = s ^ 0x63
+    t0 = []
+    for a in range(256):
+        s = sbox[a]
+        s2 = _xtime(s)
+        t0.append((s2 << 24) | (s << 16) | (s << 8) | (s2 ^ s))
+    tables = [t0]
+    for shift in (8, 16, 24):
+        tables.append([((t >> shift) | (t << (32 - shift))) & 0xffffffff
+                       for t in t0])
+    return sbox, tables
+
+_sbox, (_t0, _t1, _t2, _t3) = _makeTables()
+
+
+def _expandKey(key):
+    """
+    Returns the round keys of a 256 bit AES key as a list of words
+    """
+    words = list(struct.unpack(">8I", key))
+    rcon = 1
+    for i in range(8, 60):
+        w = words[i - 1]
+        if i % 8 == 0:
+            w = ((w << 8) | (w >> 24)) & 0xffffffff
+            w = ((_sbox[w >> 24] << 24) | (_sbox[(w >> 16) & 255] << 16)
+                 | (_sbox[(w >> 8) & 255] << 8) | _sbox[w & 255])
+            w ^= rcon << 24
+            rcon = _xtime(rcon)
+        elif i % 8 == 4:
+            w = ((_sbox[w >> 24] << 24) | (_sbox[(w >> 16) & 255] << 16)
+                 | (_sbox[(w >> 8) & 255] << 8) | _sbox[w & 255])
+        words.append(words[i - 8] ^ w)
+    return words
+
+
+def aesEncryptBlock(key, block):
+    """
+    Encrypts one 16 byte block with AES-256
+
+    >>> key = bytes(range(32))
+    >>> aesEncryptBlock(key, bytes.fromhex("00112233445566778899aabbccddeeff")).hex()
+    '8ea2b7ca516745bfeafc49904b496089'
+    """
+    return _encryptWords(_expandKey(key), struct.unpack(">4I", block))
+
+
+def _encryptWords(rk, words):
+    s0, s1, s2, s3 = (w ^ k for w, k in zip(words, rk))
+    t0, t1, t2, t3 = _t0, _t1, _t2, _t3
+    for r in range(4, 56, 4):
+        s0, s1, s2, s3 = (
+            t0[s0 >> 24] ^ t1[(s1 >> 16) & 255] ^ t2[(s2 >> 8) & 255]
+            ^ t3[s3 & 255] ^ rk[r],
+            t0[s1 >> 24] ^ t1[(s2 >> 16) & 255] ^ t2[(s3 >> 8) & 255]
+            ^ t3[s0 & 255] ^ rk[r + 1],
+            t0[s2 >> 24] ^ t1[(s3 >> 16) & 255] ^ t2[(s0 >> 8) & 255]
+            ^ t3[s1 & 255] ^ rk[r + 2],
+            t0[s3 >> 24] ^ t1[(s0 >> 16) & 255] ^ t2[(s1 >> 8) & 255]
+            ^ t3[s2 & 255] ^ rk[r + 3])
+    sbox = _sbox
+    return struct.pack(">4I", *(
+        ((sbox[a >> 24] << 24) | (sbox[(b >> 16) & 255] << 16)
+         | (sbox[(c >> 8) & 255] << 8) | sbox[d & 255]) ^ rk[56 + i]
+        for i, (a, b, c, d) in enumerate(
+            ((s0, s1, s2, s3), (s1, s2, s3, s0),
+             (s2, s3, s0, s1), (s3, s0, s1, s2)))))
+
+
+def aesCtr(key, iv, data):
+    """
+    Encrypts or decrypts data with AES-256 in CTR mode, counting up the
+    whole 16 byte iv as big endian number for each block
+
+    >>> data = b"some data which spans more than one block"
+    >>> key, iv = bytes(range(32)), bytes(16)
+    >>> aesCtr(key, iv, aesCtr(key, iv, data)) == data
+    True
+    """
+    rk = _expandKey(key)
+    counter = int.from_bytes(iv, "big")
+    mask = (1 << 128) - 1
+    stream = bytearray()
+    for i in range((len(data) + 15) // 16):
+        c = (counter + i) & mask
+        stream += _encryptWords(rk, (c >> 96, (c >> 64) & 0xffffffff,
+                                     (c >> 32) & 0xffffffff, c & 0xffffffff))
+    return _xor(data, stream[:len(data)])
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(
+        len(a), "big")
+
+
+def _mersenneTwister(seed):
+    """
+    Returns a random.Random in the state of the node's MersenneTwister
+    seeded with the bytes seed, as 32 bit little endian words
+
+    Both use the init_by_array() of the reference implementation, like
+    seeding random with an int does.
+
+    >>> seed = hashlib.sha256(b"x").digest()
+    >>> state = random.Random(int.from_bytes(seed, "little")).getstate()
+    >>> _mersenneTwister(seed).getstate() == state
+    True
+    """
+    key = struct.unpack("<%dI" % (len(seed) // 4), seed)
+    mt = [19650218]
+    for i in range(1, 624):
+        mt.append((1812433253 * (mt[i - 1] ^ (mt[i - 1] >> 30)) + i)
+                  & 0xffffffff)
+    i, j = 1, 0
+    for k in range(max(624, len(key))):
+        mt[i] = (((mt[i] ^ ((mt[i - 1] ^ (mt[i - 1] >> 30)) * 1664525))
+                  + key[j] + j) & 0xffffffff)
+        i += 1
+        j += 1
+        if i >= 624:
+            mt[0] = mt[623]
+            i = 1
+        if j >= len(key):
+            j = 0
+    for k in range(623):
+        mt[i] = (((mt[i] ^ ((mt[i - 1] ^ (mt[i - 1] >> 30)) * 1566083941))
+                  - i) & 0xffffffff)
+        i += 1
+        if i >= 624:
+            mt[0] = mt[623]
+            i = 1
+    mt[0] = 0x80000000
+    rng = random.Random()
+    rng.setstate((3, tuple(mt) + (624,), None))
+    return rng
+
+
+def padBlock(data):
+    """
+    Pads data to a full block with bytes from a MersenneTwister seeded
+    with the SHA-256 of the data, as the node does
+
+    >>> block = padBlock(b"abc")
+    >>> len(block), block[:3], block == padBlock(b"abc")
+    (32768, b'abc', True)
+    """
+    if len(data) == blockSize:
+        return bytes(data)
+    rng = _mersenneTwister(hashlib.sha256(data).digest())
+    n = blockSize - len(data)
+    words = (n + 3) // 4
+    # java.util.Random.nextBytes() takes the bytes of each int from the
+    # least significant one
+    return bytes(data) + rng.getrandbits(32 * words).to_bytes(
+        4 * words, "little")[:n]
+
+
+def encodeBlock(data, isMetadata=False, compression=noCompression):
+    """
+    Encodes at most one block of data as a CHK block
+
+    Returns (uri, header, payload), where header and payload are what
+    the node stores, and uri the CHK to fetch and decrypt them with.
+    """
+    if len(data) > blockSize:
+        raise ValueError("%d bytes do not fit into one block" % len(data))
+    plain = padBlock(data)
+    cryptoKey = hashlib.sha256(plain).digest()
+    length = struct.pack(">H", len(data) & 0xffff)
+    mac = hmac.new(cryptoKey, plain + length, hashlib.sha256).digest()
+    encrypted = aesCtr(cryptoKey, mac[:16], plain + length)
+    header = struct.pack(">H", blockHashAlgorithm) + mac + encrypted[-2:]
+    payload = encrypted[:-2]
+    routingKey = hashlib.sha256(header + payload).digest()
+    extra = struct.pack(">BBBh", 0, cryptoAlgorithm, 2 if isMetadata else 0,
+                        compression)
+    uri = "CHK@%s,%s,%s" % (
+        b64encode(routingKey), b64encode(cryptoKey), b64encode(extra))
+    return uri, header, payload
+
+
+def decodeBlock(uri, header, payload):
+    """
+    Verifies a CHK block against its uri and returns its data, as the
+    node does when it fetches the block
+
+    Raises ValueError if the block does not belong to the uri.
+
+    >>> uri, header, payload = encodeBlock(b"Hello")
+    >>> decodeBlock(uri, header, payload)
+    b'Hello'
+    >>> decodeBlock(uri, header, payload[:-1] + b"x")
+    Traceback (most recent call last):
+    ...
+    ValueError: the block does not match the routing key
+    """
+    routingKey, cryptoKey, extra = (b64decode(part) for part in
+                                    uri[len("CHK@"):].split("/")[0].split(","))
+    if hashlib.sha256(header + payload).digest() != routingKey:
+        raise ValueError("the block does not match the routing key")
+    mac = header[2:34]
+    decrypted = aesCtr(cryptoKey, mac[:16], payload + header[34:36])
+    plain, length = decrypted[:-2], decrypted[-2:]
+    if not hmac.compare_digest(
+            hmac.new(cryptoKey, plain + length, hashlib.sha256).digest(), mac):
+        raise ValueError("the block does not match the crypto key")
+    return plain[:struct.unpack(">H", length)[0]]
+
+
+def binaryKey(uri):
+    """
+    Returns a CHK in the binary form used in metadata: extra, routing
+    key and crypto key
+    """
+    routingKey, cryptoKey, extra = (b64decode(part) for part in
+                                    uri[len("CHK@"):].split("/")[0].split(","))
+    return extra + routingKey + cryptoKey
+
+
+def redirectMetadata(uri, mimetype, data):
+    """
+    Returns the metadata of an uncompressed single block insert, which
+    redirects to the block at uri and gives its MIME type, with the size
+    and the SHA-256 of the data
+    """
+    mime = mimetype.encode("utf-8")
+    return b"".join([
+        struct.pack(">QHBH", metadataMagic, 1, simpleRedirect,
+                    flagsTopSize | flagsHashes),
+        struct.pack(">qqii?h", len(data), len(data), 1, 1, True,
+                    compatibilityMode),
+        struct.pack(">i", sha256HashType),
+        hashlib.sha256(data).digest(),
+        struct.pack(">B", len(mime)),
+        mime,
+        binaryKey(uri),
+    ])
+
+
+def compute_chk(data, mimetype=None, compression=None):
+    """
+    Returns the CHK under which the node would insert data, or None if
+    it has to be computed by the node
+
+    Arguments:
+        - data - the bytes to insert
+        - mimetype - the MIME type given with the insert, if any
+        - compression - the compression codecs of the insert, None or
+          an empty string if it is inserted with DontCompress
+
+    The CHK of data with a MIME type other than the default depends on
+    the node's layout of metadata, so callers should compare it once
+    with a genchk of the node before relying on it.
+    """
+    if compression or len(data) > blockSize:
+        return None
+    uri = encodeBlock(data)[0]
+    if mimetype and mimetype != defaultMimetype:
+        uri = encodeBlock(redirectMetadata(uri, mimetype, data),
+                          isMetadata=True)[0]
+    return uri
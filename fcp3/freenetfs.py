@@ -20,12 +20,16 @@ Requires:
 #@+others
 #@+node:imports
 import sys, os, time, stat, errno
-from io import StringIO
+from io import BytesIO
 import _thread
-from threading import Lock
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+from threading import Lock, Event, Condition
 import traceback
 from queue import Queue
-from hashlib import md5, sha1
+from hashlib import sha1
 
 from errno import *
 from stat import *
@@ -63,9 +67,6 @@ quiet = 0
 myuid = os.getuid()
 mygid = os.getgid()
 
-inodes = {}
-inodesNext = 1
-
 # set this to disable hits to node, for debugging
 _no_node = 0
 
@@ -76,6 +77,26 @@ freediskSpecialFiles = [
 
 showAllExceptions = False
 
+# the size of the blocks in which the data of keys is cached
+defaultBlockSize = 65536
+
+# how much key data to keep in memory, and optionally on disk
+defaultCacheBytes = 64 * 1024 * 1024
+defaultSpillBytes = 1024 * 1024 * 1024
+
+# where freedisks keep the manifest of their last commit, and the journal
+# of a commit in progress
+defaultStateDir = os.path.join(os.path.expanduser("~"), ".freedisk")
+
+# the number of inserts a commit starts with, and the bounds within which
+# it adapts that number to the failures it sees
+defaultCommitJobs = 4
+maxCommitJobs = 32
+maxCommitRetries = 3
+
+# the number of changed files an update fetches at once
+maxUpdateJobs = 8
+
 #@-node:globals
 #@+node:class ErrnoWrapper
 class ErrnoWrapper:
@@ -109,6 +130,11 @@ class FreenetBaseFS:
     allow_other = False
     kernel_cache = False
     config = os.path.join(os.path.expanduser("~"), ".freediskrc")
+    logFile = None
+    cacheBytes = defaultCacheBytes
+    cacheDir = None
+    spillBytes = defaultSpillBytes
+    stateDir = defaultStateDir
     
     # Files and directories already present in the filesytem.
     # Note - directories must end with "/"
@@ -142,6 +168,15 @@ class FreenetBaseFS:
             - verbosity - defaults to fcp.DETAIL
             - config - location of config file
             - debug - whether to run in debug mode, default False
+            - cacheBytes - how much data of keys under /get/ to keep in
+              memory, default 64 MiB
+            - cacheDir - a directory to keep data evicted from memory in,
+              default none
+            - spillBytes - how much data to keep in cacheDir, default 1 GiB,
+              once for blocks evicted from memory and once for the files
+              of keys which were fetched completely
+            - stateDir - the directory in which freedisks keep the manifest
+              of their last commit, default ~/.freedisk
         """
     
         self.log("FreenetBaseFS.__init__: args=%s kw=%s" % (args, kw))
@@ -151,6 +186,10 @@ class FreenetBaseFS:
                   'fcpPort',
                   'verbosity',
                   'debug',
+                  'cacheBytes',
+                  'cacheDir',
+                  'spillBytes',
+                  'stateDir',
                   ]:
             if k in kw:
                 v = kw.pop(k)
@@ -166,6 +205,14 @@ class FreenetBaseFS:
     
         self.mountpoint = mountpoint
         
+        self.blockCache = BlockCache(self.cacheBytes, self.cacheDir, self.spillBytes)
+        # the keys being fetched in the background, by uri, and the files
+        # of those which were fetched completely, least recently used first
+        self.fetches = {}
+        self.fetched = collections.OrderedDict()
+        self.fetchedBytes = 0
+        self.fetchesLock = Lock()
+        
         #if not self.config:
         #    raise Exception("Missing 'config=filename.conf' argument")
     
@@ -371,17 +418,19 @@ class FreenetBaseFS:
                     print("FIXME: returning IOerror")
                     raise IOError(errno.ENOENT, path)
                 
-                # get a key
+                # stat a key: only its size is needed, its data is
+                # fetched into the block cache when it is read
                 uri = path.split("/", 2)[-1]
                 try:
                     self.connectToNode()
-                    mimetype, data = self.node.get(uri)
+                    size = self.keySize(uri)
                     rec = self.addToCache(
                         path=path,
                         isreg=True,
                         perm=0o644,
-                        data=data,
                         )
+                    rec.size = size
+                    rec.uri = uri
                 
                 except:
                     traceback.print_exc()
@@ -408,18 +457,8 @@ class FreenetBaseFS:
             else:
                 raise IOError(errno.ENOENT, path)
     
-        self.log("getattr: path=%s" % path)
-        self.log("  mode=0%o" % rec.mode)
-        self.log("  inode=0x%x" % rec.inode)
-        self.log("  dev=0x%x" % rec.dev)
-        self.log("  nlink=0x%x" % rec.nlink)
-        self.log("  uid=%d" % rec.uid)
-        self.log("  gid=%d" % rec.gid)
-        self.log("  size=%d" % rec.size)
-        self.log("  atime=%d" % rec.atime)
-        self.log("  mtime=%d" % rec.mtime)
-        self.log("  ctime=%d" % rec.ctime)
-        self.log("rec=%s" % str(rec))
+        if self.verbosity >= fcp.DEBUG:
+            self.log("getattr: %s" % rec)
     
         return tuple(rec)
     
@@ -430,19 +469,19 @@ class FreenetBaseFS:
         rec = self.files.get(path, None)
     
         if rec:
-            files = [os.path.split(child.path)[-1] for child in rec.children]
-            files.sort()
+            files = rec.childNames()
             if rec.isdir:
                 if  path != "/":
-                    files.insert(0, "..")
-                files.insert(0, ".")
+                    files = ["..", *files]
+                files = [".", *files]
         else:
             self.log("Hit main fs for %s" % path)
             files = os.listdir(path)
     
         ret = [(x,0) for x in files]
     
-        self.log("getdir: path=%s\n  => %s" % (path, ret))
+        if self.verbosity >= fcp.DEBUG:
+            self.log("getdir: path=%s\n  => %s" % (path, ret))
         return ret
     
     #@-node:getdir
@@ -584,6 +623,9 @@ class FreenetBaseFS:
         for flag in [os.O_WRONLY, os.O_RDWR, os.O_APPEND]:
             if flags & flag:
                 self.log("open: setting iswriting for %s" % path)
+                if rec.uri and rec.stream is None:
+                    # a file of an update which was not read yet
+                    rec.data = self.fetchKey(rec.uri).read(0, rec.size)
                 rec.iswriting = True
                 rec.haschanged = True
     
@@ -599,7 +641,14 @@ class FreenetBaseFS:
         """
         # forward to existing file if any
         rec = self.files.get(path, None)
-        if rec:
+        if rec and rec.uri and rec.stream is None:
+            # a key under /get/, or a file of an update not read yet
+            buf = self.readKey(rec, length, offset)
+            self.log("read: path=%s length=%s offset=%s\n => %s" % (
+                                        path, length, offset, len(buf)))
+            return buf
+        
+        elif rec:
             rec.seek(offset)
             buf = rec.read(length)
             
@@ -703,12 +752,17 @@ class FreenetBaseFS:
                             getUri += ext
                 
                         # now cache the read-back
-                        self.addToCache(
+                        getRec = self.addToCache(
                             path="/get/"+getUri,
-                            data=data,
                             perm=0o444,
                             isreg=True,
                             )
+                        if getRec:
+                            getRec.size = len(data)
+                            getRec.uri = getUri
+                            writer = BlockWriter(self.blockCache, getUri)
+                            writer.write(data)
+                            writer.close()
                 
                         # and adjust the written file to reveal read uri
                         rec.data = getUri
@@ -753,7 +807,7 @@ class FreenetBaseFS:
                 
                         self.log("got release of .cmd")
                 
-                        cmd = rec.data.strip()
+                        cmd = rec.data.decode("utf-8", "replace").strip()
                         rec.data = ""
                         
                         self.log("release: cmd=%s" % cmd)
@@ -780,8 +834,11 @@ class FreenetBaseFS:
         if not rec:
             raise IOError(errno.ENOENT, path)
     
-        del self.files[path]
-        self.files[path1] = rec
+        # move the record and everything below it to the new path
+        if path1 in self.files:
+            self.delFromCache(path1)
+        self.delFromCache(rec)
+        self.moveRecord(rec, path1)
         rec.haschanged = True
         ret = 0
     
@@ -819,14 +876,9 @@ class FreenetBaseFS:
     
         # if a freedisk root, just delete
         if path == diskPath:
-            # remove directory record
+            # remove directory record, and its children with it
             self.delFromCache(rec)
     
-            # and remove children
-            for k in list(self.files.keys()):
-                if k.startswith(path+"/"):
-                    del self.files[k]
-    
             return 0
     
         # now, it's a subdir within a freedisk
@@ -921,6 +973,8 @@ class FreenetBaseFS:
             rec = self.files.get(path, None)
             if not rec:
                 raise IOError(2, path)
+            if path.startswith("/get/") and rec.uri:
+                self.forgetKey(rec.uri)
             self.delFromCache(rec)
             return 0
     
@@ -1061,6 +1115,10 @@ class FreenetBaseFS:
         """
         synchronises a freedisk TO freenet
         
+        Files whose hash and mimetype are in the manifest of the last
+        commit, or in the journal of an interrupted one, keep their uri,
+        the others are inserted concurrently by insertFiles.
+        
         Arguments:
             - name - the name of the disk
         """
@@ -1084,150 +1142,72 @@ class FreenetBaseFS:
             # no private key - disk was mounted readonly with only a pubkey
             raise IOError(errno.EIO, "Disk %s is read-only" % name)
         
-        # and pubkey
-        pubKey = diskRec.pubKey
-    
-        # process the private key to needed format
-        privKey = privKey.split("freenet:")[-1]
-        privKey = privKey.replace("SSK@", "USK@").split("/")[0] + "/" + name + "/0"
-    
-        self.log("commit: privKey=%s" % privKey)
-    
         self.log("commitDisk: checking files in %s" % rootPath)
+        self.setDiskStatus(name, "committing\nAnalysing files\n")
+    
+        # get records of the files within this freedisk, sorted by path
+        fileRecs = sorted(self.diskFiles(rootRec), key=lambda rec: rec.path)
+    
+        # hash the files which changed since they were last hashed
+        changed = [rec for rec in fileRecs
+                   if rec.stream is not None and (rec.haschanged or not rec.hash)]
+        with ThreadPoolExecutor() as pool:
+            for rec, hash in zip(changed, pool.map(
+                    lambda rec: sha1(rec.stream.getbuffer()).hexdigest(), changed)):
+                rec.hash = hash
+        for rec in fileRecs:
+            rec.mimetype = guessMimetype(rec.path) or "text/plain"
     
-        # update status
-        #statusFile.data = "committing\nAnalysing files\n"
-    
-        # get list of records of files within this freedisk
-        fileRecs = []
-        for f in list(self.files.keys()):
-            # is file/dir within the freedisk?
-            if f.startswith(rootPath+"/"):
-                # yes, get its record
-                fileRec = self.files[f]
-    
-                # is it a file, and not a special file?
-                if fileRec.isfile \
-                and (os.path.split(f)[1] not in freediskSpecialFiles):
-                    # yes, grab it
-                    fileRecs.append(fileRec)
+        # uris of the files which are already in freenet, by hash and mimetype
+        known = {}
+        for entry in self.loadManifest(name).values():
+            known[(entry['hash'], entry['mimetype'])] = entry['uri']
+        journal = CommitJournal(os.path.join(self.stateDir, name + ".journal"))
+        known.update(journal.uris)
     
-        # now sort them by path
-        fileRecs.sort(lambda r1, r2: cmp(r1.path, r2.path))
+        jobsWaiting = []
+        for rec in fileRecs:
+            uri = known.get((rec.hash, rec.mimetype))
+            if uri:
+                rec.uri = uri
+            elif rec.stream is not None:
+                jobsWaiting.append(rec)
+            elif not rec.uri:
+                # an empty file, which has never been written
+                rec.data = b""
+                rec.hash = sha1(b"").hexdigest()
+                jobsWaiting.append(rec)
+    
+        self.log("commitDisk: %s of %s files to insert" % (
+            len(jobsWaiting), len(fileRecs)))
     
         # make sure we have a node to talk to
         self.connectToNode()
         node = self.node
     
-        # determine CHKs for all these jobs
-        for rec in fileRecs:
-            rec.mimetype = guessMimetype(rec.path)
-            rec.uri = node.put(
-                "CHK@file",
-                data=rec.data,
-                chkonly=True,
-                mimetype=rec.mimetype)
-        
-        # now insert all these files
-        maxJobs = 5
-        jobsWaiting = fileRecs[:]
-        jobsRunning = []
-        jobsDone = []
-    
-        # now, create the manifest XML file
-        manifest = XMLFile(root="freedisk")
-        root = manifest.root
-        for rec in jobsWaiting:
-            fileNode = root._addNode("file")
-            fileNode.path = rec.path
-            fileNode.uri = rec.uri
-            try:
-                fileNode.mimetype = rec.mimetype
-            except:
-                fileNode.mimetype = "text/plain"
-            fileNode.hash = sha1(rec.data).hexdigest()
-    
-        # and create an index.html to make it freesite-compatible
-        indexLines = [
-            "<html><head><title>This is a freedisk</title></head><body>",
-            "<h1>freedisk: %s" % name,
-            "<table cellspacing=0 cellpadding=3 border=1>"
-            "<tr>",
-            "<td><b>Size</b></td>",
-            "<td><b>Filename</b></td>",
-            "<td><b>URI</b></td>",
-            "</tr>",
-            ]
-        for rec in fileRecs:
-            indexLines.append("<tr><td>%s</td><td>%s</td><td>%s</td></tr>" % (
-                rec.size, rec.path, rec.uri))
-        indexLines.append("</table></body></html>\n")
-        indexHtml = "\n".join(indexLines)
-    
-        # and add the manifest as a waiting job
-        manifestJob = node.put(
-            privKey,
-            data=manifest.toxml(),
-            mimetype="text/xml",
-            **{"async": True}
-            )
-    
-        #jobsRunning.append(manifestJob)
-        #manifestUri = manifestJob.wait()
-        #print "manifestUri=%s" % manifestUri
-        #time.sleep(6)
-    
-        # the big insert/wait loop
-        while jobsWaiting or jobsRunning:
-            nWaiting = len(jobsWaiting)
-            nRunning = len(jobsRunning)
-            self.log("commit: %s waiting, %s running" % (nWaiting,nRunning))
-    
-            # launch jobs, if available, and if spare slots
-            while len(jobsRunning) < maxJobs and jobsWaiting:
-    
-                rec = jobsWaiting.pop(0)
-    
-                # if record has data, insert it, otherwise take as done            
-                if rec.hasdata:
-                    uri = rec.uri
-                    if not uri:
-                        uri = "CHK@somefile" + os.path.splitext(rec.path)[1]
-                    job = node.put(uri, data=rec.data, **{"async": True})
-                    rec.job = job
-                    jobsRunning.append(rec)
-                else:
-                    # record should already have the hash, uri, mimetype
-                    jobsDone.append(rec)
-    
-            # check running jobs
-            for rec in jobsRunning:
-                if rec == manifestJob:
-                    job = rec
-                else:
-                    job = rec.job
+        def progress(nDone, nTotal):
+            self.setDiskStatus(name, "committing\n%s of %s files inserted\n" % (
+                nDone, nTotal))
     
-                if job.isComplete():
-                    jobsRunning.remove(rec)
+        try:
+            insertFiles(node, jobsWaiting, journal, self.log, progress)
+            manifestUri = self.putManifest(name, fileRecs)
     
-                    uri = job.wait()
+        except:
+            # the journal is kept, so that the next commit resumes this one
+            self.setDiskStatus(name, "failed\n")
+            raise
     
-                    if job != manifestJob:
-                        rec.uri = uri
-                        rec.job = None
-                        jobsDone.append(rec)
+        finally:
+            journal.close()
     
-            # breathe!!
-            if jobsRunning:
-                time.sleep(5)
-            else:
-                time.sleep(1)
+        journal.remove()
+        for rec in fileRecs:
+            rec.haschanged = False
+        self.setDiskStatus(name, "idle\n")
     
-        manifestUri = manifestJob.wait()
         self.log("commitDisk: done, manifestUri=%s" % manifestUri)
     
-        #pubKeyFile.data = manifestJob.uri
-    
         endTime = time.time()
         commitTime = endTime - startTime
     
@@ -1241,6 +1221,14 @@ class FreenetBaseFS:
         """
         synchronises a freedisk FROM freenet
         
+        Fetches the manifest of the disk, and compares the hash of each
+        of its files with the local record of the file, or with the
+        manifest of the last commit or update if there is no record.
+        Changed files are fetched concurrently, unchanged files without
+        a record get one which fetches its data when it is first read.
+        Files with changes which are not committed are left alone, files
+        which are gone from the manifest are removed.
+        
         Arguments:
             - name - the name of the disk
         """
@@ -1251,28 +1239,72 @@ class FreenetBaseFS:
         # get the freedisk root's record, barf if nonexistent
         diskRec = self.freedisks.get(name, None)
         if not diskRec:
-            self.log("commitDisk: no such disk '%s'" % name)
+            self.log("updateDisk: no such disk '%s'" % name)
             return "No such disk '%s'" % name
         
-        rootRec = diskRec.root
+        rootPath = diskRec.root.path
     
-        # and get the public key, sans 'freenet:'
-        pubKey = rootRec.pubKey
-        
-        pubKey = pubKey.split("freenet:")[-1]
+        self.setDiskStatus(name, "updating\nFetching manifest\n")
+        self.connectToNode()
+        try:
+            raw = self.getManifest(name)
+        except:
+            self.setDiskStatus(name, "failed\n")
+            raise
+        remote = manifestEntries(raw)
+        previous = self.loadManifest(name)
+        local = dict((rec.path[len(rootPath)+1:], rec)
+                     for rec in self.diskFiles(diskRec.root))
+    
+        changed = []
+        nLazy = 0
+        for relpath, entry in sorted(remote.items()):
+            rec = local.get(relpath)
+            if rec is None:
+                rec = self.addDiskFile(rootPath + "/" + relpath)
+                if previous.get(relpath, {}).get('hash') == entry['hash']:
+                    # unchanged, only fetched when it is read
+                    rec.uri = entry['uri']
+                    rec.size = entry['size']
+                    rec.hash = entry['hash']
+                    rec.mimetype = entry['mimetype']
+                    nLazy += 1
+                    continue
+            elif rec.haschanged:
+                self.log("updateDisk: keeping local changes of %s" % rec.path)
+                continue
+            elif rec.hash == entry['hash']:
+                continue
+            rec.uri = entry['uri']
+            rec.hash = entry['hash']
+            rec.mimetype = entry['mimetype']
+            changed.append(rec)
     
-        # process further
-        pubKey = privKey.replace("SSK@", "USK@").split("/")[0] + "/" + name + "/0"
+        for relpath, rec in local.items():
+            if relpath not in remote and relpath in previous and not rec.haschanged:
+                self.delFromCache(rec)
     
-        self.log("update: pubKey=%s" % pubKey)
+        self.log("updateDisk: fetching %s of %s files, %s on first read" % (
+            len(changed), len(remote), nLazy))
     
-        # fetch manifest
+        nFetched = itertools.count(1)
+        def store(rec, data):
+            rec.data = data
+            rec.mtime = timeNow()
+            self.setDiskStatus(name, "updating\n%s of %s files fetched\n" % (
+                next(nFetched), len(changed)))
     
-        # mark disk as readonly
-            
-        # for each entry in manifest
-        #     if not localfile has changed
-        #         replace the file record
+        for rec in fetchFiles(self.node, changed, store, self.log):
+            # try again when the file is read
+            self.forgetKey(rec.uri)
+            rec.stream = None
+            rec.size = remote[rec.path[len(rootPath)+1:]]['size']
+    
+        self.saveManifest(name, raw)
+        self.setDiskStatus(name, "idle\n")
+    
+        self.log("updateDisk: update completed in %s seconds" % (
+            time.time() - startTime))
     
     #@-node:updateDisk
     #@+node:getManifest
@@ -1280,13 +1312,101 @@ class FreenetBaseFS:
         """
         Retrieves the manifest of a given disk
         """
+        diskRec = self.freedisks[name]
+        self.connectToNode()
+        mimetype, raw, msg = self.node.get(manifestUri(diskRec.pubKey, name, -1))
+        return bytes(raw).decode("utf-8")
+    
     #@-node:getManifest
     #@+node:putManifest
-    def putManifest(self, name):
+    def putManifest(self, name, fileRecs):
         """
-        Inserts a freedisk manifest into freenet
+        Inserts a freedisk manifest into freenet, and saves it for the
+        next commit, returns its uri
+        
+        Arguments:
+            - name - the name of the disk
+            - fileRecs - the records of the files of the disk, which all
+              have a uri and a hash
         """
+        rootPath = self.freedisks[name].root.path
+        raw = buildManifest([rec.path[len(rootPath)+1:], rec.uri,
+                             rec.mimetype, rec.hash, rec.size]
+                            for rec in fileRecs)
+        self.connectToNode()
+        uri = self.node.put(manifestUri(self.freedisks[name].privKey, name),
+                            data=raw, mimetype="text/xml")
+        self.saveManifest(name, raw)
+        return uri
+    
     #@-node:putManifest
+    #@+node:loadManifest
+    def loadManifest(self, name):
+        """
+        Returns the entries of the manifest saved by the last commit of
+        a disk, as dicts by path, which are empty if it was not committed
+        """
+        path = os.path.join(self.stateDir, name + ".manifest.xml")
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return {}
+        return manifestEntries(raw)
+    
+    #@-node:loadManifest
+    #@+node:saveManifest
+    def saveManifest(self, name, raw):
+        """
+        Saves the manifest of a commit of a disk
+        """
+        os.makedirs(self.stateDir, exist_ok=True)
+        path = os.path.join(self.stateDir, name + ".manifest.xml")
+        with open(path + ".new", "w") as f:
+            f.write(raw)
+        os.replace(path + ".new", path)
+    
+    #@-node:saveManifest
+    #@+node:diskFiles
+    def diskFiles(self, rec):
+        """
+        Yields the records of the files below a freedisk directory,
+        except the special files of the disk itself
+        """
+        for child in list(rec.children.values()):
+            if child.isdir:
+                yield from self.diskFiles(child)
+            elif child.isfile and not (rec.parent.path == "/usr"
+                                       and child.name in freediskSpecialFiles):
+                yield child
+    
+    #@-node:diskFiles
+    #@+node:addDiskFile
+    def addDiskFile(self, path):
+        """
+        Adds the record of a file of a freedisk, and of the directories
+        it is in, if they are missing
+        """
+        missing = []
+        dirPath = os.path.split(path)[0]
+        while dirPath not in self.files:
+            missing.append(dirPath)
+            dirPath = os.path.split(dirPath)[0]
+        for dirPath in reversed(missing):
+            self.addToCache(path=dirPath, isdir=True, perm=0o755)
+        return self.addToCache(path=path, isreg=True, perm=0o644)
+    
+    #@-node:addDiskFile
+    #@+node:setDiskStatus
+    def setDiskStatus(self, name, status):
+        """
+        Shows the status of a disk in its .status file, if it has one
+        """
+        rec = self.files.get("/usr/%s/.status" % name, None)
+        if rec:
+            rec.data = status
+    
+    #@-node:setDiskStatus
     #@-others
     
     #@-node:freedisk methods
@@ -1300,8 +1420,10 @@ class FreenetBaseFS:
         Create initial file/directory layout, according
         to attributes 'initialFiles' and 'chrFiles'
         """
-        # easy map of files
+        # easy map of files, and of their inode numbers
         self.files = {}
+        self.inodes = {}
+        self.inodeCounter = itertools.count(1)
     
         # now create records for initial files
         for path in self.initialFiles:
@@ -1381,6 +1503,117 @@ class FreenetBaseFS:
         #    print "mythread: ticking"
     
     #@-node:mythread
+    #@+node:keySize
+    def keySize(self, uri):
+        """
+        Returns the size of the data of a key, as soon as the node tells
+        it, without getting the data
+        
+        The request goes on, so the data gets into the node's cache.
+        """
+        sizeKnown = Event()
+        sizes = []
+        def callback(status, value):
+            if status == 'pending' and 'DataLength' in value:
+                # ExpectedDataLength or DataFound
+                sizes.append(int(value['DataLength']))
+            if status != 'pending' or sizes:
+                sizeKnown.set()
+        
+        job = self.node.get(uri, nodata=True, callback=callback,
+                            **{"async": True})
+        sizeKnown.wait()
+        if sizes:
+            return sizes[0]
+        mimetype, ignored, msg = job.wait()
+        return int(msg['DataLength'])
+    
+    #@-node:keySize
+    #@+node:readKey
+    def readKey(self, rec, length, offset):
+        """
+        Returns up to length bytes at offset of the data of the key of
+        rec, from the block cache, or else from a fetch of the key, as
+        soon as the fetch got that far
+        """
+        cache = self.blockCache
+        end = min(offset + length, rec.size)
+        if end <= offset:
+            return b""
+        indexes = range(offset // cache.blockSize, (end - 1) // cache.blockSize + 1)
+        blocks = [cache.get(rec.uri, index) for index in indexes]
+        if None in blocks:
+            return self.fetchKey(rec.uri).read(offset, end - offset)
+        data = b"".join(blocks)
+        start = offset - indexes[0] * cache.blockSize
+        return data[start:start + end - offset]
+    
+    #@-node:readKey
+    #@+node:fetchKey
+    def fetchKey(self, uri):
+        """
+        Returns the KeyFetch of a key, starting it unless it is running,
+        or its file is still kept from a fetch which completed
+        """
+        with self.fetchesLock:
+            fetch = self.fetches.get(uri)
+            if fetch is not None:
+                return fetch
+            fetch = self.fetched.get(uri)
+            if fetch is not None:
+                self.fetched.move_to_end(uri)
+                return fetch
+            self.log("fetchKey: uri=%s" % uri)
+            self.connectToNode()
+            fetch = KeyFetch(self.blockCache, uri, self.cacheDir)
+            self.fetches[uri] = fetch
+        
+        def callback(status, value):
+            if status == 'pending':
+                return
+            with self.fetchesLock:
+                if self.fetches.get(uri) is fetch:
+                    del self.fetches[uri]
+                    if status != 'failed':
+                        self.keepFetched(uri, fetch)
+            fetch.finish(value if status == 'failed' else None)
+        
+        try:
+            self.node.get(uri, stream=fetch, callback=callback, **{"async": True})
+        except Exception as e:
+            callback('failed', e)
+        return fetch
+    
+    #@-node:fetchKey
+    #@+node:keepFetched
+    def keepFetched(self, uri, fetch):
+        """
+        Keeps the file of a completed fetch, so that reads which miss the
+        block cache are served from it, and drops the files of the least
+        recently used keys beyond spillBytes, except the newest one
+        
+        Called with fetchesLock held. Readers which still have a dropped
+        fetch can go on reading its file, which is closed after them.
+        """
+        self.fetched[uri] = fetch
+        self.fetchedBytes += fetch.received
+        while self.fetchedBytes > self.spillBytes and len(self.fetched) > 1:
+            dropped, droppedFetch = self.fetched.popitem(last=False)
+            self.fetchedBytes -= droppedFetch.received
+    
+    #@-node:keepFetched
+    #@+node:forgetKey
+    def forgetKey(self, uri):
+        """
+        Drops the cached blocks and the kept file of a key
+        """
+        self.blockCache.discard(uri)
+        with self.fetchesLock:
+            fetch = self.fetched.pop(uri, None)
+            if fetch is not None:
+                self.fetchedBytes -= fetch.received
+    
+    #@-node:forgetKey
     #@+node:hashpath
     def hashpath(self, path):
         
@@ -1409,13 +1642,14 @@ class FreenetBaseFS:
         if path != '/':
             parentPath = os.path.split(path)[0]
             parentRec = self.files.get(parentPath, None)
-            parentRec.addChild(rec)
             if not parentRec:
                 self.log("addToCache: no parent of %s ?!?!" % path)
                 return
+            parentRec.addChild(rec)
     
-        # ok, add to our table
+        # ok, add to our tables
         self.files[path] = rec
+        self.inodes[rec.inode] = rec
     
         # done
         return rec
@@ -1438,9 +1672,9 @@ class FreenetBaseFS:
         parentPath = os.path.split(path)[0]
         
         if path in self.files:
-            rec = self.files[path]
-            del self.files[path]
-            for child in rec.children:
+            rec = self.files.pop(path)
+            self.inodes.pop(rec.inode, None)
+            for child in list(rec.children.values()):
                 self.delFromCache(child)
         
         parentRec = self.files.get(parentPath, None)
@@ -1448,50 +1682,25 @@ class FreenetBaseFS:
             parentRec.delChild(rec)
     
     #@-node:delFromCache
-    #@+node:statFromKw
-    def statFromKw(self, **kw):
-        """
-        Constructs a stat tuple from keywords
-        """
-        tup = [0] * 10
-    
-        # build mode mask
-        mode = kw.get('mode', 0)
-        if kw.get('isdir', False):
-            mode |= stat.S_IFDIR
-        if kw.get('ischr', False):
-            mode |= stat.S_IFCHR
-        if kw.get('isblk', False):
-            mode |= stat.S_IFBLK
-        if kw.get('isreg', False):
-            mode |= stat.S_IFREG
-        if kw.get('isfifo', False):
-            mode |= stat.S_IFIFO
-        if kw.get('islink', False):
-            mode |= stat.S_IFLNK
-        if kw.get('issock', False):
-            mode |= stat.S_IFSOCK
-    
-        path = kw['path']
-    
-        # get inode number
-        inode = self.pathToInode(path)
-        
-        dev = 0
-        
-        nlink = 1
-        uid = myuid
-        gid = mygid
-        size = 0
-        atime = mtime = ctime = timeNow()
-    
-        return (mode, inode, dev, nlink, uid, gid, size, atime, mtime, ctime)
-    
-        # st_mode, st_ino, st_dev, st_nlink,
-        # st_uid, st_gid, st_size,
-        # st_atime, st_mtime, st_ctime
-    
-    #@-node:statFromKw
+    #@+node:moveRecord
+    def moveRecord(self, rec, path):
+        """
+        Puts a record, removed with delFromCache, back in the cache at a
+        new path, together with its children
+        """
+        rec.path = path
+        rec.name = os.path.split(path)[1]
+        rec.parent = self.files[os.path.split(path)[0]]
+        children = list(rec.children.values())
+        rec.children.clear()
+        rec._childNames = None
+        if rec.isdir:
+            rec.size = 2
+        self.addToCache(rec)
+        for child in children:
+            self.moveRecord(child, os.path.join(path, child.name))
+    
+    #@-node:moveRecord
     #@+node:statToDict
     def statToDict(self, info):
         """
@@ -1525,7 +1734,7 @@ class FreenetBaseFS:
             'isblk'  : stat.S_ISBLK(mode),
             'isreg'  : stat.S_ISREG(mode),
             'isfifo' : stat.S_ISFIFO(mode),
-            'islink'  : stat.S_ISLNK(mode),
+            'islnk'  : stat.S_ISLNK(mode),
             'issock' : stat.S_ISSOCK(mode),
             'mode'   : mode,
             'inode'  : info[stat.ST_INO],
@@ -1565,7 +1774,9 @@ class FreenetBaseFS:
     def log(self, msg):
         #if not quiet:
         #    print "freedisk:"+msg
-        file("/tmp/freedisk.log", "a").write(msg+"\n")
+        if self.logFile is None:
+            self.logFile = open("/tmp/freedisk.log", "a", buffering=1)
+        self.logFile.write(msg+"\n")
     
     #@-node:log
     #@-others
@@ -1724,316 +1935,636 @@ class FreenetFuseFS(FreenetBaseFS):
     #@-others
 #@-node:class FreenetFuseFS
 #@+node:class FileRecord
-class FileRecord(list):
+class FileRecord:
     """
     Encapsulates the info for a file, and can
     be returned by getattr
+    
+    Iterating over a record yields its stat tuple. The children of a
+    directory are kept in a dict by name.
+    
+    >>> class FS: pass
+    >>> fs = FS()
+    >>> fs.files, fs.inodes, fs.inodeCounter = {}, {}, itertools.count(1)
+    >>> root = FileRecord(fs, path="/", isdir=True, perm=0o755)
+    >>> fs.files["/"] = root
+    >>> rec = FileRecord(fs, path="/b", isreg=True, perm=0o644, data="hello")
+    >>> root.addChild(rec)
+    >>> root.addChild(FileRecord(fs, path="/a", isdir=True, perm=0o755))
+    >>> root.childNames(), root.size, rec.isreg, rec.isdir, rec.size
+    (['a', 'b'], 4, True, False, 5)
+    >>> tuple(rec)[stat.ST_INO], oct(tuple(rec)[stat.ST_MODE])
+    (2, '0o100644')
+    >>> rec.write(b"!")
+    >>> rec.data, rec.size
+    (b'!ello', 5)
+    >>> FileRecord(fs, path="/l", islink=True).islnk
+    True
     """
     #@    @+others
     #@+node:attribs
-    # default attribs, can be overwritten by constructor keywords
-    haschanged = False
-    hasdata = False
-    canwrite = False
-    iswriting = False
-    uri = None
+    __slots__ = (
+        'fs', 'path', 'name', 'parent', 'children', '_childNames',
+        'mode', 'inode', 'dev', 'nlink', 'uid', 'gid', 'size',
+        'atime', 'mtime', 'ctime', 'stream',
+        'haschanged', 'hasdata', 'canwrite', 'iswriting',
+        'uri', 'mimetype', 'job', 'hash',
+        )
     
     #@-node:attribs
     #@+node:__init__
     def __init__(self, fs, statrec=None, **kw):
         """
         """
-        # copy keywords cos we'll be popping them
-        kw = dict(kw)
-    
         # save fs ref
         self.fs = fs
     
         # got a statrec arg?
         if statrec:
             # yes, extract main items
-            dev = statrec[stat.ST_DEV]
-            nlink = statrec[stat.ST_NLINK]
-            uid = statrec[stat.ST_UID]
-            gid = statrec[stat.ST_GID]
-            size = statrec[stat.ST_SIZE]
+            self.dev = statrec[stat.ST_DEV]
+            self.nlink = statrec[stat.ST_NLINK]
+            self.uid = statrec[stat.ST_UID]
+            self.gid = statrec[stat.ST_GID]
+            self.mode = statrec[stat.ST_MODE]
         else:
             # no, fudge a new one
-            statrec = [0,0,0,0,0,0,0,0,0,0]
-            dev = 0
-            nlink = 1
-            uid = myuid
-            gid = mygid
-            size = 0
-    
-        # convert tuple to list if need be
-        if not hasattr(statrec, '__setitem__'):
-            statrec = list(statrec)
+            self.dev = 0
+            self.nlink = 1
+            self.uid = myuid
+            self.gid = mygid
+            self.mode = 0
     
         # build mode mask
-        mode = kw.pop('mode', 0)
-        if kw.pop('isdir', False):
-            mode |= stat.S_IFDIR
-        if kw.pop('ischr', False):
-            mode |= stat.S_IFCHR
-        if kw.pop('isblk', False):
-            mode |= stat.S_IFBLK
-        if kw.pop('isreg', False):
-            mode |= stat.S_IFREG
-        if kw.pop('isfifo', False):
-            mode |= stat.S_IFIFO
-        if kw.pop('islink', False):
-            mode |= stat.S_IFLNK
-        if kw.pop('issock', False):
-            mode |= stat.S_IFSOCK
+        self.mode |= kw.pop('mode', 0)
+        # islink is the older spelling of islnk
+        kw['islnk'] = kw.pop('islnk', False) or kw.pop('islink', False)
+        for flag in ('isdir', 'ischr', 'isblk', 'isreg', 'isfifo', 'islnk', 'issock'):
+            if kw.pop(flag, False):
+                setattr(self, flag, True)
     
         # handle non-file-related keywords
-        perm = kw.pop('perm', 0)
-        mode |= perm
+        self.mode |= kw.pop('perm', 0)
     
         # set path
         path = kw.pop('path')
         self.path = path
+        self.name = os.path.split(path)[1]
     
-        # set up data stream
-        if "data" in kw:
-            self.stream = StringIO(kw.pop('data'))
-            self.hasdata = True
-        else:
-            self.stream = StringIO()
-        
         # find parent, if any
         if path == '/':
             self.parent = None
         else:
-            parentPath = os.path.split(path)[0]
-            parentRec = fs.files[parentPath]
-            self.parent = parentRec
+            self.parent = fs.files[os.path.split(path)[0]]
     
         # child files/dirs
-        self.children = []
+        self.children = {}
+        self._childNames = None
         
         # get inode number
-        inode = pathToInode(path)
+        self.inode = next(fs.inodeCounter)
         
-        #size = kw.get('size', 0)
         now = timeNow()
-        atime = kw.pop('atime', now)
-        mtime = kw.pop('mtime', now)
-        ctime = kw.pop('ctime', now)
-    
-        #print "statrec[stat.ST_MODE]=%s" % statrec[stat.ST_MODE]
-        #print "mode=%s" % mode
-    
-        statrec[stat.ST_MODE] |= mode
-        statrec[stat.ST_INO] = inode
-        statrec[stat.ST_DEV] = dev
-        statrec[stat.ST_NLINK] = nlink
-        statrec[stat.ST_UID] = uid
-        statrec[stat.ST_GID] = gid
-    
-        statrec[stat.ST_SIZE] = len(self.stream.getvalue())
-    
-        statrec[stat.ST_ATIME] = atime
-        statrec[stat.ST_MTIME] = atime
-        statrec[stat.ST_CTIME] = atime
+        self.atime = kw.pop('atime', now)
+        self.mtime = kw.pop('mtime', now)
+        self.ctime = kw.pop('ctime', now)
+    
+        # default attribs, can be overwritten by constructor keywords
+        self.haschanged = False
+        self.hasdata = False
+        self.canwrite = False
+        self.iswriting = False
+        self.uri = None
+        self.mimetype = None
+        self.job = None
+        self.hash = None
+    
+        # set up data stream, only created when there is data
+        self.stream = None
+        self.size = kw.pop('size', 0)
+        if "data" in kw:
+            self.data = kw.pop('data')
+            self.hasdata = True
     
         # throw remaining keywords into instance's attribs
-        self.__dict__.update(kw)
-    
-        # finally, parent constructor, now that we have a complete stat list
-        list.__init__(self, statrec)
+        for k, v in kw.items():
+            setattr(self, k, v)
     
         if self.isdir:
             self.size = 2
     
     #@-node:__init__
-    #@+node:__getattr__
-    def __getattr__(self, attr):
+    #@+node:mode flags
+    def _modeFlag(flag, test):
+        def get(self):
+            return test(self.mode)
+        def set(self, val):
+            if val:
+                self.mode |= flag
+            else:
+                self.mode &= ~flag
+        return property(get, set)
+    
+    isdir = _modeFlag(stat.S_IFDIR, stat.S_ISDIR)
+    ischr = _modeFlag(stat.S_IFCHR, stat.S_ISCHR)
+    isblk = _modeFlag(stat.S_IFBLK, stat.S_ISBLK)
+    isreg = isfile = _modeFlag(stat.S_IFREG, stat.S_ISREG)
+    isfifo = _modeFlag(stat.S_IFIFO, stat.S_ISFIFO)
+    islnk = _modeFlag(stat.S_IFLNK, stat.S_ISLNK)
+    issock = _modeFlag(stat.S_IFSOCK, stat.S_ISSOCK)
+    del _modeFlag
+    
+    #@-node:mode flags
+    #@+node:__iter__
+    def __iter__(self):
+        """
+        Yields the stat tuple
+        """
+        return iter((self.mode, self.inode, self.dev, self.nlink,
+                     self.uid, self.gid, self.size,
+                     self.atime, self.mtime, self.ctime))
+    
+    #@-node:__iter__
+    #@+node:__repr__
+    def __repr__(self):
+        return "<FileRecord %s %s>" % (self.path, tuple(self))
+    
+    #@-node:__repr__
+    #@+node:data
+    def _getData(self):
+        if self.stream is None:
+            return b""
+        return self.stream.getvalue()
+    
+    def _setData(self, val):
+        if isinstance(val, str):
+            val = val.encode("utf-8")
+        oldPos = self.stream.tell() if self.stream is not None else 0
+        self.stream = BytesIO(val)
+        self.stream.seek(min(oldPos, len(val)))
+        self.size = len(val)
+    
+    data = property(_getData, _setData)
+    
+    #@-node:data
+    #@+node:seek
+    def seek(self, offset):
+        
+        if self.stream is None:
+            self.stream = BytesIO()
+        self.stream.seek(offset)
+    
+    #@-node:seek
+    #@+node:read
+    def read(self, length):
+        
+        if self.stream is None:
+            return b""
+        return self.stream.read(length)
+    
+    #@-node:read
+    #@+node:write
+    def write(self, buf):
+        
+        if self.stream is None:
+            self.stream = BytesIO()
+        if isinstance(buf, str):
+            buf = buf.encode("utf-8")
+        self.stream.write(buf)
+        self.size = max(self.size, self.stream.tell())
+    
+    #@-node:write
+    #@+node:addChild
+    def addChild(self, rec):
         """
-        Support read of pseudo-attributes:
-            - mode, isdir, ischr, isblk, isreg, isfifo, islnk, issock,
-            - inode, dev, nlink, uid, gid, size, atime, mtime, ctime
+        Adds a child file rec as a child of this rec
         """
-        if attr == 'mode':
-            return self[stat.ST_MODE]
+        if not isinstance(rec, FileRecord):
+            raise Exception("Not a FileRecord: %s" % rec)
     
-        if attr == 'isdir':
-            return stat.S_ISDIR(self.mode)
+        if rec.name not in self.children:
+            self.size += 1
+        self.children[rec.name] = rec
+        self._childNames = None
     
-        if attr == 'ischr':
-            return stat.S_ISCHR(self.mode)
+        #print "addChild: path=%s size=%s" % (self.path, self.size)
     
-        if attr == 'isblk':
-            return stat.S_ISBLK(self.mode)
+    #@-node:addChild
+    #@+node:delChild
+    def delChild(self, rec):
+        """
+        Tries to remove a child entry
+        """
+        if self.children.get(rec.name) is rec:
+            del self.children[rec.name]
+            self._childNames = None
+            self.size -= 1
     
-        if attr in ['isreg', 'isfile']:
-            return stat.S_ISREG(self.mode)
+        else:
+            self.fs.log("delChild: %s is not a child of %s" % (rec.path, self.path))
     
-        if attr == 'isfifo':
-            return stat.S_ISFIFO(self.mode)
+        #print "delChild: path=%s size=%s" % (self.path, self.size)
     
-        if attr == 'islnk':
-            return stat.S_ISLNK(self.mode)
+    #@-node:delChild
+    #@+node:childNames
+    def childNames(self):
+        """
+        Returns the sorted names of the children, which are only sorted
+        again after they changed
+        """
+        if self._childNames is None:
+            self._childNames = sorted(self.children)
+        return self._childNames
     
-        if attr == 'issock':
-            return stat.S_ISSOCK(self.mode)
+    #@-node:childNames
+    #@-others
+
+#@-node:class FileRecord
+#@+node:class BlockCache
+class BlockCache:
+    """
+    Keeps the data of keys in blocks of blockSize bytes, evicting the
+    least recently used blocks when there are more than maxBytes of
+    them. Evicted blocks go to files in spillDir, if given, which keeps
+    spillBytes of them the same way.
+    
+    >>> cache = BlockCache(8, blockSize=4)
+    >>> cache.put("CHK@a", 0, b"abcd")
+    >>> cache.put("CHK@a", 1, b"efgh")
+    >>> cache.get("CHK@a", 0)
+    b'abcd'
+    >>> cache.put("CHK@b", 0, b"ijkl")
+    >>> cache.get("CHK@a", 1) is None
+    True
+    >>> import tempfile
+    >>> cache = BlockCache(4, tempfile.mkdtemp(), 8, blockSize=4)
+    >>> cache.put("CHK@a", 0, b"abcd")
+    >>> cache.put("CHK@a", 1, b"efgh")
+    >>> cache.get("CHK@a", 0)
+    b'abcd'
+    >>> cache.discard("CHK@a")
+    >>> cache.get("CHK@a", 1) is None
+    True
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, maxBytes=defaultCacheBytes, spillDir=None,
+                 spillBytes=defaultSpillBytes, blockSize=defaultBlockSize):
+        
+        self.maxBytes = maxBytes
+        self.spillDir = spillDir
+        self.spillBytes = spillBytes
+        self.blockSize = blockSize
+        self.lock = Lock()
+        # (uri, index) -> data, and -> size of the spilled ones
+        self.blocks = collections.OrderedDict()
+        self.spilled = collections.OrderedDict()
+        self.size = 0
+        self.spilledSize = 0
+        if spillDir and not os.path.isdir(spillDir):
+            os.makedirs(spillDir)
     
-        if attr == 'inode':
-            return self[stat.ST_INO]
+    #@-node:__init__
+    #@+node:get
+    def get(self, uri, index):
+        """
+        Returns the block of a key, or None if it is not cached
+        """
+        key = (uri, index)
+        with self.lock:
+            data = self.blocks.get(key)
+            if data is not None:
+                self.blocks.move_to_end(key)
+                return data
+            if key not in self.spilled:
+                return None
+            del self.spilled[key]
+            path = self._spillPath(key)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.unlink(path)
+            self.spilledSize -= len(data)
+            self._keep(key, data)
+            return data
+    
+    #@-node:get
+    #@+node:put
+    def put(self, uri, index, data):
+        """
+        Caches a block of a key
+        """
+        key = (uri, index)
+        with self.lock:
+            self._drop(key)
+            self._keep(key, bytes(data))
+    
+    #@-node:put
+    #@+node:discard
+    def discard(self, uri):
+        """
+        Drops all blocks of a key
+        """
+        with self.lock:
+            for key in [key for key in list(self.blocks) + list(self.spilled)
+                        if key[0] == uri]:
+                self._drop(key)
+    
+    #@-node:discard
+    #@+node:_keep
+    def _keep(self, key, data):
         
-        if attr == 'dev':
-            return self[stat.ST_DEV]
+        self.blocks[key] = data
+        self.size += len(data)
+        while self.size > self.maxBytes:
+            evicted, evictedData = self.blocks.popitem(last=False)
+            self.size -= len(evictedData)
+            if self.spillDir and len(evictedData) <= self.spillBytes:
+                with open(self._spillPath(evicted), "wb") as f:
+                    f.write(evictedData)
+                self.spilled[evicted] = len(evictedData)
+                self.spilledSize += len(evictedData)
+                while self.spilledSize > self.spillBytes:
+                    dropped, size = self.spilled.popitem(last=False)
+                    os.unlink(self._spillPath(dropped))
+                    self.spilledSize -= size
+    
+    #@-node:_keep
+    #@+node:_drop
+    def _drop(self, key):
         
-        if attr == 'nlink':
-            return self[stat.ST_NLINK]
+        data = self.blocks.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+        size = self.spilled.pop(key, None)
+        if size is not None:
+            os.unlink(self._spillPath(key))
+            self.spilledSize -= size
+    
+    #@-node:_drop
+    #@+node:_spillPath
+    def _spillPath(self, key):
         
-        if attr == 'uid':
-            return self[stat.ST_UID]
-    
-        if attr == 'gid':
-            return self[stat.ST_GID]
+        uri, index = key
+        return os.path.join(self.spillDir, "%s.%d" % (
+            sha1(uri.encode("utf-8")).hexdigest(), index))
     
-        if attr == 'size':
-            return self[stat.ST_SIZE]
-        
-        if attr == 'atime':
-            return self[stat.ST_ATIME]
-        
-        if attr == 'mtime':
-            return self[stat.ST_ATIME]
+    #@-node:_spillPath
+    #@-others
+
+#@-node:class BlockCache
+#@+node:class BlockWriter
+class BlockWriter:
+    """
+    A stream which cuts the data written to it into the blocks of a key
+    in a BlockCache
+    
+    >>> cache = BlockCache(blockSize=4)
+    >>> writer = BlockWriter(cache, "CHK@a")
+    >>> writer.write(b"abcdef")
+    >>> writer.write(memoryview(b"ghij"))
+    >>> writer.close()
+    >>> cache.get("CHK@a", 1), cache.get("CHK@a", 2)
+    (b'efgh', b'ij')
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, cache, uri):
         
-        if attr == 'ctime':
-            return self[stat.ST_ATIME]
+        self.cache = cache
+        self.uri = uri
+        self.index = 0
+        self.buf = bytearray()
     
-        if attr == 'data':
-            return self.stream.getvalue()
+    #@-node:__init__
+    #@+node:write
+    def write(self, data):
         
-        try:
-            return getattr(self.stream, attr)
-        except:
-            pass
+        self.buf += data
+        blockSize = self.cache.blockSize
+        while len(self.buf) >= blockSize:
+            self._putBlock(bytes(self.buf[:blockSize]))
+            del self.buf[:blockSize]
     
-        raise AttributeError(attr)
+    #@-node:write
+    #@+node:flush
+    def flush(self):
+        """
+        Does nothing, a partial block is only cached by close()
+        """
     
-    #@-node:__getattr__
-    #@+node:__setattr__
-    def __setattr__(self, attr, val):
+    #@-node:flush
+    #@+node:close
+    def close(self):
         """
-        Support write of pseudo-attributes:
-            - mode, isdir, ischr, isblk, isreg, isfifo, islnk, issock,
-            - inode, dev, nlink, uid, gid, size, atime, mtime, ctime
+        Caches what is left as the last block
         """
-        if attr == 'isdir':
-            if val:
-                self[stat.ST_MODE] |= stat.S_IFDIR
-            else:
-                self[stat.ST_MODE] &= ~stat.S_IFDIR
-        elif attr == 'ischr':
-            if val:
-                self[stat.ST_MODE] |= stat.S_IFCHR
-            else:
-                self[stat.ST_MODE] &= ~stat.S_IFCHR
-        elif attr == 'isblk':
-            if val:
-                self[stat.ST_MODE] |= stat.S_IFBLK
-            else:
-                self[stat.ST_MODE] &= ~stat.S_IFBLK
-        elif attr in ['isreg', 'isfile']:
-            if val:
-                self[stat.ST_MODE] |= stat.S_IFREG
-            else:
-                self[stat.ST_MODE] &= ~stat.S_IFREG
-        elif attr == 'isfifo':
-            if val:
-                self[stat.ST_MODE] |= stat.S_IFIFO
-            else:
-                self[stat.ST_MODE] &= ~stat.S_IFIFO
-        elif attr == 'islnk':
-            if val:
-                self[stat.ST_MODE] |= stat.S_IFLNK
-            else:
-                self[stat.ST_MODE] &= ~stat.S_IFLNK
-        elif attr == 'issock':
-            if val:
-                self[stat.ST_MODE] |= stat.S_IFSOCK
-            else:
-                self[stat.ST_MODE] &= ~stat.S_IFSOCK
-    
-        elif attr == 'mode':
-            self[stat.ST_MODE] = val
-        elif attr == 'inode':
-            self[stat.ST_IMO] = val
-        elif attr == 'dev':
-            self[stat.ST_DEV] = val
-        elif attr == 'nlink':
-            self[stat.ST_NLINK] = val
-        elif attr == 'uid':
-            self[stat.ST_UID] = val
-        elif attr == 'gid':
-            self[stat.ST_GID] = val
-        elif attr == 'size':
-            self[stat.ST_SIZE] = val
-        elif attr == 'atime':
-            self[stat.ST_ATIME] = val
-        elif attr == 'mtime':
-            self[stat.ST_MTIME] = val
-        elif attr == 'ctime':
-            self[stat.ST_CTIME] = val
-    
-        elif attr == 'data':
-            oldPos = self.stream.tell()
-            self.stream = StringIO(val)
-            self.stream.seek(min(oldPos, len(val)))
-            self.size = len(val)
+        if self.buf:
+            self._putBlock(bytes(self.buf))
+            self.buf = bytearray()
     
-        else:
-            self.__dict__[attr] = val
+    #@-node:close
+    #@+node:_putBlock
+    def _putBlock(self, block):
+        
+        self.cache.put(self.uri, self.index, block)
+        self.index += 1
+    
+    #@-node:_putBlock
+    #@-others
+
+#@-node:class BlockWriter
+#@+node:class KeyFetch
+class KeyFetch:
+    """
+    The data of a key as it arrives from the node, written to an
+    anonymous temporary file in dir and to a block cache. Reads of a
+    range block until the data got that far, or the fetch ended. The
+    file stays readable after the fetch, until the object is dropped.
+    
+    >>> fetch = KeyFetch(BlockCache(blockSize=4), "CHK@a")
+    >>> fetch.write(b"abcdef")
+    >>> fetch.read(2, 3)
+    b'cde'
+    >>> import threading
+    >>> reader = threading.Thread(target=lambda: print(fetch.read(4, 10)))
+    >>> reader.start()
+    >>> fetch.write(b"gh")
+    >>> fetch.finish()
+    >>> reader.join()
+    b'efgh'
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, cache, uri, dir=None):
+        
+        self.writer = BlockWriter(cache, uri)
+        self.file = tempfile.TemporaryFile(dir=dir, buffering=0)
+        self.received = 0
+        self.done = False
+        self.error = None
+        self.arrived = Condition()
     
-    #@-node:__setattr__
+    #@-node:__init__
     #@+node:write
-    def write(self, buf):
+    def write(self, data):
         
-        self.stream.write(buf)
-        self.size = len(self.stream.getvalue())
+        self.file.write(data)
+        self.writer.write(data)
+        with self.arrived:
+            self.received += len(data)
+            self.arrived.notify_all()
     
     #@-node:write
-    #@+node:addChild
-    def addChild(self, rec):
+    #@+node:flush
+    def flush(self):
+        pass
+    
+    #@-node:flush
+    #@+node:finish
+    def finish(self, error=None):
         """
-        Adds a child file rec as a child of this rec
+        Called when the fetch is done, or failed with error
         """
-        if not isinstance(rec, FileRecord):
-            raise Exception("Not a FileRecord: %s" % rec)
+        if error is None:
+            self.writer.close()
+        with self.arrived:
+            self.done = True
+            self.error = error
+            self.arrived.notify_all()
     
-        self.children.append(rec)
-        self.size += 1
+    #@-node:finish
+    #@+node:read
+    def read(self, offset, length):
+        """
+        Returns up to length bytes at offset, once they arrived
+        
+        Raises an IOError if the fetch failed before that.
+        """
+        with self.arrived:
+            while self.received < offset + length and not self.done:
+                self.arrived.wait()
+            if self.received < offset + length and self.error is not None:
+                raise IOError(errno.EIO, "Failed to fetch %s: %s" % (
+                    self.writer.uri, self.error))
+        return os.pread(self.file.fileno(), length, offset)
     
-        #print "addChild: path=%s size=%s" % (self.path, self.size)
+    #@-node:read
+    #@-others
+
+#@-node:class KeyFetch
+#@+node:class CommitJournal
+class CommitJournal:
+    """
+    Records the uris of the files inserted by a freedisk commit, so that
+    a commit which is interrupted can be resumed without inserting them
+    again. The uris are kept by hash and mimetype of the file.
+    
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), "disk.journal")
+    >>> journal = CommitJournal(path)
+    >>> journal.add("da39a3ee", "text/plain", "CHK@a")
+    >>> journal.close()
+    >>> CommitJournal(path).uris
+    {('da39a3ee', 'text/plain'): 'CHK@a'}
+    >>> journal.remove()
+    >>> CommitJournal(path).uris
+    {}
+    """
+    #@    @+others
+    #@+node:__init__
+    def __init__(self, path):
+        
+        self.path = path
+        self.file = None
+        self.uris = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    # skip a line which was cut short by the interruption
+                    if len(fields) == 3 and line.endswith("\n"):
+                        hash, mimetype, uri = fields
+                        self.uris[(hash, mimetype)] = uri
+        except FileNotFoundError:
+            pass
     
-    #@-node:addChild
-    #@+node:delChild
-    def delChild(self, rec):
+    #@-node:__init__
+    #@+node:add
+    def add(self, hash, mimetype, uri):
         """
-        Tries to remove a child entry
+        Records the uri of an inserted file
         """
-        if rec in self.children:
-            self.children.remove(rec)
-            self.size -= 1
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, "a")
+        self.file.write("%s %s %s\n" % (hash, mimetype, uri))
+        self.file.flush()
+        self.uris[(hash, mimetype)] = uri
     
-        else:
-            print("eh? trying to remove %s from %s" % (rec.path, self.path))
+    #@-node:add
+    #@+node:close
+    def close(self):
+        
+        if self.file is not None:
+            self.file.close()
+            self.file = None
     
-        #print "delChild: path=%s size=%s" % (self.path, self.size)
+    #@-node:close
+    #@+node:remove
+    def remove(self):
+        """
+        Drops the journal, once the commit is complete
+        """
+        self.close()
+        self.uris = {}
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
     
-    #@-node:delChild
+    #@-node:remove
     #@-others
 
-#@-node:class FileRecord
+#@-node:class CommitJournal
+#@+node:class MirrorFile
+class MirrorFile:
+    """
+    A file in the local directory of a FreediskMgr
+    """
+    #@    @+others
+    #@+node:attribs
+    __slots__ = ('path', 'fullpath', 'mimetype', 'hash', 'uri')
+    
+    #@-node:attribs
+    #@+node:__init__
+    def __init__(self, path, fullpath, mimetype=None, hash=None, uri=None):
+        
+        self.path = path
+        self.fullpath = fullpath
+        self.mimetype = mimetype or guessMimetype(path) or "text/plain"
+        self.hash = hash
+        self.uri = uri
+    
+    #@-node:__init__
+    #@+node:data
+    @property
+    def data(self):
+        """
+        The contents of the file, which are read as they are inserted
+        """
+        return fcp.node.FileData(self.fullpath)
+    
+    #@-node:data
+    #@-others
+
+#@-node:class MirrorFile
 #@+node:class FreediskMgr
 class FreediskMgr:
     """
     Gateway for mirroring a local directory to/from freenet
+    
+    Like freedisks in freenetfs, only the files which changed since the
+    last commit or update are inserted or fetched.
     """
     #@    @+others
     #@+node:__init__
@@ -2047,52 +2578,343 @@ class FreediskMgr:
             - root - mandatory - the root directory
             - publicKey - the freenet public key URI
             - privateKey - the freenet private key URI
+            - stateDir - the directory in which the manifest of the last
+              commit or update is kept, default ~/.freedisk
         Notes:
             - exactly one of publicKey, privateKey keywords must be given
         """
+        self.name = kw['name']
+        self.node = kw['fcpNode']
+        self.root = kw['root']
+        self.stateDir = kw.get('stateDir', defaultStateDir)
+    
+        if ('publicKey' in kw) == ('privateKey' in kw):
+            raise Exception("Need exactly one of publicKey, privateKey")
+        self.privateKey = kw.get('privateKey', None)
+        if self.privateKey:
+            self.publicKey = self.node.invertprivate(self.privateKey)
+        else:
+            self.publicKey = kw['publicKey']
+    
+        self.manifestPath = os.path.join(self.stateDir, self.name + ".manifest.xml")
+        self.journalPath = os.path.join(self.stateDir, self.name + ".journal")
     
     #@-node:__init__
     #@+node:update
     def update(self):
         """
         Update from freenet to local directory
-        """
+        
+        Files which differ from the manifest in freenet are fetched,
+        unless they were created or changed locally since the last
+        commit or update. Files which are gone from the manifest are
+        removed, unless they were changed locally.
+        """
+        mimetype, raw, msg = self.node.get(manifestUri(self.publicKey, self.name, -1))
+        raw = bytes(raw).decode("utf-8")
+        remote = manifestEntries(raw)
+        previous = self.loadManifest()
+        local = self.readFiles()
+    
+        changed = []
+        for path, entry in sorted(remote.items()):
+            f = local.get(path)
+            if f is not None:
+                if f.hash == entry['hash']:
+                    continue
+                if f.hash != previous.get(path, {}).get('hash'):
+                    # created or changed since the last commit or update
+                    self.log("update: keeping local changes of %s" % path)
+                    continue
+            changed.append(MirrorFile(path, os.path.join(self.root, path),
+                                      entry['mimetype'], entry['hash'],
+                                      entry['uri']))
+    
+        for path, f in local.items():
+            if path not in remote and path in previous \
+            and f.hash == previous[path]['hash']:
+                os.unlink(f.fullpath)
+    
+        def store(f, data):
+            os.makedirs(os.path.dirname(f.fullpath), exist_ok=True)
+            with open(f.fullpath + ".new", "wb") as fileobj:
+                fileobj.write(data)
+            os.replace(f.fullpath + ".new", f.fullpath)
+    
+        failed = fetchFiles(self.node, changed, store, self.log)
+        if failed:
+            # the next update fetches these again
+            raise IOError(errno.EIO, "Failed to fetch %s" % ", ".join(
+                f.path for f in failed))
+    
+        self.saveManifest(raw)
     
     #@-node:update
     #@+node:commit
     def commit(self):
         """
         commit from local directory into freenet
+        
+        Only files which are not in the manifest of the last commit or
+        update, or in the journal of an interrupted commit, are
+        inserted. Returns the uri of the manifest.
         """
+        if not self.privateKey:
+            raise IOError(errno.EIO, "Disk %s is read-only" % self.name)
+    
+        files = self.readFiles()
+    
+        known = {}
+        for entry in self.loadManifest().values():
+            known[(entry['hash'], entry['mimetype'])] = entry['uri']
+        journal = CommitJournal(self.journalPath)
+        known.update(journal.uris)
+    
+        waiting = []
+        for f in files.values():
+            f.uri = known.get((f.hash, f.mimetype))
+            if not f.uri:
+                waiting.append(f)
+    
+        try:
+            insertFiles(self.node, waiting, journal, self.log)
+            raw = buildManifest(
+                [path, f.uri, f.mimetype, f.hash, os.path.getsize(f.fullpath)]
+                for path, f in sorted(files.items()))
+            uri = self.node.put(manifestUri(self.privateKey, self.name),
+                                data=raw, mimetype="text/xml")
+        finally:
+            journal.close()
+    
+        self.saveManifest(raw)
+        journal.remove()
+        return uri
     
     #@-node:commit
+    #@+node:readFiles
+    def readFiles(self):
+        """
+        Returns the files of the local directory as MirrorFile objects
+        by their path relative to the root, with their hashes, which are
+        computed in parallel
+        """
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                fullpath = os.path.join(dirpath, filename)
+                path = os.path.relpath(fullpath, self.root).replace(os.sep, "/")
+                files[path] = MirrorFile(path, fullpath)
+        with ThreadPoolExecutor() as pool:
+            for f, hash in zip(files.values(), pool.map(
+                    fcp.node.hashFile, [f.fullpath for f in files.values()])):
+                f.hash = hash
+        return files
+    
+    #@-node:readFiles
+    #@+node:loadManifest
+    def loadManifest(self):
+        """
+        Returns the entries of the manifest of the last commit or update,
+        which are empty if there was none
+        """
+        try:
+            with open(self.manifestPath, "rb") as f:
+                return manifestEntries(f.read())
+        except FileNotFoundError:
+            return {}
+    
+    #@-node:loadManifest
+    #@+node:saveManifest
+    def saveManifest(self, raw):
+        
+        os.makedirs(self.stateDir, exist_ok=True)
+        with open(self.manifestPath + ".new", "w") as f:
+            f.write(raw)
+        os.replace(self.manifestPath + ".new", self.manifestPath)
+    
+    #@-node:saveManifest
+    #@+node:log
+    def log(self, msg):
+        
+        self.node._log(fcp.INFO, msg)
+    
+    #@-node:log
     #@-others
 
 #@-node:class FreediskMgr
-#@+node:pathToInode
-def pathToInode(path):
+#@+node:manifestEntries
+def manifestEntries(raw):
     """
-    Comes up with a unique inode number given a path
+    Returns the entries of a freedisk manifest as dicts by path
+    
+    >>> raw = '<freedisk><file path="a" uri="CHK@a" hash="00" mimetype="text/plain" size="3"/></freedisk>'
+    >>> manifestEntries(raw)["a"]["uri"], manifestEntries(raw)["a"]["size"]
+    ('CHK@a', 3)
     """
-    # try for existing known path/inode    
-    inode = inodes.get(path, None)
-    if inode != None:
-        return inode
+    entries = {}
+    for fileNode in XMLFile(raw=raw, root="freedisk").root._getChild("file"):
+        entry = dict(fileNode._items())
+        entry['size'] = int(entry.get('size', 0))
+        entries[entry['path']] = entry
+    return entries
 
-    # try hashing the path to 32bit
-    inode = int(md5(path).hexdigest()[:7], 16)
+#@-node:manifestEntries
+#@+node:buildManifest
+def buildManifest(entries):
+    """
+    Returns the XML of a freedisk manifest of the given entries, which
+    are sequences of path, uri, mimetype, hash and size
     
-    # and ensure it's unique
-    while inode in inodes:
-        inode += 1
-
-    # register it
-    inodes[path] = inode
+    >>> raw = buildManifest([("a", "CHK@a", "text/plain", "00", 3)])
+    >>> manifestEntries(raw)["a"]["hash"]
+    '00'
+    """
+    manifest = XMLFile(root="freedisk")
+    root = manifest.root
+    for path, uri, mimetype, hash, size in entries:
+        fileNode = root._addNode("file")
+        fileNode.path = path
+        fileNode.uri = uri
+        fileNode.mimetype = mimetype
+        fileNode.hash = hash
+        fileNode.size = size
+    return manifest.toxml()
 
-    # done
-    return inode
+#@-node:buildManifest
+#@+node:manifestUri
+def manifestUri(key, name, edition=0):
+    """
+    Returns the USK of the manifest of a freedisk, from the public or
+    private SSK of the disk
+    
+    Inserts use edition 0, from which the node goes on to the next free
+    edition. Fetches use edition -1, so that the node looks for the
+    latest edition instead of returning the first one.
     
-#@-node:pathToInode
+    >>> manifestUri("freenet:SSK@abc,def,AQACAAE/", "disk")
+    'USK@abc,def,AQACAAE/disk/0'
+    >>> manifestUri("SSK@abc,def,AQACAAE/", "disk", -1)
+    'USK@abc,def,AQACAAE/disk/-1'
+    """
+    key = key.split("freenet:")[-1]
+    return "%s/%s/%d" % (key.replace("SSK@", "USK@").split("/")[0], name, edition)
+
+#@-node:manifestUri
+#@+node:insertFiles
+def insertFiles(node, files, journal, log=None, progress=None):
+    """
+    Inserts files concurrently, and sets their uri
+    
+    The number of inserts in flight doubles with each round of inserts
+    which succeed, until one fails. From then on it is halved when an
+    insert fails, and grows by one for each round which succeeds.
+    
+    Arguments:
+        - node - the FCPNode to insert with
+        - files - objects with attributes path, data, mimetype and hash
+        - journal - the CommitJournal which records the uris
+        - log - a function called with messages about failures
+        - progress - a function called with the numbers of files inserted
+          and of all files, after each insert
+    
+    Raises IOError when a file fails to insert more than maxCommitRetries
+    times, after the inserts still in flight completed, so that the uris
+    of those which succeeded get into the journal.
+    """
+    jobsWaiting = collections.deque(files)
+    nTotal = len(jobsWaiting)
+    finished = Queue()
+    maxJobs = defaultCommitJobs
+    slowStart = True
+    jobsRunning = 0
+    retries = collections.Counter()
+    error = None
+    while jobsWaiting or jobsRunning:
+        # launch jobs, if available, and if spare slots
+        while error is None and jobsWaiting and jobsRunning < int(maxJobs):
+            f = jobsWaiting.popleft()
+            try:
+                job = node.put("CHK@", data=f.data, mimetype=f.mimetype,
+                               **{"async": True})
+            except Exception as e:
+                error = e
+                jobsWaiting.clear()
+                break
+            job.file = f
+            job.addDoneCallback(finished.put)
+            jobsRunning += 1
+
+        if not jobsRunning:
+            break
+        job = finished.get()
+        jobsRunning -= 1
+        f = job.file
+
+        if isinstance(job.result, Exception):
+            # back off, and try the file again later
+            retries[f.path] += 1
+            if log:
+                log("insertFiles: insert of %s failed: %s" % (f.path, job.result))
+            if retries[f.path] > maxCommitRetries:
+                error = error or IOError(errno.EIO, "Insert of %s failed: %s" % (
+                    f.path, job.result))
+                jobsWaiting.clear()
+                continue
+            maxJobs = max(1, maxJobs / 2)
+            slowStart = False
+            if error is None:
+                jobsWaiting.append(f)
+            continue
+
+        if slowStart:
+            maxJobs = min(maxCommitJobs, maxJobs + 1)
+        else:
+            maxJobs = min(maxCommitJobs, maxJobs + 1.0 / int(maxJobs))
+        f.uri = job.result
+        journal.add(f.hash, f.mimetype, f.uri)
+        if progress:
+            progress(nTotal - len(jobsWaiting) - jobsRunning, nTotal)
+
+    if error is not None:
+        raise error
+
+#@-node:insertFiles
+#@+node:fetchFiles
+def fetchFiles(node, files, store, log=None, maxJobs=maxUpdateJobs):
+    """
+    Fetches files concurrently, with up to maxJobs at once, and returns
+    the files which could not be fetched
+    
+    Arguments:
+        - node - the FCPNode to fetch with
+        - files - objects with attributes path and uri
+        - store - a function called with each file and its data
+        - log - a function called with messages about failures
+    """
+    jobsWaiting = collections.deque(files)
+    finished = Queue()
+    jobsRunning = 0
+    failed = []
+    while jobsWaiting or jobsRunning:
+        while jobsWaiting and jobsRunning < maxJobs:
+            f = jobsWaiting.popleft()
+            job = node.get(f.uri, **{"async": True})
+            job.file = f
+            job.addDoneCallback(finished.put)
+            jobsRunning += 1
+
+        job = finished.get()
+        jobsRunning -= 1
+        if isinstance(job.result, Exception):
+            if log:
+                log("fetchFiles: fetch of %s failed: %s" % (job.file.path, job.result))
+            failed.append(job.file)
+        else:
+            mimetype, data, msg = job.result
+            store(job.file, bytes(data))
+    return failed
+
+#@-node:fetchFiles
 #@+node:timeNow
 def timeNow():
     return int(time.time()) & 0xffffffff
@@ -18,12 +18,16 @@ For FCP documentation, see http://wiki.freenetproject.org/FCPv2
 """
 
 import queue
+import atexit
 import base64
+import collections
+import contextlib
 import mimetypes
 import os
 import pprint
 import random
 import select
+import selectors
 import hashlib
 import socket
 import stat
@@ -38,8 +42,6 @@ import unicodedata
 
 from . import pseudopythonparser
 
-_pollInterval = 0.03
-
 
 class ConnectionRefused(Exception):
     """
@@ -131,6 +133,15 @@ if "FPROXY_PORT" in os.environ:
 pollTimeout = 0.1
 #pollTimeout = 3
 
+# how many bytes to read from the FCP socket at once
+rxBufferSize = 65536
+
+# how many bytes of a file to read and send at once for direct uploads
+uploadChunkSize = 262144
+
+# up to how many bytes of batched messages to coalesce into one send
+txBufferSize = 65536
+
 # list of keywords sent from node to client, which have
 # int values
 intKeys = [
@@ -140,6 +151,26 @@ intKeys = [
 # for the FCP 'ClientHello' handshake
 expectedVersion="2.0"
 
+# replies which older nodes send without the Identifier of the command
+# they answer, mapped to the commands which they can answer
+untaggedReplies = {
+    'Peer': ('ListPeers', 'ListPeer', 'AddPeer', 'ModifyPeer'),
+    'EndListPeers': ('ListPeers',),
+    'PeerRemoved': ('RemovePeer',),
+    'UnknownNodeIdentifier': ('ListPeer', 'ModifyPeer', 'RemovePeer',
+                              'ListPeerNotes', 'ModifyPeerNote'),
+    'PeerNote': ('ListPeerNotes', 'ModifyPeerNote'),
+    'EndListPeerNotes': ('ListPeerNotes',),
+    'UnknownPeerNoteType': ('ModifyPeerNote',),
+    'NodeData': ('GetNode',),
+    'ConfigData': ('GetConfig', 'ModifyConfig'),
+    'TestDDAReply': ('TestDDARequest',),
+    'TestDDAComplete': ('TestDDAResponse',),
+    'EndListPersistentRequests': ('ListPersistentRequests',),
+    }
+untaggedCommands = frozenset(
+    cmd for cmds in untaggedReplies.values() for cmd in cmds)
+
 # logger verbosity levels
 SILENT = 0
 FATAL = 1
@@ -286,6 +317,15 @@ class FCPNode:
         self.logfunc = logfunc
         self.verbosity = kw.get('verbosity', defaultVerbosity)
     
+        # the pending job tickets
+        self.jobs = JobTable() # keyed by request ID
+        self.keepJobs = [] # job ids that should never be removed from self.jobs
+        self._untaggedJobs = [] # jobs of untaggedCommands, in sending order
+    
+        # incremental parser for the messages from the node
+        self._rxParser = FCPMessageParser(getStream=self._rxStream)
+        self._rxMessages = collections.deque()
+    
         # try to connect to node
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         if(None != self.socketTimeout):
@@ -306,13 +346,21 @@ class FCPNode:
         self._hello()
         self.nodeIsAlive = True
     
-        # the pending job tickets
-        self.jobs = {} # keyed by request ID
-        self.keepJobs = [] # job ids that should never be removed from self.jobs
-    
         # queue for incoming client requests
         self.clientReqQueue = queue.Queue()
     
+        # the JobGroup collecting the requests of each thread in batch()
+        self._batches = threading.local()
+    
+        # the manager thread sleeps in a single selector, which wakes
+        # up on node messages as well as on queued client requests
+        self._wakeupRecv, self._wakeupSend = socket.socketpair()
+        self._wakeupRecv.setblocking(False)
+        self._wakeupSend.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeupRecv, selectors.EVENT_READ)
+    
         # launch receiver thread
         self.running = True
         self.shutdownLock = threading.Lock()
@@ -465,6 +513,25 @@ class FCPNode:
     
         self._log(DETAIL, "get: kw=%s" % kw)
     
+        id, opts = self._getOpts(uri, **kw)
+    
+        if 'Filename' in opts:
+            # need to do a TestDDARequest to have a chance of a
+            # successful get to file.
+            self.testDDA(Directory=os.path.dirname(opts['Filename']),
+                         WantWriteDirectory=True)
+    
+        # ---------------------------------
+        # now enqueue the request
+        return self._submitCmd(id, "ClientGet", **opts)
+    
+
+    def _getOpts(self, uri, **kw):
+        """
+        Formats the ClientGet options for the keywords of get()
+    
+        Returns a 2-tuple (id, opts)
+        """
         # ---------------------------------
         # format the request
         opts = {}
@@ -497,10 +564,6 @@ class FCPNode:
             opts['ReturnType'] = "disk"
             #opts['File'] = file
             opts['Filename'] = file
-            # need to do a TestDDARequest to have a chance of a
-            # successful get to file.
-            self.testDDA(Directory=os.path.dirname(file),
-                         WantWriteDirectory=True)
     
         elif kw.get('nodata', False):
             nodata = True
@@ -528,8 +591,27 @@ class FCPNode:
     #        uri = os.path.splitext(uri)[0]
     
         # process uri, including possible namesite lookups
+        opts['URI'] = self._resolveUri(uri)
+    
+        opts['MaxRetries'] = kw.get("maxretries", -1)
+        opts['MaxSize'] = kw.get("maxsize", "1000000000000")
+        opts['PriorityClass'] = int(kw.get("priority", 2))
+        opts['RealTimeFlag'] = toBool(kw.get("realtime", "false"))
+
+        opts['timeout'] = int(kw.pop("timeout", ONE_YEAR))
+    
+        #print "get: opts=%s" % opts
+    
+        return id, opts
+    
+
+    def _resolveUri(self, uri):
+        """
+        Strips 'freenet:' from a uri, and resolves 'domain name' uris
+        through the namesites
+        """
         uri = uri.split("freenet:")[-1]
-        if len(uri) < 5 or (uri[:4] not in ('SSK@', 'KSK@', 'CHK@', 'USK@', 'SVK@')):
+        if len(uri) < 4 or (uri[:4] not in ('SSK@', 'KSK@', 'CHK@', 'USK@', 'SVK@')):
             # we seem to have a 'domain name' uri
             try:
                 domain, rest = uri.split("/", 1)
@@ -545,21 +627,7 @@ class FCPNode:
                 uri = (tgtUri + "/" + rest).replace("//", "/")
             else:
                 uri = tgtUri
-            
-        opts['URI'] = uri
-    
-        opts['MaxRetries'] = kw.get("maxretries", -1)
-        opts['MaxSize'] = kw.get("maxsize", "1000000000000")
-        opts['PriorityClass'] = int(kw.get("priority", 2))
-        opts['RealTimeFlag'] = toBool(kw.get("realtime", "false"))
-
-        opts['timeout'] = int(kw.pop("timeout", ONE_YEAR))
-    
-        #print "get: opts=%s" % opts
-    
-        # ---------------------------------
-        # now enqueue the request
-        return self._submitCmd(id, "ClientGet", **opts)
+        return uri
     
 
     def put(self, uri="CHK@", **kw):
@@ -571,12 +639,18 @@ class FCPNode:
         
         Keywords - you must specify one of the following to choose an insert mode:
             - file - path of file from which to read the key data
-            - data - the raw data of the key as string
+            - data - the raw data of the key as string or bytes, or a binary
+              file object, which is streamed to the node from its current
+              position to its end
             - dir - the directory to insert, for freesite insertion
             - redirect - the target URI to redirect to
 
         Keywords for 'file' mode:
             - name - human-readable target filename - default is taken from URI
+            - direct - default False - if True, send the file contents to the
+              node inline, read and sent in chunks when the request is sent,
+              instead of letting the node read the file. Use this if the node
+              cannot access the file, for a remote node or without DDA
 
         Keywords for 'dir' mode:
             - name - name of the freesite, the 'sitename' in SSK@privkey/sitename'
@@ -625,6 +699,23 @@ class FCPNode:
             self._log(DETAIL, "put => putdir")
             return self.putdir(uri, **kw)
     
+        id, opts = self._putOpts(uri, **kw)
+    
+        if kw.get('Global', False):
+            # listen to the global queue
+            self.listenGlobal()
+    
+        # ---------------------------------
+        # now dispatch the job
+        return self._submitCmd(id, "ClientPut", **opts)
+    
+
+    def _putOpts(self, uri, **kw):
+        """
+        Formats the ClientPut options for the keywords of put()
+    
+        Returns a 2-tuple (id, opts)
+        """
         # ---------------------------------
         # format the request
         opts = {}
@@ -647,30 +738,8 @@ class FCPNode:
         if opts['Global'] == 'true' and opts['Persistence'] == 'connection':
             raise Exception("Global requests must be persistent")
     
-
-        if kw.get('Global', False):
-            # listen to the global queue
-            self.listenGlobal()
-
         # process uri, including possible namesite lookups
-        uri = uri.split("freenet:")[-1]
-        if len(uri) < 4 or (uri[:4] not in ('SSK@', 'KSK@', 'CHK@', 'USK@', 'SVK@')):
-            # we seem to have a 'domain name' uri
-            try:
-                domain, rest = uri.split("/", 1)
-            except:
-                domain = uri
-                rest = ''
-            
-            tgtUri = self.namesiteLookup(domain)
-            if not tgtUri:
-                raise FCPNameLookupFailure(
-                    "Failed to resolve freenet domain '%s'" % domain)
-            if rest:
-                uri = (tgtUri + "/" + rest).replace("//", "/")
-            else:
-                uri = tgtUri
-    
+        uri = self._resolveUri(uri)
         opts['URI'] = uri
         
         # determine a mimetype
@@ -712,7 +781,16 @@ class FCPNode:
                                 self.defaultCompressionCodecsString())
         opts['LocalRequestOnly'] = kw.get('LocalRequestOnly', False)
         
-        if "file" in kw:
+        if "file" in kw and kw.get('direct', False):
+            opts['UploadFrom'] = "direct"
+            opts['Data'] = FileData(kw['file'])
+            if "mimetype" not in kw:
+                opts['Metadata.ContentType'] = guessMimetype(kw['file'])
+            targetFilename = kw.get('name')
+            if targetFilename:
+                opts["TargetFilename"] = targetFilename
+    
+        elif "file" in kw:
             filepath = os.path.abspath(kw['file'])
             opts['UploadFrom'] = "disk"
             opts['Filename'] = filepath
@@ -755,9 +833,7 @@ class FCPNode:
         
         #print "sendEnd=%s" % sendEnd
     
-        # ---------------------------------
-        # now dispatch the job
-        return self._submitCmd(id, "ClientPut", **opts)
+        return id, opts
     
 
     def putdir(self, uri, **kw):
@@ -979,6 +1055,9 @@ class FCPNode:
 
             # insert each file, one at a time
             nTotal = len(manifest)
+    
+            # receives each job as it completes
+            finished = queue.Queue()
         
             # output status messages, and manage concurrent inserts
             while True:
@@ -1004,14 +1083,14 @@ class FCPNode:
                     log(INFO, "putdir: all inserts completed (or failed)")
                     break
         
-                # wait and go round again if concurrent inserts are maxed
-                if nInserting >= maxConcurrent:
-                    time.sleep(_pollInterval)
-                    continue
-        
-                # just go round again if manifest is empty (all remaining are in progress)
-                if len(manifest) == 0:
-                    time.sleep(_pollInterval)
+                # wait for the next insert to finish, then go round
+                # again if concurrent inserts are maxed, or if manifest
+                # is empty (all remaining are in progress)
+                if nInserting >= maxConcurrent or len(manifest) == 0:
+                    try:
+                        finished.get(True, 10)
+                    except queue.Empty:
+                        pass
                     continue
         
                 # got >0 waiting jobs and >0 spare slots, so we can submit a new one
@@ -1025,15 +1104,14 @@ class FCPNode:
                 log(INFO, "Launching insert of %s" % relpath)
         
         
-                # gotta suck raw data, since we might be inserting to a remote FCP
-                # service (which means we can't use 'file=' (UploadFrom=pathmae) keyword)
-                raw = open(fullpath, "rb").read()
-        
+                # send the data inline, since we might be inserting to a remote FCP
+                # service (which means we can't use UploadFrom=disk)
                 print("globalMode=%s persistence=%s" % (globalMode, persistence))
         
                 # fire up the insert job asynchronously
                 job = self.put("CHK@",
-                               data=raw,
+                               file=fullpath,
+                               direct=True,
                                mimetype=mimetype,
                                waituntilsent=1,
                                Verbosity=Verbosity,
@@ -1046,6 +1124,7 @@ class FCPNode:
                 jobs.append(job)
                 filerec['job'] = job
                 job.filerec = filerec
+                job.addDoneCallback(finished.put)
         
                 # wait for that job to finish if we are in the slow 'one at a time' mode
                 if not allAtOnce:
@@ -1148,7 +1227,7 @@ class FCPNode:
                         a dict containing the response from node
             - keywords, which are the same as for the FCP message and documented in the wiki: http://wiki.freenetproject.org/FCP2p0ModifyConfig
         """
-        return self._submitCmd("__global", "ModifyConfig", **kw)
+        return self._submitCmd(self._getUniqueId(), "ModifyConfig", **kw)
     
 
     def getconfig(self, **kw):
@@ -1171,7 +1250,7 @@ class FCPNode:
             - other keywords, which are the same as for the FCP message and documented in the wiki: http://wiki.freenetproject.org/FCP2p0GetConfig
         """
         
-        return self._submitCmd("__global", "GetConfig", **kw)
+        return self._submitCmd(self._getUniqueId(), "GetConfig", **kw)
     
 
     def invertprivate(self, privatekey):
@@ -1222,7 +1301,9 @@ class FCPNode:
         
         Keywords - you must specify one of the following:
             - file - path of file from which to read the key data
-            - data - the raw data of the key as string
+            - data - the raw data of the key as string or bytes, or a binary
+              file object, which is streamed to the node from its current
+              position to its end
     
         Keywords - optional:
             - mimetype - defaults to text/plain - THIS AFFECTS THE CHK!!
@@ -1249,7 +1330,7 @@ class FCPNode:
             - WithVolatile - default False - if True, returns a peer's volatile info
         """
         
-        return self._submitCmd("__global", "ListPeers", **kw)
+        return self._submitCmd(self._getUniqueId(), "ListPeers", **kw)
     
 
     def listpeernotes(self, **kw):
@@ -1270,7 +1351,7 @@ class FCPNode:
             - NodeIdentifier - one of name, identity or IP:port for the desired peer
         """
         
-        return self._submitCmd("__global", "ListPeerNotes", **kw)
+        return self._submitCmd(self._getUniqueId(), "ListPeerNotes", **kw)
     
 
     def refstats(self, **kw):
@@ -1292,8 +1373,7 @@ class FCPNode:
             - WithPrivate - default False - if True, includes the node's private node reference fields
             - WithVolatile - default False - if True, returns a node's volatile info
         """
-        # The GetNode answer has no id, so we have to use __global.
-        return self._submitCmd("__global", "GetNode", **kw)
+        return self._submitCmd(self._getUniqueId(), "GetNode", **kw)
     
 
     def testDDA(self, **kw):
@@ -1320,7 +1400,7 @@ class FCPNode:
         except KeyError:
             pass # we actually have to test this dir.
         try:
-            requestResult = self._submitCmd("__global", "TestDDARequest", **kw)
+            requestResult = self._submitCmd(self._getUniqueId(), "TestDDARequest", **kw)
         except FCPProtocolError as e:
             self._log(DETAIL, str(e))
             return False
@@ -1354,7 +1434,7 @@ class FCPNode:
             except FileNotFoundError:
                 pass
             
-        responseResult = self._submitCmd("__global", "TestDDAResponse", **kw)
+        responseResult = self._submitCmd(self._getUniqueId(), "TestDDAResponse", **kw)
         if writeFilename is not None:
             try:
                 os.remove(writeFilename)
@@ -1385,7 +1465,7 @@ class FCPNode:
             - kwdict - If neither File nor URL are provided, the fields of a noderef can be passed in the form of a Python dictionary using the kwdict keyword
         """
         
-        return self._submitCmd("__global", "AddPeer", **kw)
+        return self._submitCmd(self._getUniqueId(), "AddPeer", **kw)
     
 
     def listpeer(self, **kw):
@@ -1406,7 +1486,7 @@ class FCPNode:
             - NodeIdentifier - one of name (except for opennet peers), identity or IP:port for the desired peer
         """
         
-        return self._submitCmd("__global", "ListPeer", **kw)
+        return self._submitCmd(self._getUniqueId(), "ListPeer", **kw)
     
 
     def modifypeer(self, **kw):
@@ -1429,7 +1509,7 @@ class FCPNode:
             - NodeIdentifier - one of name, identity or IP:port for the desired peer
         """
         
-        return self._submitCmd("__global", "ModifyPeer", **kw)
+        return self._submitCmd(self._getUniqueId(), "ModifyPeer", **kw)
     
 
     def modifypeernote(self, **kw):
@@ -1452,7 +1532,7 @@ class FCPNode:
             - PeerNoteType - code number of peer note type: currently only private peer note is supported by the node with code number 1 
         """
         
-        return self._submitCmd("__global", "ModifyPeerNote", **kw)
+        return self._submitCmd(self._getUniqueId(), "ModifyPeerNote", **kw)
     
 
     def removepeer(self, **kw):
@@ -1473,7 +1553,7 @@ class FCPNode:
             - NodeIdentifier - one of name, identity or IP:port for the desired peer
         """
         
-        return self._submitCmd("__global", "RemovePeer", **kw)
+        return self._submitCmd(self._getUniqueId(), "RemovePeer", **kw)
     
 
     # methods for namesites
@@ -1768,21 +1848,157 @@ class FCPNode:
         """
         Returns a list of persistent jobs, excluding global jobs
         """
-        return [j for j in list(self.jobs.values()) if j.isPersistent and not j.isGlobal]
+        return self.jobs.ofKind('persistent')
     
 
     def getGlobalJobs(self):
         """
         Returns a list of global jobs
         """
-        return [j for j in list(self.jobs.values()) if j.isGlobal]
+        return self.jobs.ofKind('global')
     
 
     def getTransientJobs(self):
         """
         Returns a list of non-persistent, non-global jobs
         """
-        return [j for j in list(self.jobs.values()) if not j.isPersistent]
+        return self.jobs.ofKind('transient')
+    
+
+    def getJobsWithPrefix(self, prefix):
+        """
+        Returns a list of the jobs whose ids start with the given
+        '|'-separated parts, for example 'freesitemgr|mysite' for
+        'freesitemgr|mysite|index.html'
+        """
+        return self.jobs.withPrefix(prefix)
+    
+
+    def getPendingJobs(self):
+        """
+        Returns a list of the jobs which are not yet complete
+        """
+        return self.jobs.pending()
+    
+
+    def getCompleteJobs(self):
+        """
+        Returns a list of the complete jobs which are still kept
+        """
+        return self.jobs.complete()
+    
+
+    def asCompleted(self, jobs, timeout=None):
+        """
+        Yields the given jobs in the order in which they complete
+    
+        Arguments:
+            - jobs - a sequence of JobTicket objects
+            - timeout - seconds to wait for all jobs, default no limit
+    
+        Raises FCPNodeTimeout if the jobs are not all complete when the
+        timeout has passed.
+        """
+        jobs = list(jobs)
+        finished = queue.Queue()
+        for job in jobs:
+            job.addDoneCallback(finished.put)
+    
+        if timeout is not None:
+            deadline = time.time() + timeout
+        for n in range(len(jobs)):
+            if timeout is None:
+                yield finished.get()
+                continue
+            try:
+                yield finished.get(True, max(0, deadline - time.time()))
+            except queue.Empty:
+                raise FCPNodeTimeout(
+                    header="%d of %d jobs did not complete in time" % (
+                        len(jobs) - n, len(jobs)))
+    
+
+    def waitAny(self, jobs, timeout=None):
+        """
+        Blocks until at least one of the given jobs is complete
+    
+        Returns a 2-tuple of lists (done, pending) of the jobs. done is
+        empty if the timeout passed before any job completed.
+        """
+        return self._waitJobs(jobs, timeout, 1)
+    
+
+    def waitAll(self, jobs, timeout=None):
+        """
+        Blocks until all given jobs are complete
+    
+        Returns a 2-tuple of lists (done, pending) of the jobs. pending
+        is non-empty only if the timeout passed first.
+        """
+        jobs = list(jobs)
+        return self._waitJobs(jobs, timeout, len(jobs))
+    
+
+    def _waitJobs(self, jobs, timeout, count):
+        """
+        Waits until count of the jobs are complete, or timeout passed
+        """
+        jobs = list(jobs)
+        try:
+            completed = self.asCompleted(jobs, timeout)
+            for n in range(min(count, len(jobs))):
+                next(completed)
+        except FCPNodeTimeout:
+            pass
+        done, pending = [], []
+        for job in jobs:
+            if job.isComplete():
+                done.append(job)
+            else:
+                pending.append(job)
+        return done, pending
+    
+
+    def batch(self, callback=None):
+        """
+        Returns a JobGroup, which collects the requests submitted in a
+        with-block by this thread, and sends them all at once
+    
+        Keywords:
+            - callback - if given, called as callback(group, job) by the
+              manager thread each time one of the jobs completes
+    
+        All requests in the block must be async. They are registered
+        together and sent with as few writes as possible when the block
+        ends, and are not sent at all if it raises:
+    
+            with node.batch() as group:
+                for path in paths:
+                    node.put("CHK@", file=path, direct=True, **{"async": True})
+            done, failed, total = group.progress()
+            results = group.wait()
+        """
+        return JobGroup(self, callback)
+    
+
+    def submitMany(self, cmds, callback=None):
+        """
+        Submits a sequence of raw FCP commands in one batch
+    
+        Arguments:
+            - cmds - a sequence of (cmd, kw) tuples, as for _submitCmd,
+              a missing Identifier is generated
+            - callback - as for batch()
+    
+        Returns the JobGroup of the submitted jobs
+        """
+        with self.batch(callback) as group:
+            for cmd, kw in cmds:
+                kw = dict(kw)
+                kw['async'] = True
+                id = kw.get('Identifier', None) or self._getUniqueId()
+                self._submitCmd(id, cmd, **kw)
+        return group
     
 
     def refreshPersistentRequests(self, **kw):
@@ -1797,14 +2013,11 @@ class FCPNode:
         """
         self._log(DETAIL, "listPersistentRequests")
     
-        if '__global' in self.jobs:
-            raise Exception("An existing non-identifier job is currently pending")
-    
         # ---------------------------------
         # format the request
         opts = {}
     
-        id = '__global'
+        id = self._getUniqueId()
         opts['Identifier'] = id
     
         opts['async'] = kw.pop('async', False)
@@ -1893,8 +2106,8 @@ class FCPNode:
     
         self.running = False
     
-        # give the manager thread a chance to bail out
-        time.sleep(pollTimeout * 3)
+        # make the manager thread bail out right away
+        self._wakeup()
     
         # wait for mgr thread to quit
         log(DETAIL, "shutdown: waiting for manager thread to terminate")
@@ -1924,7 +2137,7 @@ class FCPNode:
             - waituntilsent - whether to block until this command has been sent
               to the node, default False
         """
-        return self._submitCmd("__global", "Shutdown", **kw)
+        return self._submitCmd(self._getUniqueId(), "Shutdown", **kw)
 
         
     # methods for manager thread
@@ -1943,33 +2156,41 @@ class FCPNode:
     
                 log(NOISY, "_mgrThread: Top of manager thread")
     
-                # try for incoming messages from node
-                log(NOISY, "_mgrThread: Testing for incoming message")
-                if self._msgIncoming():
-                    log(DEBUG, "_mgrThread: Retrieving incoming message")
-                    msg = self._rxMsg()
+                # sleep until the node sends something or a client
+                # queues a request. The timeout only serves to notice
+                # shutdowns which did not wake us up.
+                for key, events in self._selector.select(pollTimeout):
+                    if key.fileobj is self._wakeupRecv:
+                        log(NOISY, "_mgrThread: Woken up by client")
+                        self._drainWakeup()
+                    else:
+                        log(DEBUG, "_mgrThread: Retrieving incoming messages")
+                        self._rxChunk()
+        
+                # dispatch all complete messages from the node
+                while self._rxMessages:
+                    msg = self._rxMessages.popleft()
                     log(DEBUG, "_mgrThread: Got incoming message, dispatching")
                     self._on_rxMsg(msg)
                     log(DEBUG, "_mgrThread: back from on_rxMsg")
-                else:
-                    log(NOISY, "_mgrThread: No incoming message from node")
         
-                # try for incoming requests from clients
-                log(NOISY, "_mgrThread: Testing for client req")
-                try:
-                    req = self.clientReqQueue.get(True, pollTimeout)
+                # dispatch all pending requests from clients
+                while True:
+                    try:
+                        req = self.clientReqQueue.get_nowait()
+                    except queue.Empty:
+                        log(NOISY, "_mgrThread: No incoming client req")
+                        break
                     log(DEBUG, "_mgrThread: Got client req, dispatching")
                     self._on_clientReq(req)
                     log(DEBUG, "_mgrThread: Back from on_clientReq")
-                except queue.Empty:
-                    log(NOISY, "_mgrThread: No incoming client req")
-                    pass
     
             self._log(DETAIL, "_mgrThread: Manager thread terminated normally")
     
         except Exception as e:
             traceback.print_exc()
             self._log(CRITICAL, "_mgrThread: manager thread crashed")
+            self.nodeIsAlive = False
     
             # send the exception to all waiting jobs
             for id, job in list(self.jobs.items()):
@@ -1984,9 +2205,36 @@ class FCPNode:
                     log(NOISY, "_mgrThread: No incoming client req")
                     break
     
+        self._selector.close()
+        self._wakeupRecv.close()
+        self._wakeupSend.close()
         self.shutdownLock.release()
     
 
+    def _wakeup(self):
+        """
+        Wakes up the manager thread, e.g. because a client request
+        was queued
+        """
+        try:
+            self._wakeupSend.send(b"\0")
+        except OSError:
+            # either the wakeup buffer is full, so the manager thread
+            # will wake up anyway, or the manager thread is gone
+            pass
+    
+
+    def _drainWakeup(self):
+        """
+        Discards all pending wakeup bytes
+        """
+        try:
+            while self._wakeupRecv.recv(4096):
+                pass
+        except OSError:
+            pass
+    
+
     def _msgIncoming(self):
         """
         Returns True if a message is coming in from the node
@@ -2073,7 +2321,20 @@ class FCPNode:
         if cmd == 'ClientPut' and 'Metadata.ContentType' in kw:
             job.mimetype = kw['Metadata.ContentType']
     
+        group = getattr(self._batches, 'group', None)
+        if group is not None:
+            # sent when the batch ends, so nothing can wait for it now
+            if _async:
+                group._add(job)
+                return job
+            elif cmd in ['WatchGlobal', "RemovePersistentRequest"]:
+                group._add(job)
+                return
+            raise FCPException(header="Only async requests can be batched",
+                               CodeDescription="%s:%s" % (cmd, id))
+    
         self.clientReqQueue.put(job)
+        self._wakeup()
     
         # log(DEBUG, "_submitCmd: id='%s' cmd='%s' kw=%s" % (id, cmd, # truncate long commands
         #                                                    str([(k,str(kw.get(k, ""))[:128])
@@ -2098,22 +2359,128 @@ class FCPNode:
         the fcp port, and also registers it so the manager thread
         can action responses from the fcp port.
         """
+        if isinstance(job, JobGroup):
+            return self._on_clientReqGroup(job)
+    
         id = job.id
         cmd = job.cmd
         kw = job.kw
     
         # register the req
-        if cmd != 'WatchGlobal':
-            self.jobs[id] = job
-            self._log(DEBUG, "_on_clientReq: cmd=%s id=%s lock=%s" % (
-                cmd, repr(id), job.lock))
+        self._registerJob(job)
+        self._log(DEBUG, "_on_clientReq: cmd=%s id=%s" % (
+            cmd, repr(id)))
         
         # now can send, since we're the only one who will
         self._txMsg(cmd, **kw)
     
         job.timeQueued = int(time.time())
     
-        job.reqSentLock.release()
+        job.reqSentEvent.set()
+        self._checkUpload(job)
+    
+
+    def _checkUpload(self, job):
+        """
+        Fails a job whose FileData payload could not be sent as it was
+        announced, and asks the node to drop it
+        """
+        data = job.kw.get('Data')
+        if not isinstance(data, FileData) or data.error is None:
+            return
+        self._txMsg("RemovePersistentRequest",
+                    Global=job.isGlobal and "true" or "false",
+                    Identifier=job.id)
+        self._failUpload(job, data.error)
+    
+
+    def _failUpload(self, job, error):
+        """
+        Fails a job whose payload could not be sent, once the node has been
+        asked to drop it
+        """
+        self._log(ERROR, "_checkUpload: %s: %s" % (job.id, error))
+        self.jobs.pop(job.id, None)
+        job.callback('failed', str(error))
+        job._putResult(error)
+    
+
+    def _registerJob(self, job):
+        """
+        Registers a job which is about to be sent, so the replies of the
+        node find it
+        """
+        if job.cmd != 'WatchGlobal':
+            self.jobs[job.id] = job
+        if job.cmd in untaggedCommands:
+            # the replies might lack the identifier, so they are matched
+            # to the oldest job of a command they can answer
+            self._untaggedJobs.append(job)
+            job.addDoneCallback(self._untaggedJobs.remove)
+    
+
+    def _untaggedJob(self, hdr):
+        """
+        Returns the oldest pending job which a reply without identifier
+        can answer, or None
+        """
+        cmds = untaggedReplies.get(hdr, ())
+        for job in self._untaggedJobs:
+            if job.cmd in cmds:
+                return job
+        return None
+    
+
+    def _ddaJob(self, directory):
+        """
+        Returns the oldest pending TestDDARequest or TestDDAResponse job
+        for directory, or None
+        """
+        directory = directory.rstrip("/")
+        for job in self._untaggedJobs:
+            if job.cmd in ('TestDDARequest', 'TestDDAResponse') \
+            and str(job.kw.get('Directory', '')).rstrip("/") == directory:
+                return job
+        return None
+    
+
+    def _on_clientReqGroup(self, group):
+        """
+        Registers all the jobs of a JobGroup before sending any of
+        them, then sends their messages coalesced into few writes
+        """
+        for job in group.jobs:
+            self._registerJob(job)
+        self._log(DEBUG, "_on_clientReqGroup: %d jobs" % len(group.jobs))
+    
+        buf = bytearray()
+        for job in group.jobs:
+            raw, data, length = self._encodeMsgParts(job.cmd, **job.kw)
+            buf += raw
+            if data is None:
+                pass
+            elif length <= txBufferSize and not hasattr(data, 'read') \
+                    and not isinstance(data, FileData):
+                buf += data
+            else:
+                self.socket.sendall(buf)
+                buf.clear()
+                self._txData(job.cmd, data, length)
+            if len(buf) >= txBufferSize:
+                self.socket.sendall(buf)
+                buf.clear()
+        if buf:
+            self.socket.sendall(buf)
+    
+        now = int(time.time())
+        for job in group.jobs:
+            job.timeQueued = now
+            job.reqSentEvent.set()
+            if job.cmd in ['WatchGlobal', "RemovePersistentRequest"]:
+                # the node does not answer these
+                job._putResult(None)
+            else:
+                self._checkUpload(job)
     
 
     def _on_rxMsg(self, msg):
@@ -2125,16 +2492,28 @@ class FCPNode:
         """
         log = self._log
     
+        hdr = msg['header']
+    
         # find the job this relates to
-        id = msg.get('Identifier', '__global')
-        # FIXME: this is a hack to get TestDDARequest to fail gracefully
-        # FIXME: See https://bugs.freenetproject.org/view.php?id=6890
-        if id.startswith('/'):
+        id = msg.get('Identifier', None)
+        job = None
+        if hdr == 'ProtocolError' and isinstance(id, str) and id.startswith('/'):
+            # the node puts the directory of a TestDDA in the identifier
+            # FIXME: See https://bugs.freenetproject.org/view.php?id=6890
+            job = self._ddaJob(id)
+        elif hdr == 'ProtocolError' and id is None and self._untaggedJobs:
+            # only the job of an untagged command can be meant, and the
+            # node answers in order, so it is the oldest one
+            job = self._untaggedJobs[0]
+        elif id is None or (isinstance(id, str) and id.startswith('/')):
+            job = self._untaggedJob(hdr)
+        if job is not None:
+            id = job.id
+        elif id is None or (isinstance(id, str) and id.startswith('/')):
             id = '__global'
     
-        hdr = msg['header']
-    
-        job = self.jobs.get(id, None)
+        if job is None:
+            job = self.jobs.get(id, None)
         if not job:
             # we have a global job and/or persistent job from last connection
             log(DETAIL, "***** Got %s from unknown job id %s" % (hdr, repr(id)))
@@ -2539,6 +2918,14 @@ class FCPNode:
                          ExpectedVersion=expectedVersion)
         
         resp = self._rxMsg()
+        self._parseNodeHello(resp)
+        return resp
+    
+
+    def _parseNodeHello(self, resp):
+        """
+        Takes over the node properties from its NodeHello message
+        """
         if("Version" in resp):
           self.nodeVersion = resp[ "Version" ];
         if("FCPVersion" in resp):
@@ -2582,9 +2969,6 @@ class FCPNode:
                 resp [ "CompressionCodecs" ])
         except (KeyError, IndexError, ValueError):
             pass
-
-            
-        return resp
     
 
     def _parseCompressionCodecs(self, CompressionCodecsString):
@@ -2629,23 +3013,68 @@ class FCPNode:
             - msgType - one of the FCP message headers, such as 'ClientHello'
             - args - zero or more (keyword, value) tuples
         Keywords:
-            - rawcmd - if given, this is the raw buffer to send
+            - rawcmd - if given, this is the raw buffer to send, up to
+              and including its 'Data' line if Data is given too
+            - Data - the payload, as bytes-like object, as FileData, or as
+              binary file object which is sent from its current position
+              to its end
             - other keywords depend on the value of msgType
         """
+        raw, data, length = self._encodeMsgParts(msgType, **kw)
+        self.socket.sendall(raw)
+        if data is not None:
+            self._txData(msgType, data, length)
+    
+
+    def _txData(self, msgType, data, length):
+        """
+        Sends the payload of a message, after its 'Data' line
+        """
+        if isinstance(data, FileData):
+            for chunk in data.chunks():
+                self.socket.sendall(chunk)
+        elif hasattr(data, 'read'):
+            # uses os.sendfile where possible, and else sends the
+            # file in chunks, so the payload never sits in memory
+            offset = data.tell()
+            sent = self.socket.sendfile(data, offset, length)
+            if sent != length:
+                self.nodeIsAlive = False
+                raise FCPNodeFailure("%s: sent only %d of %d bytes of data" % (
+                    msgType, sent, length))
+        else:
+            with memoryview(data) as view:
+                self.socket.sendall(view)
+    
+
+    def _encodeMsgParts(self, msgType, **kw):
+        """
+        Returns the message to the node as 3-tuple (raw, data, length)
+        of the raw bytes up to and including the 'Data' line, the
+        payload and its length, with data None if there is no payload
+        """
         log = self._log
     
-        # just send the raw command, if given    
+        # just send the raw command, if given, and its payload, if any
         rawcmd = kw.get('rawcmd', None)
         if rawcmd:
-            self.socket.sendall(rawcmd)
             log(DETAIL, "CLIENT: %s" % rawcmd)
-            return
+            if isinstance(rawcmd, str):
+                rawcmd = rawcmd.encode('utf-8')
+            data = kw.get('Data', None)
+            if data is None:
+                return rawcmd, None, 0
+            return rawcmd, data, dataLength(data)
     
         if "Data" in kw:
             data = kw.pop("Data")
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            length = dataLength(data)
             sendEndMessage = False
         else:
             data = None
+            length = 0
             sendEndMessage = True
     
         items = [msgType.encode('utf-8') + b"\n"]
@@ -2658,12 +3087,11 @@ class FCPNode:
             items.append(line + b"\n")
             log(DETAIL, "CLIENT: %s" % line)
     
-        if data != None:
-            items.append(("DataLength=%d\n" % len(data)).encode('utf-8'))
-            log(DETAIL, "CLIENT: DataLength=%d" % len(data))
+        if data is not None:
+            items.append(("DataLength=%d\n" % length).encode('utf-8'))
+            log(DETAIL, "CLIENT: DataLength=%d" % length)
             items.append(b"Data\n")
             log(DETAIL, "CLIENT: ...data...")
-            items.append(data)
     
         #print "sendEndMessage=%s" % sendEndMessage
     
@@ -2671,25 +3099,7 @@ class FCPNode:
             items.append(b"EndMessage\n")
             log(DETAIL, "CLIENT: %s" % b"EndMessage")
         
-        # ensure that every item is a byte
-        items = [(i if not isinstance(i, str) else i.encode("utf-8"))
-                 for i in items]
-        
-        try:
-            raw = b"".join(items)
-        except TypeError as e:
-            # at least one item is no bytearray
-            log(ERROR, str(e))
-            for item in items:
-                try:
-                    print(item) # can print strings
-                    log(ERROR, item)
-                except TypeError:
-                    print(item.decode("utf-8")) # to still show those which should have worked
-                    log(ERROR, item.decode("utf-8"))
-            raise
-    
-        self.socket.sendall(raw)
+        return b"".join(items), data, length
     
 
     def _rxMsg(self):
@@ -2698,101 +3108,52 @@ class FCPNode:
         
         The header keyword is included as key 'header'
         """
-        log = self._log
-    
-        log(DETAIL, "NODE: ----------------------------")
-    
-        # shorthand, for reading n bytes
-        def read(n):
-            if n > 1:
-                log(DEBUG, "read: want %d bytes" % n)
-            chunks = bytearray()
-            remaining = n
-            while remaining > 0:
-                chunk = self.socket.recv(remaining)
-                chunklen = len(chunk)
-                if chunk:
-                    chunks += chunk
-                else:
-                    self.nodeIsAlive = False
-                    raise FCPNodeFailure("FCP socket closed by node")
-                remaining -= chunklen
-                if remaining > 0:
-                    if n > 1:
-                        log(DEBUG,
-                            "wanted %s, got %s still need %s bytes" % (n, chunklen, remaining)
-                            )
-                    pass
-            return chunks
-    
-        # read a line
-        def readln():
-            buf = bytearray()
-            while True:
-                c = read(1)
-                buf += c
-                if c == b'\n':
-                    break
-            log(DETAIL, "NODE: " + buf[:-1].decode('utf-8'))
-            return buf
+        while not self._rxMessages:
+            self._rxChunk()
+        return self._rxMessages.popleft()
     
-        items = {}
-    
-        # read the header line
-        # It is not binary; decode.
-        while True:
-            line = readln().decode('utf-8').strip()
-            if line:
-                items['header'] = line
-                break
-    
-        # read the body
-        while True:
-            line = readln().strip()
-            if line in [b'End', b'EndMessage']:
-                break
-    
-            if line == b'Data':
-                # read the following data
-                
-                # try to locate job
-                id = items['Identifier']
-                job = self.jobs[id]
-                if job.stream:
-                    # loop to transfer from socket to stream
-                    remaining = items['DataLength']
-                    stream = job.stream
-                    while remaining > 0:
-                        buf = self.socket.recv(remaining)
-                        stream.write(buf)
-                        stream.flush()
-                        remaining -= len(buf)
-                    items['Data'] = None
-                else:
-                    buf = read(items['DataLength'])
-                    items['Data'] = buf
-                log(DETAIL, "NODE: ...<%d bytes of data>" % len(buf))
-                break
-            else:
-                # it's a normal 'key=val' pair
-                # Pairs are not binary; decode as UTF-8.
-                try:
-                    line = line.decode('utf-8')
-                    k, v = line.split("=", 1)
-                except:
-                    log(ERROR, "_rxMsg: barfed splitting '%s'" % repr(line))
-                    raise
+
+    def _rxChunk(self):
+        """
+        Reads what the node has sent so far, and queues all messages
+        which are complete now on self._rxMessages
+        """
+        messages = self._rxParser.receive(self.socket)
+        if messages is None:
+            self.nodeIsAlive = False
+            raise FCPNodeFailure("FCP socket closed by node")
     
-                # attempt int conversion
-                try:
-                    v = int(v)
-                except:
-                    pass
+        for msg in messages:
+            if self.verbosity >= DETAIL:
+                self._logRxMsg(msg)
+            self._rxMessages.append(msg)
     
-                items[k] = v
+
+    def _rxStream(self, msg):
+        """
+        Returns the stream to which the data of the given message should
+        be written, or None if the data should be kept in the message
+        """
+        job = self.jobs.get(msg.get('Identifier'), None)
+        if job:
+            return job.stream
+        return None
     
-        # all done
-        return items
+
+    def _logRxMsg(self, msg):
+        """
+        Logs a message received from the node
+        """
+        log = self._log
+        log(DETAIL, "NODE: ----------------------------")
+        log(DETAIL, "NODE: %s" % msg['header'])
+        for k, v in msg.items():
+            if k == 'header':
+                continue
+            if k == 'Data':
+                log(DETAIL, "NODE: ...<%d bytes of data>" % msg['DataLength'])
+                continue
+            log(DETAIL, "NODE: %s=%s" % (k, v))
     
 
     def _log(self, level, msg):
@@ -2816,6 +3177,196 @@ class FCPNode:
     
 
 
+#: the first characters of field values which int() might accept
+_intStartChars = frozenset("0123456789+- ")
+
+
+class FCPMessageParser:
+    """
+    Incremental parser for the FCP messages sent by a node
+
+    Bytes are fed in as they arrive, in chunks of any size, and each
+    call to feed() returns the messages which got completed by that
+    chunk, as dicts with the header keyword as key 'header'.
+
+    The payload of a message with Data is read into a buffer of
+    DataLength bytes which is allocated once, or written a chunk at a
+    time to the stream returned by getStream(msg), if that returns one.
+    receive() reads from a socket with recv_into, so the payload goes
+    from the socket into that buffer or stream without further copies.
+
+    >>> p = FCPMessageParser()
+    >>> p.feed(b"NodeHello\\nFCPVersion=2.0\\nEnd")
+    []
+    >>> p.feed(b"Message\\n")
+    [{'header': 'NodeHello', 'FCPVersion': '2.0'}]
+    >>> msgs = p.feed(b"AllData\\nIdentifier=x\\nDataLength=3\\nData\\nabcSSKKeypair\\nEnd")
+    >>> msgs
+    [{'header': 'AllData', 'Identifier': 'x', 'DataLength': 3, 'Data': bytearray(b'abc')}]
+    >>> p.feed(b"Message\\n")[0]['header']
+    'SSKKeypair'
+    >>> import io
+    >>> stream = io.BytesIO()
+    >>> p = FCPMessageParser(getStream=lambda msg: stream)
+    >>> [p.feed(bytes([c])) for c in b"AllData\\nDataLength=2\\nData\\nab"][-1]
+    [{'header': 'AllData', 'DataLength': 2, 'Data': None}]
+    >>> stream.getvalue()
+    b'ab'
+    """
+
+    def __init__(self, getStream=None):
+        self.getStream = getStream
+        self.buf = bytearray()
+        self.pos = 0
+        self.msg = None
+    
+        # state of the payload currently being read
+        self.inData = False
+        self.data = None
+        self.dataStream = None
+        self.dataFilled = 0
+        self.dataLength = 0
+    
+        # reused receive buffer for receive()
+        self.rxBuf = None
+    
+
+    def receive(self, sock, size=rxBufferSize):
+        """
+        Receives up to size bytes from a socket and parses them like
+        feed(), returns the list of completed messages, or None if the
+        connection was closed
+        
+        While a payload is being read and no other bytes are buffered,
+        it is received straight into the payload buffer, or into a
+        reused buffer from which it is written to the payload stream.
+        """
+        if self.rxBuf is None or len(self.rxBuf) < size:
+            self.rxBuf = bytearray(size)
+        if self.inData and self.pos == len(self.buf):
+            size = min(size, self.dataLength - self.dataFilled)
+            if self.dataStream is None:
+                with memoryview(self.data) as view:
+                    with view[self.dataFilled:self.dataFilled + size] as part:
+                        n = sock.recv_into(part)
+            else:
+                with memoryview(self.rxBuf) as view:
+                    n = sock.recv_into(view, size)
+                    if n:
+                        with view[:n] as part:
+                            self.dataStream.write(part)
+                        self.dataStream.flush()
+            if not n:
+                return None
+            self.dataFilled += n
+            return self.feed(b"")
+    
+        with memoryview(self.rxBuf) as view:
+            n = sock.recv_into(view, size)
+            if not n:
+                return None
+            with view[:n] as part:
+                return self.feed(part)
+    
+
+    def feed(self, chunk):
+        """
+        Parses the next chunk of bytes, returns a list of the messages
+        completed by it
+        """
+        buf = self.buf
+        buf += chunk
+        messages = []
+        while True:
+            if self.inData:
+                if not self._readData():
+                    break
+                self.msg['Data'] = self.data
+                messages.append(self.msg)
+                self.msg = None
+                self.data = None
+                self.dataStream = None
+                self.inData = False
+                continue
+    
+            end = buf.find(b"\n", self.pos)
+            if end < 0:
+                break
+            line = buf[self.pos:end].strip()
+            self.pos = end + 1
+    
+            if self.msg is None:
+                # skip empty lines before the header
+                if line:
+                    self.msg = {'header': line.decode('utf-8')}
+                continue
+    
+            if line == b'EndMessage' or line == b'End':
+                messages.append(self.msg)
+                self.msg = None
+            elif line == b'Data':
+                self._startData()
+            else:
+                # it's a normal 'key=val' pair
+                try:
+                    k, v = line.decode('utf-8').split("=", 1)
+                except ValueError:
+                    raise ValueError("FCP message %s has a malformed line %r" % (
+                        self.msg['header'], bytes(line)))
+                # attempt int conversion
+                if v[:1] in _intStartChars:
+                    try:
+                        v = int(v)
+                    except ValueError:
+                        pass
+                self.msg[k] = v
+    
+        # drop the consumed bytes
+        if self.pos:
+            del buf[:self.pos]
+            self.pos = 0
+        return messages
+    
+
+    def _startData(self):
+        """
+        Prepares for reading the payload of the current message
+        """
+        try:
+            self.dataLength = int(self.msg['DataLength'])
+        except (KeyError, ValueError):
+            raise ValueError("FCP message %s has Data without a DataLength" % (
+                self.msg['header']))
+        self.dataFilled = 0
+        self.dataStream = None
+        if self.getStream is not None:
+            self.dataStream = self.getStream(self.msg)
+        if self.dataStream is None:
+            self.data = bytearray(self.dataLength)
+        self.inData = True
+    
+
+    def _readData(self):
+        """
+        Consumes payload bytes from the buffer, returns True once the
+        payload is complete
+        """
+        n = min(self.dataLength - self.dataFilled, len(self.buf) - self.pos)
+        if n:
+            with memoryview(self.buf) as view:
+                part = view[self.pos:self.pos + n]
+                if self.dataStream is not None:
+                    self.dataStream.write(part)
+                    self.dataStream.flush()
+                else:
+                    self.data[self.dataFilled:self.dataFilled + n] = part
+                part.release()
+            self.pos += n
+            self.dataFilled += n
+        return self.dataFilled == self.dataLength
+    
+
+
 class JobTicket:
     """
     A JobTicket is an object returned to clients making
@@ -2878,21 +3429,23 @@ class JobTicket:
         self.timeQueued = int(time.time())
         self.timeSent = None
     
-        self.lock = threading.Lock()
-        #print "** JobTicket.__init__: lock=%s" % self.lock
-    
-        self.lock.acquire()
         self.result = None
     
-        self.reqSentLock = threading.Lock()
-        self.reqSentLock.acquire()
+        # set by the manager thread when the job completes, and when
+        # its request has been sent to the node
+        self.completeEvent = threading.Event()
+        self.reqSentEvent = threading.Event()
+    
+        # functions to call on completion, see addDoneCallback
+        self.doneCallbacks = []
+        self.doneCallbacksLock = threading.Lock()
     
 
     def isComplete(self):
         """
         Returns True if the job has been completed
         """
-        return self.result != None
+        return self.completeEvent.is_set()
     
 
     def wait(self, timeout=None):
@@ -2906,29 +3459,13 @@ class JobTicket:
         # wait forever for job to complete, if no timeout given
         if timeout is None:
             log(DEBUG, "wait:%s:%s: no timeout" % (self.cmd, self.id))
-            while not self.lock.acquire(False):
-                time.sleep(_pollInterval)
-            self.lock.release()
+            self.completeEvent.wait()
             return self.getResult()
     
-        # wait for timeout
-        then = int(time.time())
+        deadline = time.time() + timeout
     
         # ensure command has been sent, wait if not
-        while not self.reqSentLock.acquire(False):
-    
-            # how long have we waited?
-            elapsed = int(time.time()) - then
-    
-            # got any time left?
-            if elapsed < timeout:
-                # yep, patience remains
-                time.sleep(_pollInterval)
-                log(DEBUG, "wait:%s:%s: job not dispatched, timeout in %ss" % \
-                     (self.cmd, self.id, timeout-elapsed))
-                continue
-    
-            # no - timed out waiting for job to be sent to node
+        if not self.reqSentEvent.wait(timeout):
             log(DEBUG, "wait:%s:%s: timeout on send command" % (self.cmd, self.id))
             raise FCPSendTimeout(
                     header="Command '%s' took too long to be sent to node" % self.cmd
@@ -2937,23 +3474,7 @@ class JobTicket:
         log(DEBUG, "wait:%s:%s: job now dispatched" % (self.cmd, self.id))
     
         # wait now for node response
-        while not self.lock.acquire(False):
-            # how long have we waited?
-            elapsed = int(time.time()) - then
-    
-            # got any time left?
-            if elapsed < timeout:
-                # yep, patience remains
-                time.sleep(_pollInterval)
-    
-                #print "** lock=%s" % self.lock
-    
-                if timeout < ONE_YEAR:
-                    log(DEBUG, "wait:%s:%s: awaiting node response, timeout in %ss" % \
-                         (self.cmd, self.id, timeout-elapsed))
-                continue
-    
-            # no - timed out waiting for node to respond
+        if not self.completeEvent.wait(max(0, deadline - time.time())):
             log(DEBUG, "wait:%s:%s: timeout on node response" % (self.cmd, self.id))
             raise FCPNodeTimeout(
                     header="Command '%s' took too long for node response" % self.cmd
@@ -2961,9 +3482,6 @@ class JobTicket:
     
         log(DEBUG, "wait:%s:%s: job complete" % (self.cmd, self.id))
     
-        # if we get here, we got the lock, command completed
-        self.lock.release()
-    
         # and we have a result
         return self.getResult()
     
@@ -2972,7 +3490,21 @@ class JobTicket:
         """
         Waits till the request has been sent to node
         """
-        self.reqSentLock.acquire()
+        self.reqSentEvent.wait()
+    
+
+    def addDoneCallback(self, fn):
+        """
+        Arranges for fn(job) to be called when the job completes
+    
+        fn is called by the manager thread, so it should return
+        quickly. If the job is already complete, fn is called right away.
+        """
+        with self.doneCallbacksLock:
+            if not self.completeEvent.is_set():
+                self.doneCallbacks.append(fn)
+                return
+        fn(self)
     
 
     def getResult(self):
@@ -3038,14 +3570,17 @@ class JobTicket:
             except:
                 pass
     
-        #print "** job: lock=%s" % self.lock
-    
-        try:
-            self.lock.release()
-        except:
-            pass
+        with self.doneCallbacksLock:
+            self.completeEvent.set()
+            callbacks = self.doneCallbacks
+            self.doneCallbacks = []
+        self.node.jobs.jobCompleted(self)
     
-        #print "** job: lock released"
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
     
 
     def __repr__(self):
@@ -3069,6 +3604,577 @@ class JobTicket:
 
 
 
+class JobTable(dict):
+    """
+    The jobs of a node keyed by request ID, with indexes to find them
+    by persistence, by id prefix and by completion without scanning all
+    jobs
+    
+    The id prefixes of a job are the leading parts of its id, split at
+    '|', so the job 'freesitemgr|mysite|index.html' is found under
+    'freesitemgr' and under 'freesitemgr|mysite'.
+    
+    >>> class Job:
+    ...     def __init__(self, id, isGlobal=False, isPersistent=False):
+    ...         self.id, self.isGlobal, self.isPersistent = id, isGlobal, isPersistent
+    ...         self.done = False
+    ...     def isComplete(self):
+    ...         return self.done
+    >>> jobs = JobTable()
+    >>> for id in ('freesitemgr|a|x', 'freesitemgr|a|y', 'freesitemgr|b|x'):
+    ...     jobs[id] = Job(id, isGlobal=True, isPersistent=True)
+    >>> jobs['id1'] = Job('id1')
+    >>> [job.id for job in jobs.withPrefix('freesitemgr|a')]
+    ['freesitemgr|a|x', 'freesitemgr|a|y']
+    >>> len(jobs.ofKind('global')), len(jobs.ofKind('transient'))
+    (3, 1)
+    >>> jobs['freesitemgr|a|x'].done = True
+    >>> jobs.jobCompleted(jobs['freesitemgr|a|x'])
+    >>> [job.id for job in jobs.complete()]
+    ['freesitemgr|a|x']
+    >>> del jobs['freesitemgr|a|y']
+    >>> [job.id for job in jobs.withPrefix('freesitemgr')]
+    ['freesitemgr|a|x', 'freesitemgr|b|x']
+    >>> [job.id for job in jobs.pending()]
+    ['freesitemgr|b|x', 'id1']
+    """
+    kinds = ('global', 'persistent', 'transient')
+    
+    def __init__(self):
+        dict.__init__(self)
+        self.lock = threading.RLock()
+        self.byKind = dict((kind, {}) for kind in self.kinds)
+        self.byPrefix = {}
+        self.byCompletion = {True: {}, False: {}}
+    
+
+    def __setitem__(self, id, job):
+        with self.lock:
+            if id in self:
+                self._unindex(id, dict.__getitem__(self, id))
+            dict.__setitem__(self, id, job)
+            self._index(id, job)
+    
+
+    def __delitem__(self, id):
+        with self.lock:
+            self._unindex(id, dict.pop(self, id))
+    
+
+    def pop(self, id, *default):
+        with self.lock:
+            if id in self:
+                job = dict.pop(self, id)
+                self._unindex(id, job)
+                return job
+            if default:
+                return default[0]
+            raise KeyError(id)
+    
+
+    def clear(self):
+        with self.lock:
+            dict.clear(self)
+            for index in [self.byPrefix] + list(self.byKind.values()) \
+                    + list(self.byCompletion.values()):
+                index.clear()
+    
+
+    def jobCompleted(self, job):
+        """
+        Moves the job to the complete ones, called when it completes
+        """
+        with self.lock:
+            if dict.get(self, job.id) is job:
+                self.byCompletion[False].pop(job.id, None)
+                self.byCompletion[True][job.id] = job
+    
+
+    def ofKind(self, kind):
+        """
+        Returns a list of the jobs of one kind:
+            - global - global jobs
+            - persistent - persistent jobs, excluding global jobs
+            - transient - non-persistent jobs
+        """
+        with self.lock:
+            return list(self.byKind[kind].values())
+    
+
+    def withPrefix(self, prefix):
+        """
+        Returns a list of the jobs whose ids start with prefix and '|'
+        """
+        with self.lock:
+            return list(self.byPrefix.get(prefix, {}).values())
+    
+
+    def pending(self):
+        """
+        Returns a list of the jobs which are not complete
+        """
+        with self.lock:
+            return list(self.byCompletion[False].values())
+    
+
+    def complete(self):
+        """
+        Returns a list of the complete jobs
+        """
+        with self.lock:
+            return list(self.byCompletion[True].values())
+    
+
+    def _indexes(self, id, job):
+        """
+        Returns the indexes which contain the job
+        """
+        indexes = []
+        if job.isGlobal:
+            indexes.append(self.byKind['global'])
+        elif job.isPersistent:
+            indexes.append(self.byKind['persistent'])
+        if not job.isPersistent:
+            indexes.append(self.byKind['transient'])
+        parts = str(id).split("|")
+        for n in range(1, len(parts)):
+            indexes.append(self.byPrefix.setdefault("|".join(parts[:n]), {}))
+        indexes.append(self.byCompletion[bool(job.isComplete())])
+        return indexes
+    
+
+    def _index(self, id, job):
+        for index in self._indexes(id, job):
+            index[id] = job
+    
+
+    def _unindex(self, id, job):
+        for index in (self.byCompletion[True], self.byCompletion[False]):
+            index.pop(id, None)
+        for index in self._indexes(id, job)[:-1]:
+            index.pop(id, None)
+        parts = str(id).split("|")
+        for n in range(1, len(parts)):
+            prefix = "|".join(parts[:n])
+            if not self.byPrefix.get(prefix, True):
+                del self.byPrefix[prefix]
+    
+
+
+
+class JobGroup:
+    """
+    A group of JobTickets which are sent to the node together, as
+    returned by FCPNode.batch() and FCPNode.submitMany()
+    
+    Attributes of interest:
+        - jobs - the list of JobTicket objects, in submission order
+    """
+    def __init__(self, node, callback=None):
+        self.node = node
+        self.callback = callback
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.doneCount = 0
+        self.failedCount = 0
+        self.completeEvent = threading.Event()
+        self.submitted = False
+    
+
+    def __enter__(self):
+        batches = self.node._batches
+        if getattr(batches, 'group', None) is not None:
+            raise FCPException(header="Batches cannot be nested")
+        batches.group = self
+        return self
+    
+
+    def __exit__(self, type, value, traceback):
+        self.node._batches.group = None
+        if type is None:
+            self.submit()
+    
+
+    def __len__(self):
+        return len(self.jobs)
+    
+
+    def __iter__(self):
+        return iter(self.jobs)
+    
+
+    def _add(self, job):
+        if self.submitted:
+            raise FCPException(header="Batch was already submitted")
+        self.jobs.append(job)
+    
+
+    def submit(self):
+        """
+        Hands all collected jobs to the manager thread at once
+        
+        Called at the end of the with-block.
+        """
+        self.submitted = True
+        if not self.jobs:
+            self.completeEvent.set()
+            return
+        for job in self.jobs:
+            job.addDoneCallback(self._jobDone)
+        self.node.clientReqQueue.put(self)
+        self.node._wakeup()
+    
+
+    def _jobDone(self, job):
+        with self.lock:
+            self.doneCount += 1
+            if isinstance(job.result, Exception):
+                self.failedCount += 1
+            if self.doneCount == len(self.jobs):
+                self.completeEvent.set()
+        if self.callback is not None:
+            self.callback(self, job)
+    
+
+    def _putResult(self, result):
+        """
+        Ends all jobs of the group with the given result, used by the
+        manager thread when it fails
+        """
+        for job in self.jobs:
+            job._putResult(result)
+    
+
+    def waitTillReqSent(self):
+        """
+        Waits until the messages of all jobs have been sent to the node
+        """
+        for job in self.jobs:
+            job.waitTillReqSent()
+    
+
+    def progress(self):
+        """
+        Returns a 3-tuple (done, failed, total) of job counts, where
+        done includes the failed jobs
+        """
+        with self.lock:
+            return self.doneCount, self.failedCount, len(self.jobs)
+    
+
+    def isComplete(self):
+        """
+        Returns True if all jobs of the group are complete
+        """
+        return self.completeEvent.is_set()
+    
+
+    def wait(self, timeout=None):
+        """
+        Waits until all jobs are complete, and returns their results
+        in submission order, with exceptions as values for failed jobs
+        
+        Raises FCPNodeTimeout if the timeout passes first.
+        """
+        if not self.completeEvent.wait(timeout):
+            done, failed, total = self.progress()
+            raise FCPNodeTimeout(
+                header="%d of %d jobs did not complete in time" % (
+                    total - done, total))
+        return [job.result for job in self.jobs]
+    
+
+    def asCompleted(self, timeout=None):
+        """
+        Yields the jobs in the order in which they complete, as
+        FCPNode.asCompleted
+        """
+        return self.node.asCompleted(self.jobs, timeout)
+    
+
+class FCPNodePool:
+    """
+    Keeps FCP connections open for reuse across short-lived callers
+
+    Opening an FCPNode costs a TCP connect, a ClientHello round trip
+    and a manager thread, which dominates small requests like a single
+    plugin message. The pool hands out running nodes instead, keyed by
+    host, port and client name, and replaces nodes whose connection
+    died. An idle node is handed out first. Otherwise a new one is
+    opened, up to size nodes per key, and callers share the least used
+    one after that: FCPNode is safe for concurrent use. A key with an
+    explicit client name gets one node only, since the node drops the
+    older of two connections with the same name.
+
+    Use borrow() as a with-block, which does not shut down the node:
+
+        with pool.borrow(port=9481) as node:
+            node.fcpPluginMessage(...)
+
+    The process-wide pool fcp3.node.nodePool is shut down at exit.
+    """
+    def __init__(self, size=1, **nodeopts):
+        """
+        Arguments:
+            - size - maximum number of connections per host, port and name
+            - nodeopts - default keywords for the FCPNode constructor,
+              for example verbosity or logfunc
+        """
+        self.size = size
+        self.nodeopts = nodeopts
+        self.lock = threading.Lock()
+        # notified when a node finished connecting, or failed to
+        self.connected = threading.Condition(self.lock)
+        # (host, port, name) -> list of [node, borrowers], where node is
+        # None while it connects
+        self.nodes = {}
+    
+
+    def _key(self, kw):
+        env = os.environ
+        host = kw.get('host', env.get("FCP_HOST", defaultFCPHost))
+        port = int(kw.get('port', env.get("FCP_PORT", defaultFCPPort)))
+        return host, port, kw.get('name', None)
+    
+
+    def acquire(self, **kw):
+        """
+        Returns a running FCPNode, connecting a new one if needed
+        
+        Keywords are passed to the FCPNode constructor. Every acquired
+        node must be given back with release().
+        
+        A new node connects outside the lock, in a slot reserved for it,
+        so callers who can share a running node do not wait for it.
+        """
+        opts = dict(self.nodeopts)
+        opts.update(kw)
+        key = self._key(opts)
+        with self.lock:
+            while True:
+                entries = self.nodes.setdefault(key, [])
+                # drop the nodes whose connection or manager thread died
+                for entry in entries[:]:
+                    node = entry[0]
+                    if node is not None \
+                            and not (node.running and node.nodeIsAlive):
+                        entries.remove(entry)
+                        if not entry[1]:
+                            node.shutdown()
+                ready = [entry for entry in entries if entry[0] is not None]
+                idle = [entry for entry in ready if not entry[1]]
+                if idle:
+                    idle[0][1] += 1
+                    return idle[0][0]
+                if len(entries) < (self.size if key[2] is None else 1):
+                    entry = [None, 1]
+                    entries.append(entry)
+                    break
+                if ready:
+                    entry = min(ready, key=lambda entry: entry[1])
+                    entry[1] += 1
+                    return entry[0]
+                # all slots are taken by nodes which are connecting
+                self.connected.wait()
+    
+        try:
+            node = FCPNode(**opts)
+        except:
+            with self.lock:
+                # entries are compared by identity, others may be equal
+                entries[:] = [other for other in entries if other is not entry]
+                self.connected.notify_all()
+            raise
+        with self.lock:
+            entry[0] = node
+            self.connected.notify_all()
+            if self.nodes.get(key) is entries \
+                    and any(other is entry for other in entries):
+                return node
+        # the pool was shut down while the node connected
+        node.shutdown()
+        raise FCPNodeFailure("%s:%s: node pool was shut down" % key[:2])
+    
+
+    def release(self, node):
+        """
+        Gives back a node taken with acquire()
+        
+        A dead node is shut down once its last borrower released it.
+        """
+        with self.lock:
+            for entries in self.nodes.values():
+                for entry in entries:
+                    if entry[0] is node:
+                        entry[1] -= 1
+                        return
+        # the node was dropped from the pool while it was borrowed
+        if not node.nodeIsAlive:
+            node.shutdown()
+    
+
+    @contextlib.contextmanager
+    def borrow(self, **kw):
+        """
+        Context manager around acquire() and release()
+        """
+        node = self.acquire(**kw)
+        try:
+            yield node
+        finally:
+            self.release(node)
+    
+
+    def shutdown(self):
+        """
+        Shuts down all pooled nodes
+        """
+        with self.lock:
+            nodes = [entry[0] for entries in self.nodes.values()
+                     for entry in entries if entry[0] is not None]
+            self.nodes.clear()
+        for node in nodes:
+            try:
+                node.shutdown()
+            except Exception:
+                traceback.print_exc()
+    
+
+#: the process-wide pool used by pooledNode(). A large payload occupies
+#: its connection while it is sent, so callers in parallel threads get
+#: connections of their own, up to 4 per node.
+nodePool = FCPNodePool(size=4)
+atexit.register(nodePool.shutdown)
+
+def pooledNode(**kw):
+    """
+    Borrows a running node from the process-wide pool for a with-block
+    
+    Unlike using FCPNode() itself as a context manager, the connection
+    stays open after the block for the next caller.
+    """
+    return nodePool.borrow(**kw)
+
+
+class FileData:
+    """
+    The contents of a file as payload of a direct upload
+    
+    The size of the file is taken when this object is created, so a
+    missing file fails in the caller. The file is only opened when the
+    message is sent, and read and sent in chunks of uploadChunkSize
+    bytes, so queued uploads hold no file descriptors and the file never
+    needs to fit into memory.
+    
+    If the file shrinks before it is sent or cannot be read, the rest of
+    the DataLength announced is sent as zero bytes, and error is set, so
+    only the job of this upload fails, instead of the connection.
+    
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     _ = f.write(b"abcdef")
+    ...     f.flush()
+    ...     data = FileData(f.name)
+    ...     _ = f.truncate(4)
+    ...     f.flush()
+    ...     sent = b"".join(bytes(chunk) for chunk in data.chunks(4))
+    >>> data.size, sent, data.error is not None
+    (6, b'abcd\\x00\\x00', True)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.size = os.stat(path).st_size
+        self.error = None
+    
+
+    def chunks(self, chunksize=uploadChunkSize):
+        """
+        Yields the contents of the file as memoryviews of a reused
+        buffer, which are only valid until the next one is yielded
+        
+        Always yields exactly size bytes, because the DataLength was
+        sent already, and sets error if the file changed its size since
+        this object was created.
+        """
+        self.error = None
+        buf = bytearray(min(chunksize, self.size) or 1)
+        remaining = self.size
+        with memoryview(buf) as view:
+            try:
+                with open(self.path, "rb") as f:
+                    while remaining:
+                        n = f.readinto(view[:min(remaining, len(buf))])
+                        if not n:
+                            break
+                        yield view[:n]
+                        remaining -= n
+                    if not remaining and f.read(1):
+                        self.error = IOError(
+                            "%s grew during upload" % self.path)
+            except OSError as e:
+                self.error = e
+            if remaining:
+                if self.error is None:
+                    self.error = IOError(
+                        "%s shrank during upload" % self.path)
+                buf[:] = bytes(len(buf))
+                while remaining:
+                    n = min(remaining, len(buf))
+                    yield view[:n]
+                    remaining -= n
+    
+
+class ConcatData(FileData):
+    """
+    The contents of several files and byte strings, one after another,
+    as one payload of a direct upload, such as the data of all the
+    UploadFrom=direct files of a ClientPutComplexDir
+    
+    The files are given as FileData, so their sizes are summed up in
+    the caller. They are opened when the message is sent, one at a time,
+    and read in chunks, so the payload never needs to fit into memory.
+    A file which changed its size is padded or cut as in FileData.chunks(),
+    and its error becomes the error of the whole payload.
+    
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     _ = f.write(b"defgh")
+    ...     f.flush()
+    ...     data = ConcatData([b"abc", FileData(f.name), b"i"])
+    ...     data.size, b"".join(bytes(chunk) for chunk in data.chunks(2))
+    (9, b'abcdefghi')
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     _ = f.write(b"defgh")
+    ...     f.flush()
+    ...     data = ConcatData([b"abc", FileData(f.name), b"i"])
+    ...     _ = f.truncate(2)
+    ...     f.flush()
+    ...     sent = b"".join(bytes(chunk) for chunk in data.chunks(2))
+    >>> sent, data.error is not None
+    (b'abcde\\x00\\x00\\x00i', True)
+    """
+    def __init__(self, parts):
+        self.parts = [part if isinstance(part, FileData) else bytes(part)
+                      for part in parts]
+        self.size = sum(dataLength(part) for part in self.parts)
+        self.error = None
+    
+
+    def chunks(self, chunksize=uploadChunkSize):
+        """
+        Yields the parts in order, files as in FileData.chunks()
+        """
+        self.error = None
+        for part in self.parts:
+            if isinstance(part, FileData):
+                for chunk in part.chunks(chunksize):
+                    yield chunk
+                if self.error is None:
+                    self.error = part.error
+            elif part:
+                yield part
+    
+
 def toBool(arg):
     try:
         arg = int(arg)
@@ -3088,6 +4194,36 @@ def toBool(arg):
     else:
         return False
 
+def dataLength(data):
+    """
+    Returns the number of bytes of a payload, which is a bytes-like
+    object or a binary file object read from its current position
+
+    >>> dataLength(b"abc"), dataLength(memoryview(b"abcd"))
+    (3, 4)
+    >>> import io
+    >>> f = io.BytesIO(b"abcdef")
+    >>> f.seek(2)
+    2
+    >>> dataLength(f), f.tell()
+    (4, 2)
+    """
+    if isinstance(data, FileData):
+        return data.size
+    if not hasattr(data, 'read'):
+        return memoryview(data).nbytes
+    pos = data.tell()
+    try:
+        st = os.fstat(data.fileno())
+        if stat.S_ISREG(st.st_mode):
+            return st.st_size - pos
+    except (AttributeError, OSError):
+        pass
+    # not backed by a regular file
+    end = data.seek(0, os.SEEK_END)
+    data.seek(pos)
+    return end - pos
+
 def readdir(dirpath, prefix='', gethashes=False):
     """
     Reads a directory, returning a sequence of file dicts.
@@ -3169,8 +4305,11 @@ def hashFile(path):
     >>> hashFile(filepath) == hashlib.sha1("test").hexdigest()
     True
     """
-    raw = open(path, "rb").read()
-    return hashlib.sha1(raw).hexdigest()
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(uploadChunkSize), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
 def sha256dda(nodehelloid, identifier, path=None):
     """
@@ -3182,8 +4321,11 @@ def sha256dda(nodehelloid, identifier, path=None):
     >>> print sha256dda("1","2",filepath) == hashlib.sha256("1-2-" + "test").digest()
     True
     """
-    tohash = b"-".join([nodehelloid.encode('utf-8'), identifier.encode('utf-8'), open(path, "rb").read()])
-    return hashlib.sha256(tohash).digest()
+    h = hashlib.sha256(b"-".join([nodehelloid.encode('utf-8'), identifier.encode('utf-8'), b""]))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(uploadChunkSize), b""):
+            h.update(chunk)
+    return h.digest()
 
 def guessMimetype(filename):
     """
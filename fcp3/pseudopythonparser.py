@@ -7,7 +7,11 @@ Safe method for reading files in the pseudo python syntax used for storing pyFre
 This CANNOT read all kinds of python files. It is purely a specialized
 reader for a very restricted subset of python code.
 
-It uses json for reading more complex assignments.
+It uses json for reading more complex assignments. Assignments in
+json syntax are decoded in one go. For the others, each line is scanned
+once, counting the brackets outside of strings, and the assignment is
+handed to json when its brackets are closed, so the time to parse a
+file is linear in its size.
 """
 
 # this requires at least python 2.6.
@@ -16,6 +20,15 @@ import logging
 import re
 
 
+#: strings in json or python syntax, whose brackets must not be counted
+_strings = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+#: the brackets which nest complex datastructures
+_brackets = re.compile(r'[][{}()]')
+#: the line boundaries of str.splitlines
+_newline = re.compile("\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+_decoder = json.JSONDecoder()
+
+
 # Firstoff we need a reader which can be given consecutive lines and parse these into a dictionary of variables.
 class Parser:
     def __init__(self):
@@ -40,6 +53,10 @@ class Parser:
         ...   ]
         ...   ''')['c'][0]['d']
         [1, 2, 3, None, False, True, 'e']
+        >>> p.parse('''e = [ { "a": "]",
+        ...   "b": ["[", 1]},
+        ...   ("c", 'd"]'), 2 ]''')['e']
+        [{'a': ']', 'b': ['[', 1]}, ['c', 'd"]'], 2]
         """
         self.data = {}
         self.unparsed = []
@@ -49,13 +66,45 @@ class Parser:
         self.unparsedvariable = None
     
     def parse(self, text):
-        for line in text.splitlines():
-            self.readline(line)
+        pos = 0
+        while pos < len(text):
+            newline = _newline.search(text, pos)
+            line = text[pos:newline.start() if newline else len(text)]
+            # json data is decoded in one go, anything else line by line
+            end = None
+            if not self.unparsed:
+                end = self.jsondecode(text, pos, line)
+            if end is None:
+                self.readline(line)
+                end = newline.end() if newline else len(text)
+            pos = end
         # if unparsed code remains, that is likely an error in the code.
         if self.unparsedstring.strip() or self.endunparsed:
-            raise ValueError("Invalid or too complex code: " + self.endunparsed + "\n" + self.unparsed)
+            raise ValueError("Invalid or too complex code: " + self.endunparsed + "\n" + self.unparsedstring)
         return self.data
     
+    def jsondecode(self, text, start, line):
+        """Decode an assignment of json data, which starts with line at start of text.
+
+        Returns the position after its last line, or None if the
+        assignment is not (only) json.
+        """
+        if " = [" in line:
+            assign = line.index(" = [")
+        elif " = {" in line:
+            assign = line.index(" = {")
+        else:
+            return None
+        try:
+            value, end = _decoder.raw_decode(text, start + assign + 3)
+        except ValueError:
+            return None
+        newline = _newline.search(text, end)
+        if text[end:newline.start() if newline else len(text)].strip():
+            return None
+        self.data[line[:assign]] = value
+        return newline.end() if newline else len(text)
+    
     def jsonload(self, text):
         origtext = text
         # replace entities which json encodes differently from python.
@@ -81,22 +130,23 @@ class Parser:
             # Only if there is an odd number of "  in a line, then every ' must be
             # replaced by ". This requires some care.
             lines = text.splitlines()
-            for n, l in enumerate(lines[:]):
-                l2 = ""
+            for n, l in enumerate(lines):
+                if "'" not in l:
+                    continue
+                l2 = []
                 inquotes = False
                 insinglequotes = False
-                add = 0
                 for i, c in enumerate(l):
-                    i += add
-                    if not insinglequotes and c == '"' and (i == 0 or l[i-1] != '\\'):
+                    escaped = i > 0 and l[i-1] == '\\'
+                    if not insinglequotes and c == '"' and not escaped:
                         inquotes = not inquotes
-                    if not inquotes and c == "'" and (i == 0 or l[i-1] != '\\'):
+                    elif not inquotes and c == "'" and not escaped:
                         insinglequotes = not insinglequotes
-                        l = l[:i] + '"' + l[i+1:]
-                    if c == '"' and insinglequotes:
-                        l = l[:i] + '\\"' + l[:i+1]
-                        add += 1
-                lines[n] = l
+                        c = '"'
+                    elif c == '"' and insinglequotes:
+                        c = '\\"'
+                    l2.append(c)
+                lines[n] = "".join(l2)
             text = "\n".join(lines) + "\n"
             try:
                 return json.loads(text)
@@ -122,33 +172,36 @@ class Parser:
         """Join and return self.unparsed as a string."""
         return "\n".join(self.unparsed)
     
+    def countnesting(self, line):
+        """Track the nesting depth of brackets outside of strings in line."""
+        if not _brackets.search(line):
+            return
+        if '"' in line or "'" in line:
+            line = _strings.sub("", line)
+        self.endnesting += (line.count("[") + line.count("{") + line.count("(")
+                            - line.count("]") - line.count("}") - line.count(")"))
+    
     def checkandprocessunprocessed(self):
-        """Check if the rest of self.unprocessed finishes the line."""
-        if self.endunparsed in self.unparsedstring:
-            try:
-                self.data[self.unparsedvariable] = self.jsonload(self.unparsedstring)
-            except ValueError as e:
-                logging.error(
-                    "could not load unparsed string, likely nested datastructures (error: %s). Aggregating more",
-                    str(e))
-                return
-            else:
-                self.unparsed, self.unparsedvariable, self.endunparsed = [], "", ""
+        """Load self.unparsed once all its brackets are closed."""
+        if self.endnesting > 0:
+            return
+        try:
+            self.data[self.unparsedvariable] = self.jsonload(self.unparsedstring)
+        except ValueError as e:
+            raise ValueError("Invalid or too complex code for %s: %s" % (
+                self.unparsedvariable, e))
+        self.unparsed, self.unparsedvariable, self.endunparsed = [], "", ""
+        self.endnesting = 0
     
     def readline(self, line):
         """Read one line of text."""
-        # if we have unparsed code and this line does not end it, we just add the code to the unparsed code.
+        # if we have unparsed code, we add the line to it, until its brackets are closed.
         if self.unparsed and not self.endunparsed:
             raise ValueError("We have unparsed data but we do not know how it ends. THIS IS A BUG.")
         
-        if self.unparsed and self.endunparsed:
+        if self.unparsed:
             self.unparsed.append(line)
-        
-        if self.unparsed and self.endunparsed and not line.strip().endswith(self.endunparsed):
-            return # line is already processed as far as possible
-        if self.unparsed and self.endunparsed and line.strip().endswith(self.endunparsed):
-            # json uses null for None, true for True and false for False. 
-            # We have to replace those in the content and hope that nothing will break.
+            self.countnesting(line)
             self.checkandprocessunprocessed()
             return
         
@@ -157,16 +210,16 @@ class Parser:
             start = line.index(" = [")
             self.unparsedvariable = line[:start]
             self.unparsed = [line[start+3:]]
-            self.endnesting += 1
             self.endunparsed = "]"
+            self.countnesting(self.unparsed[0])
             self.checkandprocessunprocessed()
             return
         elif " = {" in line:
             start = line.index(" = {")
             self.unparsedvariable = line[:start]
             self.unparsed = [line[start+3:]]
-            self.endnesting += 1
             self.endunparsed = "}"
+            self.countnesting(self.unparsed[0])
             self.checkandprocessunprocessed()
             return
         
@@ -24,21 +24,33 @@ new persistent SiteMgr class
 
 #@+others
 #@+node:imports
+import collections
 import fnmatch
 import io
+import itertools
+import contextlib
 import json
 import os
 import os.path
+import posixpath
 import pprint
+import re
 import stat
 import sys
 import threading
 import time
 import traceback
+import urllib.parse
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 import fcp3 as fcp
 from fcp3 import CRITICAL, ERROR, INFO, DETAIL, DEBUG #, NOISY
-from fcp3.node import hashFile
+from fcp3.node import hashFile, FileData, ConcatData
+from fcp3.chk import compute_chk, blockSize as chkBlockSize
 
 #@-node:imports
 #@+node:globals
@@ -48,6 +60,10 @@ maxretries = -1
 
 defaultMaxConcurrent = 10
 
+defaultMaxConcurrentSites = 4
+
+defaultChkCacheSize = 100000
+
 testMode = False
 #testMode = True
 
@@ -56,6 +72,23 @@ defaultPriority = 3
 defaultMaxManifestSizeBytes = 1024*1024*2 # 2.0 MiB: As used by the freenet default dir inserter. Reduced by 512 bytes per redirect. TODO: Add a larger side-container for additional medium-size files like images. Doing this here, because here we know what is linked in the index file.
 defaultMaxNumberSeparateFiles = 1024 - 128 # ad hoq - my node sometimes dies at 500 simultaneous uploads. This is below 90% of the space in the estimated size of the manifest.
 
+#: The size of a redirect. See src/freenet/support/ContainerSizeEstimator.java
+redirectSize = 512
+#: The estimated size of the .metadata object. See src/freenet/support/ContainerSizeEstimator.java
+metadataSize = 128
+#: The cost of fetching a file separately instead of with the manifest, as
+#: the number of bytes a visitor could get in the time of the extra request
+fetchLatencyBytes = 64 * 1024
+#: The share of visitors who need a file when they load the index page,
+#: for CSS and other files linked from the index, other html files and the rest
+loadProbability = {'css': 1.0, 'linked': 0.5, 'html': 0.1, 'other': 0.02}
+#: MIME types (or their prefixes) of data which is compressed already, so
+#: it is inserted with DontCompress, and small files get their CHKs locally
+incompressibleMimetypes = (
+    "image/jpeg", "image/png", "image/gif", "image/webp", "audio/", "video/",
+    "application/zip", "application/gzip", "application/x-gzip",
+    "application/x-bzip2", "application/x-xz", "application/x-7z-compressed",
+    "font/woff", "application/font-woff")
 
 version = 1
 
@@ -93,14 +126,35 @@ class SiteMgr:
         self.verbosity = kw.get('verbosity', fcp.node.DETAIL)
         self.Verbosity = kw.get('Verbosity', 0)
         self.noInsert = kw.get('noInsert', False)
+        self.paranoid = kw.get('paranoid', False)
         self.maxConcurrent = kw.get('maxconcurrent', defaultMaxConcurrent)
+        self.maxConcurrentSites = kw.get('maxConcurrentSites',
+                                         defaultMaxConcurrentSites)
+        # the CHK requests in flight, shared by all sites
+        self.insertBudget = threading.BoundedSemaphore(self.maxConcurrent)
         self.priority = kw.get('priority', defaultPriority)
     
         self.chkCalcNode = kw.get('chkCalcNode', None)
+        # further nodes to spread the CHK calculations over
+        self.chkCalcNodes = kw.get('chkCalcNodes', [])
         self.maxManifestSizeBytes = kw.get("maxManifestSizeBytes", 
                                            defaultMaxManifestSizeBytes)
         self.maxNumberSeparateFiles = kw.get("maxNumberSeparateFiles", 
                                              defaultMaxNumberSeparateFiles)
+        # the CHKs of file contents, shared by all sites
+        self.chkCache = ChkCache(os.path.join(self.basedir, ".chkcache.sqlite"),
+                                 kw.get('chkCacheSize', defaultChkCacheSize))
+        # whether to check that inserted CHKs are still in the datastore
+        # before skipping their insert
+        self.checkRetrievable = kw.get('checkRetrievable', False)
+        # the CHKs which sites queued for insert in this run, with the
+        # ids of their insert jobs
+        self.chksQueued = {}
+        # by MIME type, whether a locally computed CHK matched the node's
+        self.localChks = {}
+        # guards chksQueued and localChks, which the sites inserted at
+        # the same time by runSites share
+        self.chkLock = threading.Lock()
 
 
         self.index = kw.get('index', 'index.html')
@@ -152,6 +206,8 @@ class SiteMgr:
             self.node = fcp.FCPNode(**nodeopts)
             if not self.chkCalcNode:
                 self.chkCalcNode = self.node
+            if not self.chkCalcNodes:
+                self.chkCalcNodes = [self.chkCalcNode]
     
             self.node.listenGlobal()
             
@@ -183,6 +239,7 @@ class SiteMgr:
                 Verbosity=self.Verbosity,
                 noInsert=self.noInsert,
                 chkCalcNode=self.chkCalcNode,
+                chkCalcNodes=self.chkCalcNodes,
                 mtype=self.mtype,
                 mimeTypeMatch=self.mimeTypeMatch,
                 )
@@ -305,6 +362,8 @@ class SiteMgr:
         site = self.getSite(name)
         self.sites.remove(site)
         os.unlink(site.path)
+        if os.path.isfile(site.dbPath):
+            os.unlink(site.dbPath)
     
     #@-node:removeSite
     #@+node:cancelUpdate
@@ -330,11 +389,12 @@ class SiteMgr:
         else:
             sites = self.sites
         
-        for site in sites:
+        def insert(site):
             if cron:
                 print("---------------------------------------------------------------------")
                 print("freesitemgr: updating site '%s' on %s" % (site.name, time.asctime()))
             site.insert()
+        self.runSites(sites, insert)
     
     #@-node:insert
     #@+node:reinsert
@@ -351,12 +411,16 @@ class SiteMgr:
         else:
             sites = self.sites
         
-        for site in sites:
+        def reinsert(site):
             if cron:
                 print("---------------------------------------------------------------------")
                 print("freesitemgr: reinserting site '%s' on %s" % (site.name, time.asctime()))
             site.mark_for_reinsert()
-            site.insert()
+            try:
+                site.insert()
+            finally:
+                site.reinserting = False
+        self.runSites(sites, reinsert)
     
     #@-node:reinsert
     #@+node:cleanup
@@ -369,10 +433,67 @@ class SiteMgr:
         else:
             sites = self.sites
         
-        for site in sites:
-            site.cleanup()
+        self.runSites(sites, lambda site: site.cleanup())
     
     #@-node:cleanup
+    #@+node:runSites
+    def runSites(self, sites, action):
+        """
+        Calls action(site) for all given sites, for up to
+        maxConcurrentSites sites at once, and logs the time each took
+
+        The global queue is listed once for all sites beforehand.
+        """
+        self.dispatchGlobalQueue(sites)
+        self.chksQueued.clear()
+        pending = collections.deque(sites)
+        timings = []
+    
+        def worker():
+            while True:
+                try:
+                    site = pending.popleft()
+                except IndexError:
+                    return
+                start = time.time()
+                try:
+                    action(site)
+                except Exception:
+                    self.log(CRITICAL, "%s failed:\n%s" % (
+                        site.name, traceback.format_exc()))
+                finally:
+                    # the listing is outdated by what the site did
+                    site.queueListed = False
+                timings.append((site.name, time.time() - start))
+    
+        workers = [threading.Thread(target=worker, name="site-%d" % i)
+                   for i in range(min(self.maxConcurrentSites, len(sites)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            # joining with a timeout lets KeyboardInterrupt through
+            while thread.is_alive():
+                thread.join(1)
+    
+        for name, seconds in timings:
+            self.log(INFO, "%s: done in %.1fs" % (name, seconds))
+    
+    #@-node:runSites
+    #@+node:dispatchGlobalQueue
+    def dispatchGlobalQueue(self, sites):
+        """
+        Lists the node's global queue once for all given sites, which
+        then find their jobs 'freesitemgr|<sitename>|<file>' in the
+        node's job index
+        """
+        if not self.node:
+            return
+        self.node.refreshPersistentRequests()
+        for site in sites:
+            site.queueListed = True
+    
+    #@-node:dispatchGlobalQueue
     #@+node:securityCheck
     def securityCheck(self):
     
@@ -444,7 +565,11 @@ class SiteState:
     Stores the current state of a single freesite's insertion, in a way
     that can recover from cancellations, node crashes etc
 
-    The state is saved as a pretty-printed python dict, in ~/.freesitemgr/<sitename>
+    The state is saved as a pretty-printed python dict, in ~/.freesitemgr/<sitename>,
+    and the file records in an SQLite database ~/.freesitemgr/.<sitename>.sqlite,
+    which is read when the records are first used, and where only the
+    records which changed are written on save. Sites with their file
+    records in the state file are migrated on their next save.
     """
     #@    @+others
     #@+node:__init__
@@ -479,6 +604,8 @@ class SiteState:
         # TODO: at some point this should be configurable per site
         self.maxManifestSizeBytes = self.sitemgr.maxManifestSizeBytes
         self.noInsert = self.sitemgr.noInsert
+        # rehash every file on scan instead of trusting the stat index
+        self.paranoid = self.sitemgr.paranoid
     
         # borrow the node's logger
         try:
@@ -492,12 +619,23 @@ class SiteState:
         self.uriPriv = kw.get('uriPriv', '')
         self.updateInProgress = True
         self.files = []
+        # names of the records in the state database
+        self.savedNames = set()
         self.maxConcurrent = kw.get('maxconcurrent', defaultMaxConcurrent)
         self.priority = kw.get('priority', defaultPriority)
         self.basedir = kw.get('basedir', defaultBaseDir)
         self.path = os.path.join(self.basedir, self.name)
+        self.dbPath = os.path.join(self.basedir, ".%s.sqlite" % self.name)
         self.Verbosity = kw.get('Verbosity', 0)
         self.chkCalcNode = kw.get('chkCalcNode', self.node)
+        self.chkCalcNodes = kw.get('chkCalcNodes') or [self.chkCalcNode]
+        # whether the CHK calculation nodes can read our files, None
+        # while the first CHK request from disk finds out
+        self.filesReadableBy = {}
+        # our jobs from the sitemgr's listing of the global queue
+        self.queueListed = False
+        # whether the inserts of this run heal the site
+        self.reinserting = False
 
         self.index = kw.get('index', 'index.html')
         self.sitemap = kw.get('sitemap', 'sitemap.html')
@@ -551,6 +689,13 @@ class SiteState:
             for k,v in list(d.items()):
                 setattr(self, k, v)
     
+            if sqlite3 and os.path.isfile(self.dbPath):
+                # the records are read when they are first used
+                self.files = None
+            else:
+                # the records are in the state file, or there are none yet
+                self.files = [FileRecord(rec) for rec in d.get('files', [])]
+    
             # a hack here - replace keys if missing
             if not self.uriPriv:
                 self.uriPub, self.uriPriv = self.node.genkey()
@@ -563,7 +708,7 @@ class SiteState:
     
             # another hack - ensure records have hashes and IDs and states
             needToSave = False
-            for rec in self.files:
+            for rec in self._files or []:
                 if not rec.get('hash', ''):
                     needToSave = True
                     try:
@@ -593,15 +738,47 @@ class SiteState:
             
             #print "load: files=%s" % self.files
     
-            # now gotta create lookup table, by name
-            self.filesDict = {}
-            for rec in self.files:
-                self.filesDict[rec['name']] = rec
-    
         finally:
             self.fileLock.release()
     
     #@-node:load
+    #@+node:files
+    @property
+    def files(self):
+        """
+        The list of file records, read from the state database on first use
+        """
+        if self._files is None:
+            self._files = []
+            with contextlib.closing(sqlite3.connect(self.dbPath)) as db:
+                for text, in db.execute("SELECT rec FROM files ORDER BY name"):
+                    rec = FileRecord(json.loads(text))
+                    rec.dirty = False
+                    self._files.append(rec)
+            self.savedNames = set(rec['name'] for rec in self._files)
+            self.log(DETAIL, "files: read %d records from %s" % (
+                len(self._files), self.dbPath))
+        return self._files
+    
+    @files.setter
+    def files(self, files):
+        self._files = files
+        self._filesDict = None
+    
+    @property
+    def filesDict(self):
+        """
+        The file records by name
+        """
+        if self._filesDict is None:
+            self._filesDict = dict((rec['name'], rec) for rec in self.files)
+        return self._filesDict
+    
+    @filesDict.setter
+    def filesDict(self, filesDict):
+        self._filesDict = filesDict
+    
+    #@-node:files
     #@+node:create
     def create(self):
         """
@@ -631,6 +808,7 @@ class SiteState:
         for rec in self.files:
             rec['state'] = 'changed'
         self.needToUpdate = True
+        self.reinserting = True
         self.save()
     
     #@-node:mark_for_reinsert
@@ -701,10 +879,16 @@ class SiteState:
             writeVars(mimeTypeMatch=self.mimeTypeMatch)
             
             w("\n")
-            # we should not save generated files.
-            physicalfiles = [rec for rec in self.files 
-                            if 'path' in rec]
-            writeVars("Detailed site contents", files=physicalfiles)
+            # we should not save generated files. Records which were
+            # never read from the database are unchanged.
+            if self._files is not None:
+                physicalfiles = [rec for rec in self._files 
+                                if 'path' in rec]
+                if sqlite3:
+                    self.saveFiles(physicalfiles)
+                else:
+                    writeVars("Detailed site contents", files=physicalfiles)
+            self.sitemgr.chkCache.save()
     
             f.close()
     
@@ -725,6 +909,120 @@ class SiteState:
             self.fileLock.release()
     
     #@-node:save
+    #@+node:saveFiles
+    def saveFiles(self, records):
+        """
+        Writes the changed file records to the state database, and
+        deletes the ones which are gone
+        """
+        names = set(rec['name'] for rec in records)
+        removed = self.savedNames - names
+        changed = [rec for rec in records if getattr(rec, 'dirty', True)]
+        if not removed and not changed and os.path.isfile(self.dbPath):
+            return
+    
+        self.log(DETAIL, "saveFiles: %d changed and %d removed records" % (
+            len(changed), len(removed)))
+        with contextlib.closing(sqlite3.connect(self.dbPath)) as db:
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS files "
+                           "(name TEXT PRIMARY KEY, rec TEXT NOT NULL)")
+                db.executemany("DELETE FROM files WHERE name = ?",
+                               [(name,) for name in removed])
+                db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                               [(rec['name'], json.dumps(rec)) for rec in changed])
+        for rec in changed:
+            rec.dirty = False
+        self.savedNames = names
+    
+    #@-node:saveFiles
+    #@+node:chkCache
+    def chkCacheKey(self, rec):
+        """
+        Returns the key of a file in the CHK cache, or None if its
+        contents are not known by hash
+        """
+        if not rec.get('hash'):
+            return None
+        return (rec['hash'], rec['mimetype'], ChkTargetFilename(rec['name']),
+                self.codecs(rec))
+    
+    def codecs(self, rec):
+        """
+        Returns the compression codecs a file is inserted with, an empty
+        string if it is inserted with DontCompress
+        
+        Files of incompressibleMimetypes are inserted with DontCompress,
+        because compressing them again rarely saves anything, and only
+        uncompressed blocks can get their CHKs without the node. Files
+        inserted before with compression therefore get new CHKs when they
+        change or are reinserted.
+        """
+        if not isCompressible(rec['mimetype']):
+            return ""
+        return self.node.defaultCompressionCodecsString()
+    
+    def localChk(self, rec):
+        """
+        Returns the CHK of a small incompressible file computed without
+        the node, or None
+        """
+        with self.sitemgr.chkLock:
+            known = self.sitemgr.localChks.get(rec['mimetype'])
+        if self.codecs(rec) or known is False \
+                or 'path' not in rec or rec['sizebytes'] > chkBlockSize:
+            return None
+        with open(rec['path'], "rb") as f:
+            data = f.read(chkBlockSize + 1)
+        uri = compute_chk(data, rec['mimetype'])
+        if uri is None:
+            return None
+        return uri + "/" + ChkTargetFilename(rec['name'])
+    
+    def getCachedChk(self, rec):
+        """
+        Returns (uri, inserted) for a file whose contents got a CHK
+        before, in this or another site, or None
+        """
+        key = self.chkCacheKey(rec)
+        if key is None:
+            return None
+        return self.sitemgr.chkCache.get(key)
+    
+    def cacheChk(self, rec, uri, inserted=False):
+        """
+        Remembers the CHK of a file's contents, and whether its insert
+        succeeded
+        """
+        key = self.chkCacheKey(rec)
+        if key is not None:
+            self.sitemgr.chkCache.put(key, uri, inserted)
+    
+    def needsInsert(self, uri, inserted):
+        """
+        Whether the data of a CHK which we know from the cache still
+        needs to be inserted
+        
+        It does not if another site queued it in this run, which the
+        file then shares, or if an insert of it succeeded before and it
+        is not a reinsert. With checkRetrievable, the data must be in the
+        node's datastore too.
+        """
+        with self.sitemgr.chkLock:
+            if uri in self.sitemgr.chksQueued:
+                return False
+        if not inserted or self.reinserting:
+            return True
+        if not self.sitemgr.checkRetrievable:
+            return False
+        try:
+            self.node.get(uri, nodata=True, dsonly=True, maxretries=0)
+        except fcp.node.FCPException:
+            self.log(INFO, "%s is no longer retrievable" % uri)
+            return True
+        return False
+    
+    #@-node:chkCache
     #@+node:getFile
     def getFile(self, name):
         """
@@ -749,7 +1047,7 @@ class SiteState:
         self.insertingManifest = False
     
         for rec in self.files:
-            if rec['state'] == 'inserting':
+            if rec['state'] in ('inserting', 'shared'):
                 rec['state'] = 'waiting'
         self.save()
         
@@ -836,63 +1134,193 @@ class SiteState:
         # cleared more quickly.
         filesToInsert.sort(key=lambda x: x['sizebytes'])
         
-        # compute CHKs for all these files, synchronously, and at the same time,
-        # submit the inserts, asynchronously
-        chkCounter = 0
-        for rec in filesToInsert:
-            if rec['state'] == 'waiting':
-                continue
-            log(INFO, "Pre-computing CHK for file %s" % rec['name'])
-            # get the data
-            if 'path' in rec:
-                raw = open(rec['path'],"rb").read()
-            elif rec['name'] in self.generatedTextData:
-                raw = self.generatedTextData[rec['name']].encode("utf-8")
-            else:
-                raise Exception("File %s, has neither path nor generated Text. rec: %s" % (
-                    rec['name'], rec))
-            # precompute the CHK
+        # compute CHKs for all these files, and as they arrive, submit
+        # the inserts, asynchronously, in batches of chkSaveInterval
+        pendingInserts = []
+        def queueInsert(rec, source):
             name = rec['name']
-            try:
-                uri = self.chkCalcNode.genchk(
-                    data=raw, 
-                    mimetype=rec['mimetype'], 
-                    TargetFilename=ChkTargetFilename(name))
-            except fcp.node.FCPProtocolError: # likely unsupported mime type
-                uri = self.chkCalcNode.genchk(
-                    data=raw, 
-                    TargetFilename=ChkTargetFilename(name))
-            rec['uri'] = uri
-            rec['state'] = 'waiting'
     
             # get a unique id for the queue
             id = self.allocId(name)
+            # and claim the CHK, unless another site queued it meanwhile
+            with self.sitemgr.chkLock:
+                owner = self.sitemgr.chksQueued.setdefault(rec['uri'], id)
+            if owner != id:
+                shareInsert(rec, owner)
+                return
+            rec['state'] = 'waiting'
     
             # and queue it up for insert, possibly on a different node
-            # TODO: First check whether the CHK top block is
-            #       retrievable (=someone else inserted it).
-            self.node.put(
-                "CHK@",
+            pendingInserts.append((rec, dict(
+                source,
                 id=id,
                 mimetype=rec['mimetype'],
                 priority=self.priority,
                 Verbosity=self.Verbosity,
-                data=raw,
                 TargetFilename=ChkTargetFilename(name),
+                nocompress=not self.codecs(rec),
                 chkonly=testMode,
                 persistence="forever",
                 Global=True,
-                waituntilsent=True,
                 maxretries=maxretries,
-                **{"async": True}
-                )
-            rec['state'] = 'inserting'
-            rec['chkname'] = ChkTargetFilename(name)
+                **{"async": True})))
     
-            chkCounter += 1
-            if( 0 == ( chkCounter % chkSaveInterval )):
+            # checkpoint the CHKs we have so far
+            if len(pendingInserts) >= chkSaveInterval:
+                submitInserts()
                 self.save()
+    
+        def shareInsert(rec, owner):
+            # wait for the result of the other insert
+            log(INFO, "File %s is being inserted as %s by %s" % (
+                rec['name'], rec['uri'], owner))
+            rec['state'] = 'shared'
+            rec['sharedWith'] = owner
+    
+        def submitInserts():
+            with self.node.batch() as group:
+                for rec, kw in pendingInserts:
+                    self.node.put("CHK@", **kw)
+            group.waitTillReqSent()
+            for rec, kw in pendingInserts:
+                rec['state'] = 'inserting'
+                rec['chkname'] = kw['TargetFilename']
+            del pendingInserts[:]
+    
+        # the CHKs are computed by up to maxConcurrent requests at
+        # once, spread over all CHK calculation nodes. Files are
+        # streamed from disk, so only their chunks are held in memory.
+        chkJobs = collections.deque()
+        chkNodes = itertools.cycle(self.chkCalcNodes)
+        def getSource(rec):
+            # get the data, files are streamed to the node in chunks
+            # because it might be remote and cannot read them itself
+            if 'path' in rec:
+                return {'file': rec['path'], 'direct': True}
+            elif rec['name'] in self.generatedTextData:
+                return {'data': self.generatedTextData[rec['name']].encode("utf-8")}
+            else:
+                raise Exception("File %s, has neither path nor generated Text. rec: %s" % (
+                    rec['name'], rec))
+    
+        def submitChk(rec):
+            log(INFO, "Pre-computing CHK for file %s" % rec['name'])
+            source = getSource(rec)
+            # the CHKs of files which the node would not compress can be
+            # computed here, once they matched the node's for their type
+            localUri = self.localChk(rec)
+            with self.sitemgr.chkLock:
+                verified = self.sitemgr.localChks.get(rec['mimetype'])
+            if localUri and verified:
+                rec['uri'] = localUri
+                self.cacheChk(rec, localUri)
+                queueInsert(rec, source)
+                return
+            node = next(chkNodes)
+            # a node which can read the file computes the CHK without
+            # getting the file contents over FCP. The first request to
+            # each node finds out whether it can, the others send the
+            # contents until then
+            if 'path' not in rec:
+                chkSource = source
+            elif node not in self.filesReadableBy:
+                self.filesReadableBy[node] = None
+                chkSource = {'file': rec['path']}
+            elif self.filesReadableBy[node]:
+                chkSource = {'file': rec['path']}
+            else:
+                chkSource = source
+            # take from the budget shared with the other sites, but
+            # only wait for it when we hold none of it
+            while not self.sitemgr.insertBudget.acquire(not chkJobs):
+                receiveChk()
+            try:
+                job = node.genchk(
+                    mimetype=rec['mimetype'],
+                    TargetFilename=ChkTargetFilename(rec['name']),
+                    nocompress=not self.codecs(rec),
+                    **dict(chkSource, **{"async": True}))
+            except:
+                self.sitemgr.insertBudget.release()
+                raise
+            chkJobs.append((rec, source, chkSource, node, job, localUri))
+    
+        def receiveChk():
+            rec, source, chkSource, node, job, localUri = chkJobs.popleft()
+            name = rec['name']
+            try:
+                try:
+                    uri = job.wait()
+                except fcp.node.FCPProtocolError:
+                    if chkSource is source or self.filesReadableBy.get(node):
+                        raise
+                    # the node cannot read our files, or does not know
+                    # the mime type, which sending the file tells apart
+                    chkSource = source
+                    uri = node.genchk(
+                        mimetype=rec['mimetype'],
+                        TargetFilename=ChkTargetFilename(name),
+                        nocompress=not self.codecs(rec),
+                        **chkSource)
+                    self.filesReadableBy[node] = False
+                else:
+                    if chkSource is not source:
+                        self.filesReadableBy[node] = True
+            except fcp.node.FCPProtocolError: # likely unsupported mime type
+                if node in self.filesReadableBy \
+                        and self.filesReadableBy[node] is None:
+                    # a later file finds out whether the node reads them
+                    del self.filesReadableBy[node]
+                uri = node.genchk(
+                    TargetFilename=ChkTargetFilename(name),
+                    nocompress=not self.codecs(rec),
+                    **chkSource)
+                localUri = None
+            finally:
+                self.sitemgr.insertBudget.release()
+            if localUri:
+                matches = localUri == uri
+                with self.sitemgr.chkLock:
+                    self.sitemgr.localChks[rec['mimetype']] = matches
+                log(INFO, "CHKs of %s files %s computed locally%s" % (
+                    rec['mimetype'], "are" if matches else "are not",
+                    "" if matches else ": %s differs from %s" % (localUri, uri)))
+            rec['uri'] = uri
+            self.cacheChk(rec, uri)
+            queueInsert(rec, source)
+    
+        try:
+            for rec in filesToInsert:
+                if rec['state'] == 'waiting':
+                    continue
+                cached = self.getCachedChk(rec)
+                if cached:
+                    uri, inserted = cached
+                    rec['uri'] = uri
+                    if self.needsInsert(uri, inserted):
+                        log(INFO, "Using cached CHK for file %s" % rec['name'])
+                        queueInsert(rec, getSource(rec))
+                        continue
+                    with self.sitemgr.chkLock:
+                        owner = self.sitemgr.chksQueued.get(uri)
+                    if owner:
+                        shareInsert(rec, owner)
+                    else:
+                        log(INFO, "File %s is inserted already as %s" % (
+                            rec['name'], uri))
+                        rec['state'] = 'idle'
+                    continue
+                if len(chkJobs) >= self.maxConcurrent:
+                    receiveChk()
+                submitChk(rec)
+            while chkJobs:
+                receiveChk()
+        finally:
+            # give back the budget of requests we no longer wait for
+            for i in range(len(chkJobs)):
+                self.sitemgr.insertBudget.release()
             
+        submitInserts()
         self.save()
     
         log(INFO, 
@@ -910,6 +1338,7 @@ class SiteState:
         self.node._submitCmd(
             self.manifestCmdId, "ClientPutComplexDir",
             rawcmd=self.manifestCmdBuf,
+            Data=self.manifestData,
             waituntilsent=True,
             keep=True,
             persistence="forever",
@@ -1002,27 +1431,16 @@ class SiteState:
         self.log(INFO, "insert:%s: fetching progress reports from global queue..." %
                         self.name)
     
-        self.node.refreshPersistentRequests()
-        
         needToInsertManifest = self.insertingManifest
         needToInsertIndex = self.insertingIndex
     
         queuedJobs = {}
         
         # for each job on queue that we know, clear it
-        globalJobs = self.node.getGlobalJobs()
-        for job in globalJobs:
+        for job in self.getQueuedJobs():
         
             # get file rec, if any (could be __manifest)
-            parts = job.id.split("|")
-            if parts[0] != 'freesitemgr':
-                # that's not our job - ignore it
-                continue
-            if parts[1] != self.name:
-                # not our site - ignore it
-                continue
-        
-            name = parts[2]
+            name = job.id.split("|")[2]
             # bab: huh? duplicated info?
             queuedJobs[name] = name
         
@@ -1071,6 +1489,8 @@ class SiteState:
                 # that file is now done
                 rec['uri'] = result
                 rec['state'] = 'idle'
+                if not isinstance(result, Exception):
+                    self.cacheChk(rec, result, inserted=True)
             elif name not in ['__manifest', self.index, self.sitemap]:
                 self.log(ERROR,
                          "insert:%s: Don't have a record for file %s" % (
@@ -1085,6 +1505,25 @@ class SiteState:
                 rec['state'] = 'waiting'
                 self.needToUpdate = True
         
+        # files whose CHK another insert job inserts are done when it
+        # succeeded, and get inserted by us if it failed or is gone
+        for rec in self.files:
+            if rec['state'] != 'shared':
+                continue
+            cached = self.getCachedChk(rec)
+            job = self.node.jobs.get(rec.get('sharedWith'))
+            if cached and cached[1]:
+                rec['state'] = 'idle'
+            elif job is not None and not job.isComplete():
+                continue
+            elif job is not None and not isinstance(job.result, Exception):
+                rec['state'] = 'idle'
+            else:
+                self.log(ERROR, "insert:%s: insert %s of file %s failed, inserting it again" % (
+                    self.name, rec.get('sharedWith'), rec['name']))
+                rec['state'] = 'waiting'
+                self.needToUpdate = True
+        
         # check for any uninserted files or manifests
         stillInserting = False
         for rec in self.files:
@@ -1110,6 +1549,7 @@ class SiteState:
         log = self.log
         
         structureChanged = False
+        indexChanged = False
     
         self.log(INFO, "scan: analysing freesite '%s' for changes..." % self.name)
     
@@ -1126,7 +1566,7 @@ class SiteState:
         physFiles = []
         physDict = {}
         for f in lst:
-            rec = {}
+            rec = FileRecord()
             try:
                 enc = "utf-8"
                 f['fullpath'].decode(enc)
@@ -1140,8 +1580,18 @@ class SiteState:
                 for pattern, mimetype in patternType.items():
                     if fnmatch.fnmatch(rec['name'], pattern):
                         rec['mimetype'] = mimetype
-            rec['hash'] = hashFile(rec['path'])
-            rec['sizebytes'] = getFileSize(rec['path'])
+            # only rehash files whose stat signature changed since
+            # the last scan, unless we are paranoid
+            st = os.stat(rec['path'])
+            rec['sizebytes'] = st.st_size
+            rec['mtimens'] = st.st_mtime_ns
+            rec['inode'] = st.st_ino
+            knownrec = self.filesDict.get(rec['name'])
+            if (not self.paranoid and knownrec and knownrec.get('hash')
+                and statSignature(knownrec) == statSignature(rec)):
+                rec['hash'] = knownrec['hash']
+            else:
+                rec['hash'] = hashFile(rec['path'])
             rec['uri'] = ''
             rec['id'] = ''
             physFiles.append(rec)
@@ -1197,6 +1647,12 @@ class SiteState:
                 # the size get the physical size.
                 if 'sizebytes' not in knownrec:
                     knownrec['sizebytes'] = rec['sizebytes']
+                # remember the stat signature of the hash we now know
+                if statSignature(knownrec) != statSignature(rec):
+                    knownrec['sizebytes'] = rec['sizebytes']
+                    knownrec['mtimens'] = rec['mtimens']
+                    knownrec['inode'] = rec['inode']
+                    indexChanged = True
 
     
         # if structure has changed, gotta sort and save
@@ -1206,6 +1662,8 @@ class SiteState:
             self.save()
             self.log(INFO, "scan: site %s has changed" % self.name)
         else:
+            if indexChanged:
+                self.save()
             self.log(INFO, "scan: site %s has not changed" % self.name)
     
     #@-node:scan
@@ -1215,30 +1673,34 @@ class SiteState:
         remove all node queue records relating to this site
         """
         self.log(INFO, "clearing node queue of leftovers")
-        self.node.refreshPersistentRequests()
-        for job in self.node.getGlobalJobs():
-            id = job.id
-            idparts = id.split("|")
-            if idparts[0] == 'freesitemgr' and idparts[1] == self.name:
-                self.node.clearGlobalJob(id)
+        for job in self.getQueuedJobs():
+            self.node.clearGlobalJob(job.id)
     
     #@-node:clearNodeQueue
+    #@+node:getQueuedJobs
+    def getQueuedJobs(self):
+        """
+        Returns the jobs of this freesite on the node's global queue,
+        from the listing the sitemgr made for all sites, if any, or
+        else from a new listing
+        """
+        if not self.queueListed:
+            self.node.refreshPersistentRequests()
+        return [job for job in self.node.getJobsWithPrefix("freesitemgr|" + self.name)
+                if job.isGlobal]
+    
+    #@-node:getQueuedJobs
     #@+node:readNodeQueue
     def readNodeQueue(self):
         """
-        Refreshes the node global queue, and reads from the queue a dict of
-        all jobs which are related to this freesite
+        Reads from the node global queue a dict of all jobs which are
+        related to this freesite, as getQueuedJobs
         
         Keys in the dict are filenames (rel paths), or __manifest
         """
         jobs = {}
-        self.node.refreshPersistentRequests()
-        for job in self.node.getGlobalJobs():
-            id = job.id
-            idparts = id.split("|")
-            if idparts[0] == 'freesitemgr' and idparts[1] == self.name:
-                name = idparts[2]
-                jobs[name] = job
+        for job in self.getQueuedJobs():
+            jobs[job.id.split("|")[2]] = job
         return jobs
     
     #@-node:readNodeQueue
@@ -1367,9 +1829,9 @@ class SiteState:
                         uri = rec['uri']
                     except KeyError:
                         if 'path' in rec:
-                            raw = open(rec['path'],"rb").read()
                             uri = self.chkCalcNode.genchk(
-                                data=raw, 
+                                file=rec['path'],
+                                direct=True,
                                 mimetype=rec['mimetype'],
                                 TargetFilename=ChkTargetFilename(rec['name']))
                             rec['uri'] = uri
@@ -1428,27 +1890,18 @@ class SiteState:
         marks them with rec['target'] = 'manifest'. All other files
         are marked with 'separate'.
         
-        Files are selected for the manifest until the manifest reaches 
-        maxManifestSizeBytes based on the following rules:
-        - index and activelink.png are always included
-        - the first to include are CSS files referenced in the index, smallest first
-        - then follow all other files referenced in the index, smallest first
-        - then follow html files not referenced in the index, smallest first
-        - then follow all other files, smallest first
+        The index and activelink.png are always included. The other files
+        are packed into the manifest until it reaches maxManifestSizeBytes,
+        by the fetch latency they save per byte they add to the manifest:
+        a file saves its visitors one request of fetchLatencyBytes, for
+        the share loadProbability of them which need it when they load the
+        index, and adds its size minus the size of its redirect. So CSS
+        linked from the index goes first, then other files linked from the
+        index, then other html files, and smaller files before larger ones.
         
         The manifest goes above the max size if that is necessary to avoid having more 
         than maxNumberSeparateFiles redirects.
         """
-        # TODO: This needs to avoid spots which break freenet. If we
-        # have very many small files, they should all be put into the
-        # container. Maybe add a maximum number of files to insert
-        # separately.
-        
-        #: The size of a redirect. See src/freenet/support/ContainerSizeEstimator.java
-        redirectSize = 512
-        #: The estimated size of the .metadata object. See src/freenet/support/ContainerSizeEstimator.java
-        metadataSize = 128
-
         # check whether we have an activelink.
         for rec in self.files:
             if rec['name'] == self.index:
@@ -1457,21 +1910,17 @@ class SiteState:
                 self.sitemapRec = rec
             if rec['name'] == "activelink.png":
                 self.activelinkRec = rec
-        maxsize = self.maxManifestSizeBytes - redirectSize * len(self.files)
-        totalsize = metadataSize
-        # we add the index as first file, so it is always fast.
-        if self.indexRec:
-            self.indexRec['target'] = "manifest"
-            totalsize += self.indexRec['sizebytes']
-            maxsize += redirectSize # no redirect needed for this file
+        
+        def addedSize(rec):
+            # a file in the manifest needs no redirect
+            return rec['sizebytes'] - redirectSize
+        
+        # we add the index as first file, so it is always fast, and
         # also we always add the activelink
-        if self.activelinkRec and (self.activelinkRec['sizebytes'] + totalsize
-                                   <= maxsize + redirectSize):
-            self.activelinkRec['target'] = "manifest"
-            totalsize = self.activelinkRec['sizebytes']
-            maxsize += redirectSize # no redirect needed for this file
-        # sort the files by filesize
-        recBySize = sorted(self.files, key=lambda rec: rec['sizebytes'])
+        inManifest = [rec for rec in (self.indexRec, self.activelinkRec) if rec]
+        totalsize = metadataSize + redirectSize * len(self.files) \
+                    + sum(addedSize(rec) for rec in inManifest)
+        
         # now we parse the index to see which files are directly
         # referenced from the index page. These should have precedence
         # over other files.
@@ -1491,65 +1940,59 @@ class SiteState:
                     except (TypeError, UnicodeDecodeError):
                         # truly final chance: just throw out errors. TODO: Use chardet: https://pypi.python.org/pypi/chardet
                         indexText = io.open(self.indexRec['path'], "r", encoding="utf-8", errors="ignore").read()
-        # now resort the recBySize to have the recs which are
-        # referenced in index first - with additional preference to CSS files.
-        # For files outside the index, prefer html files before others.
-        fileNamesInIndex = set([rec['name'] for rec in recBySize 
-                                if rec['name'] in indexText])
-        fileNamesInIndexCSS = set([rec['name'] for rec in recBySize 
-                                   if rec['name'] in fileNamesInIndex 
-                                   and rec['name'].lower().endswith('.css')])
-        fileNamesInManifest = set()
-        recByIndexAndSize = []
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] in fileNamesInIndexCSS)
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] in fileNamesInIndex
-                                 and rec['name'] not in fileNamesInIndexCSS)
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] not in fileNamesInIndex
-                                 and rec['name'].lower().endswith(".html"))
-        recByIndexAndSize.extend(rec for rec in recBySize 
-                                 if rec['name'] not in fileNamesInIndex
-                                 and not rec['name'].lower().endswith(".html"))
-        for rec in recByIndexAndSize:
-            if rec is self.indexRec or rec is self.activelinkRec:
-                rec['target'] = 'manifest'
-                # remember this
-                fileNamesInManifest.add(rec['name'])
-                continue # we already added the size.
-            if rec['sizebytes'] + totalsize <= maxsize + redirectSize:
-                rec['target'] = 'manifest'
-                totalsize += rec['sizebytes']
-                maxsize += redirectSize # no redirect needed for this file
-                # remember this
-                fileNamesInManifest.add(rec['name'])
+        namesInIndex = linkedNames(indexText)
+        
+        def savedLatencyPerByte(rec):
+            name = rec['name'].lower()
+            if rec['name'] in namesInIndex:
+                kind = 'css' if name.endswith('.css') else 'linked'
             else:
-                if rec.get('target', 'separate') == 'manifest':
-                    # if files moved out of the manifest, they have to be uploaded again
-                    if not rec['uri']:
-                        rec['state'] = 'changed'
-                        self.needToUpdate = True
-                        self.needToSave = True
-                rec['target'] = 'separate'
+                kind = 'html' if name.endswith('.html') else 'other'
+            size = addedSize(rec)
+            if size <= 0:
+                # smaller than its redirect: the manifest only gets smaller
+                return float('inf')
+            return loadProbability[kind] * fetchLatencyBytes / size
+        
+        candidates = [rec for rec in self.files
+                      if rec is not self.indexRec and rec is not self.activelinkRec]
+        candidates.sort(key=lambda rec: (-savedLatencyPerByte(rec), rec['sizebytes']))
+        separate = []
+        for rec in candidates:
+            if totalsize + addedSize(rec) <= self.maxManifestSizeBytes:
+                inManifest.append(rec)
+                totalsize += addedSize(rec)
+            else:
+                separate.append(rec)
+        
         # now add more small files to the manifest until less than
         # maxNumberSeparateFiles remain separate.
-        separateRecBySize = [i for i in recBySize
-                             if not i['name'] in fileNamesInManifest]
-        numSeparate = len(separateRecBySize)
-        filesToAdd = max(0, numSeparate - self.sitemgr.maxNumberSeparateFiles)
-        for i in range(filesToAdd):
-            rec = separateRecBySize[i]
-            rec['target'] = 'manifest'
-            totalsize += rec['sizebytes']
+        separate.sort(key=lambda rec: rec['sizebytes'])
+        filesToAdd = max(0, len(separate) - self.sitemgr.maxNumberSeparateFiles)
+        inManifest.extend(separate[:filesToAdd])
+        separate = separate[filesToAdd:]
         
+        # only touch the records which change, so only those get saved
+        for rec in inManifest:
+            if rec.get('target') != 'manifest':
+                rec['target'] = 'manifest'
+        for rec in separate:
+            if rec.get('target', 'separate') == 'manifest':
+                # if files moved out of the manifest, they have to be uploaded again
+                if not rec['uri']:
+                    rec['state'] = 'changed'
+                    self.needToUpdate = True
+                    self.needToSave = True
+            if rec.get('target') != 'separate':
+                rec['target'] = 'separate'
     
     #@-node:markManifestFiles
     #@+node:makeManifest
     def makeManifest(self):
         """
         Create a site manifest insertion command buffer from our
-        current inventory
+        current inventory, and the payload of its direct uploads, which
+        only reads the files when it is sent
         """
         # build up a command buffer to insert the manifest
         self.manifestCmdId = self.allocId("__manifest")
@@ -1571,7 +2014,8 @@ class SiteState:
         default = None
         # cache DDA requests to avoid stalling for ages on big sites
         hasDDAtested = {}
-        datatoappend = []
+        # the data of the direct uploads, in the order of their entries
+        dataparts = []
 
         def fileMsgLines(n, rec):
             if rec.get('target', 'separate') == 'separate':
@@ -1609,11 +2053,13 @@ class SiteState:
             else:
                 if rec['name'] in self.generatedTextData:
                     data = self.generatedTextData[rec['name']].encode("utf-8")
+                    sizebytes = len(data)
                 else:
-                    data = open(rec['path'], "rb").read()
-                datatoappend.append(data)
-                # update the sizebytes from the data actually read here.
-                rec['sizebytes'] = len(data)
+                    data = FileData(rec['path'])
+                    sizebytes = data.size
+                dataparts.append(data)
+                # update the sizebytes from the size of the data to send.
+                rec['sizebytes'] = sizebytes
                 return [
                     "Files.%d.Name=%s" % (n, rec['name']),
                     "Files.%d.UploadFrom=direct" % n,
@@ -1653,23 +2099,27 @@ class SiteState:
                     continue
             # otherwise, ok to add
             msgLines.extend(fileMsgLines(n, rec))
-            # note that the file does not need additional actions.
-            rec['state'] = 'idle'
+            # note that the file does not need additional actions, unless
+            # it waits for the insert of another site
+            if rec['state'] != 'shared':
+                rec['state'] = 'idle'
             # TODO: sum up sizes here to find the error due to which the files get truncated.
     
             # don't forget to up the count
             n += 1
         
         # finish the command buffer
-        if datatoappend:
+        if dataparts:
             msgLines.append("Data")
+            self.manifestData = ConcatData(dataparts)
+            datalength = self.manifestData.size
         else:
             msgLines.append("EndMessage")
+            self.manifestData = None
+            datalength = 0
     
         # and save
         self.manifestCmdBuf = b"\n".join(i.encode("utf-8") for i in msgLines) + b"\n"
-        self.manifestCmdBuf += b"".join(datatoappend)
-        datalength = len(b"".join(datatoappend))
         # FIXME: Reports an erroneous Error when no physical index is present.
         reportedlength = sum(rec['sizebytes'] for rec in self.files
                              if rec.get('target', 'separate') == 'manifest'
@@ -1692,6 +2142,140 @@ class SiteState:
     #@-others
 
 #@-node:class SiteState
+#@+node:class FileRecord
+class FileRecord(dict):
+    """
+    The record of a file of a site, which remembers whether it was
+    changed since it was last saved
+
+    >>> rec = FileRecord(name='index.html', state='idle')
+    >>> rec.dirty = False
+    >>> rec['state'] = 'changed'
+    >>> rec.dirty
+    True
+    """
+    __slots__ = ('dirty',)
+
+    def __init__(self, *args, **kw):
+        dict.__init__(self, *args, **kw)
+        self.dirty = True
+
+    def __setitem__(self, key, value):
+        self.dirty = True
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self.dirty = True
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kw):
+        self.dirty = True
+        dict.update(self, *args, **kw)
+
+    def setdefault(self, key, default=None):
+        self.dirty = True
+        return dict.setdefault(self, key, default)
+
+    def pop(self, *args):
+        self.dirty = True
+        return dict.pop(self, *args)
+
+#@-node:class FileRecord
+#@+node:class ChkCache
+class ChkCache:
+    """
+    The CHKs of file contents, keyed by (hash, mimetype, TargetFilename,
+    codecs), with whether an insert of each succeeded. Keeps the
+    maxEntries most recently used ones in a database shared by all sites.
+
+    >>> cache = ChkCache(":memory:", 2)
+    >>> cache.put(("h1", "text/html", "a.html", "GZIP"), "CHK@1/a.html")
+    >>> cache.put(("h2", "text/html", "b.html", "GZIP"), "CHK@2/b.html", True)
+    >>> cache.get(("h1", "text/html", "a.html", "GZIP"))
+    ('CHK@1/a.html', False)
+    >>> cache.put(("h3", "text/css", "c.css", "GZIP"), "CHK@3/c.css")
+    >>> cache.get(("h2", "text/html", "b.html", "GZIP")) is None
+    True
+    """
+    def __init__(self, path, maxEntries=defaultChkCacheSize):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        self._entries = None
+        # keys to write to and delete from the database on save
+        self.changed = set()
+        self.evicted = set()
+
+    @property
+    def entries(self):
+        """
+        The entries as OrderedDict of key -> (uri, inserted), least
+        recently used first, read from the database on first use
+        """
+        if self._entries is None:
+            self._entries = collections.OrderedDict()
+            if sqlite3 and os.path.isfile(self.path):
+                with contextlib.closing(sqlite3.connect(self.path)) as db:
+                    for key, uri, inserted in db.execute(
+                            "SELECT key, uri, inserted FROM chks ORDER BY used"):
+                        self._entries[tuple(json.loads(key))] = (uri, bool(inserted))
+        return self._entries
+
+    def get(self, key):
+        """
+        Returns (uri, inserted) for key, or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.changed.add(key)
+            return entry
+
+    def put(self, key, uri, inserted=False):
+        """
+        Remembers the uri for key, evicting the least recently used
+        entries beyond maxEntries. A succeeded insert is remembered
+        until the uri changes.
+        """
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None and old[0] == uri:
+                inserted = inserted or old[1]
+            self.entries[key] = (uri, inserted)
+            self.changed.add(key)
+            self.evicted.discard(key)
+            while len(self.entries) > self.maxEntries:
+                evicted, entry = self.entries.popitem(last=False)
+                self.changed.discard(evicted)
+                self.evicted.add(evicted)
+
+    def save(self):
+        """
+        Writes the changed entries to the database
+        """
+        if not sqlite3 or self.path == ":memory:":
+            return
+        with self.lock:
+            if not self.changed and not self.evicted:
+                return
+            order = dict((key, n) for n, key in enumerate(self.entries))
+            with contextlib.closing(sqlite3.connect(self.path)) as db:
+                with db:
+                    db.execute("CREATE TABLE IF NOT EXISTS chks (key TEXT PRIMARY KEY, "
+                               "uri TEXT NOT NULL, inserted INTEGER, used INTEGER)")
+                    db.executemany("DELETE FROM chks WHERE key = ?",
+                                   [(json.dumps(key),) for key in self.evicted])
+                    # only the order of the entries matters, so the
+                    # unchanged ones are moved behind the changed ones
+                    db.execute("UPDATE chks SET used = used - ?", (len(order),))
+                    db.executemany("INSERT OR REPLACE INTO chks VALUES (?, ?, ?, ?)",
+                                   [(json.dumps(key),) + self.entries[key] + (order[key],)
+                                    for key in self.changed])
+            self.changed.clear()
+            self.evicted.clear()
+
+#@-node:class ChkCache
 #@+node:funcs
 # utility funcs
 
@@ -1704,6 +2288,46 @@ def getFileSize(filepath):
     return os.stat(filepath)[stat.ST_SIZE]
 
 #@-node:getFileSize
+#@+node:statSignature
+def statSignature(rec):
+    """
+    The stat signature of a file record, which changes whenever the
+    file on disk is modified or replaced.
+
+    >>> statSignature({'sizebytes': 3, 'mtimens': 1500000000000000000, 'inode': 42})
+    (1500000000000000000, 3, 42)
+    >>> statSignature({'sizebytes': 3})
+    (None, 3, None)
+    """
+    return rec.get('mtimens'), rec.get('sizebytes'), rec.get('inode')
+
+#@-node:statSignature
+#@+node:linkedNames
+def linkedNames(text):
+    """
+    Returns the set of file names which the links in an html text may
+    refer to: each link target with all its trailing path parts, so
+    that links with the site key or relative to a directory match too.
+    
+    >>> sorted(linkedNames('''<link rel="stylesheet" href="style.css">
+    ... <img src='/USK@key,AQACAAE/site/3/img/a%20b.png?x=1#top'>
+    ... <a href=sub/../b.html>b</a> <div style="background: url(bg.png)">'''))
+    ['3/img/a b.png', 'USK@key,AQACAAE/site/3/img/a b.png', 'a b.png', 'b.html', 'bg.png', 'img/a b.png', 'site/3/img/a b.png', 'style.css']
+    """
+    names = set()
+    for match in _linkPattern.finditer(text):
+        link = next(group for group in match.groups() if group is not None)
+        path = urllib.parse.unquote(urllib.parse.urldefrag(link)[0].split("?")[0])
+        parts = posixpath.normpath(path).strip("/").split("/")
+        for n in range(len(parts)):
+            names.add("/".join(parts[n:]))
+    return names
+
+_linkPattern = re.compile(
+    r"""(?:\b(?:href|src)\s*=\s*|\burl\(\s*)(?:"([^"]*)"|'([^']*)'|([^\s"'<>()]+))""",
+    re.IGNORECASE)
+
+#@-node:linkedNames
 #@+node:fixUri
 def fixUri(uri, name, version=0):
     """
@@ -1732,6 +2356,19 @@ def ChkTargetFilename(name):
     return os.path.basename(name)
 
 #@-node:targetFilename
+#@+node:isCompressible
+def isCompressible(mimetype):
+    """
+    Whether data of a MIME type is worth compressing on insert
+
+    >>> isCompressible("text/html"), isCompressible("image/png")
+    (True, False)
+    >>> isCompressible("video/webm")
+    False
+    """
+    return not (mimetype or "").startswith(incompressibleMimetypes)
+
+#@-node:isCompressible
 #@+node:runTest
 def runTest():
     
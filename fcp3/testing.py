@@ -0,0 +1,725 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+A simulated Freenet node for tests and benchmarks without a real node.
+
+FakeNode is an FCP 2.0 server on localhost which answers the commands
+the fcp3 client uses, keeping inserted data in memory:
+
+    - ClientHello, GenerateSSK, WatchGlobal, GetNode, GetConfig,
+      ModifyConfig, ListPeers
+    - ClientPut (direct, disk and redirect) and ClientPutComplexDir
+    - ClientGet (direct, disk and none), following redirects
+    - USK editions: inserts take the next free edition, and fetches of
+      a negative edition get the latest one
+    - ListPersistentRequests and RemovePersistentRequest
+    - TestDDARequest and TestDDAResponse
+    - FCPPluginMessage, with a stub of the Web of Trust plugin
+
+Replies can be delayed by a fixed latency, payloads throttled to a
+bandwidth, and requests made to fail or connections to drop at random.
+
+>>> import fcp3
+>>> with FakeNode() as fake:
+...     with fcp3.FCPNode(port=fake.port, verbosity=fcp3.SILENT) as n:
+...         uri = n.put("CHK@", data=b"Hello", mimetype="text/plain")
+...         bytes(n.get(uri)[1])
+b'Hello'
+
+Run it standalone with python3 -m fcp3.testing --port 9481 to point
+other programs at it, like the doctests of fcp3.node.
+"""
+
+import argparse
+import base64
+import hashlib
+import os
+import queue
+import random
+import socket
+import threading
+import time
+
+
+# how many bytes to send at once, when throttling the bandwidth
+sendChunkSize = 65536
+
+# the messages which end a request
+finalMessages = ("PutSuccessful", "PutFailed", "DataFound", "GetFailed")
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).decode("utf-8").rstrip("=").replace("_", "~")
+
+
+def chkFor(data, mimetype=None, filename=None):
+    """
+    Returns the fake CHK of some data, which like a real CHK depends on
+    the data and its mimetype, and ends in the target filename
+
+    >>> chkFor(b"a") == chkFor(b"a")
+    True
+    >>> chkFor(b"a") == chkFor(b"a", "text/plain")
+    False
+    >>> chkFor(b"a", filename="a.txt").endswith(",AAMC--8/a.txt")
+    True
+    """
+    h = hashlib.sha256(data)
+    if mimetype:
+        h.update(mimetype.encode("utf-8"))
+    routing = h.digest()
+    crypto = hashlib.sha256(b"crypto" + routing).digest()
+    uri = "CHK@%s,%s,AAMC--8" % (_b64(routing), _b64(crypto))
+    if filename:
+        uri += "/" + filename
+    return uri
+
+
+def _isTrue(value):
+    return str(value).lower() == "true"
+
+
+def _stripUri(uri):
+    """
+    Returns a uri without freenet: prefix and trailing slash
+    """
+    if uri.startswith("freenet:"):
+        uri = uri[len("freenet:"):]
+    return uri.rstrip("/")
+
+
+def _uskParts(uri):
+    """
+    Splits a USK uri into the part before the edition, the edition and
+    the rest, or returns Nones if it is no USK with an edition
+
+    >>> _uskParts("USK@abc,def,AQACAAE/site/-3/index.html")
+    ('USK@abc,def,AQACAAE/site', -3, '/index.html')
+    >>> _uskParts("CHK@abc")
+    (None, None, None)
+    """
+    if not uri.startswith("USK@"):
+        return None, None, None
+    parts = uri.split("/", 3)
+    if len(parts) < 3 or not parts[2].lstrip("-").isdigit():
+        return None, None, None
+    rest = "/" + parts[3] if len(parts) == 4 else ""
+    return "/".join(parts[:2]), int(parts[2]), rest
+
+
+class FakeNode:
+    """
+    An FCP 2.0 server on localhost which simulates a Freenet node
+
+    Attributes of interest:
+        - port - the port the server listens on
+        - store - a dict of the inserted data, keyed by request uri,
+          values are (mimetype, data) tuples
+        - persistent - a dict of the persistent requests, keyed by
+          identifier, values are the request messages
+        - peers - a list of dicts of the fields of simulated peers
+        - plugins - a dict of plugin names to functions, which take the
+          parameters of an FCPPluginMessage as dict and return the
+          fields of the reply as dict
+        - received - the number of messages received from clients
+    """
+    def __init__(self, host="127.0.0.1", port=0, **kw):
+        """
+        Create a simulated node and start listening
+
+        Arguments:
+            - host - the address to listen on
+            - port - the port to listen on, default a free one
+
+        Keywords:
+            - latency - seconds to delay each reply, default 0
+            - bandwidth - bytes per second to send payloads with,
+              default unlimited
+            - failureRate - probability with which a ClientGet or
+              ClientPut fails, default 0
+            - disconnectRate - probability with which the node drops
+              the connection instead of answering a message, default 0
+            - seed - seed for the random failures and keys
+            - peers - number of simulated peers, default 3
+        """
+        self.latency = kw.get('latency', 0)
+        self.bandwidth = kw.get('bandwidth', None)
+        self.failureRate = kw.get('failureRate', 0)
+        self.disconnectRate = kw.get('disconnectRate', 0)
+        self.random = random.Random(kw.get('seed', None))
+        self.lock = threading.Lock()
+
+        self.store = {}
+        self.persistent = {}
+        self.insertKeys = {} # private key part -> public key part
+        self.editions = {} # USK without edition -> latest inserted edition
+        self.ddaTests = {} # directory -> read filename and content, write filename and content
+        self.received = 0
+        self.peers = [
+            {"identity": _b64(hashlib.sha256(b"peer%d" % i).digest()),
+             "myName": "peer%d" % i,
+             "physical.udp": "127.0.0.%d:%d" % (i + 2, 12000 + i),
+             "version": "Fred,0.7,1.0,1500",
+             "opennet": "false",
+             "seed": "false",
+             "volatile.status": "CONNECTED"}
+            for i in range(kw.get('peers', 3))]
+        self.plugins = {"plugins.WebOfTrust.WebOfTrust": self.webOfTrust}
+        self.ownIdentities = {}
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(16)
+        self.host = host
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self._acceptThread, daemon=True).start()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+
+
+    def shutdown(self):
+        """
+        Stops listening for new connections
+        """
+        self.running = False
+        try:
+            self.listener.close()
+        except OSError:
+            pass
+
+
+    def _acceptThread(self):
+        while self.running:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            FakeConnection(self, conn)
+
+
+    def _chance(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+
+    def newKeypair(self):
+        """
+        Returns a new (public, private) SSK keypair and remembers it, so
+        inserts under the private key can be fetched with the public one
+        """
+        with self.lock:
+            secret = bytes(self.random.getrandbits(8) for i in range(32))
+        private = _b64(secret) + "," + _b64(hashlib.sha256(b"c" + secret).digest())
+        public = _b64(hashlib.sha256(secret).digest()) + "," + _b64(hashlib.sha256(b"c" + secret).digest())
+        self.insertKeys[private] = public
+        return "SSK@%s,AQACAAE/" % public, "SSK@%s,AQECAAE/" % private
+
+
+    def requestUri(self, uri):
+        """
+        Returns the uri under which data inserted at uri can be fetched
+        """
+        uri = _stripUri(uri)
+        if uri[:4] not in ("SSK@", "USK@"):
+            return uri
+        keytype, rest = uri[:4], uri[4:]
+        key, sep, path = rest.partition("/")
+        parts = key.split(",")
+        private = ",".join(parts[:2])
+        if private in self.insertKeys:
+            parts = self.insertKeys[private].split(",") + ["AQACAAE"]
+        return keytype + ",".join(parts) + sep + path
+
+
+    def insertEdition(self, uri):
+        """
+        Returns the request uri with the edition a USK insert at uri
+        gets: the given one, or the next one if that is taken already
+        """
+        base, edition, rest = _uskParts(uri)
+        if base is None:
+            return uri
+        with self.lock:
+            latest = self.editions.get(base, -1)
+            if edition <= latest:
+                edition = latest + 1
+            self.editions[base] = edition
+        return "%s/%d%s" % (base, edition, rest)
+
+
+    def fetchEdition(self, uri):
+        """
+        Returns the uri a USK fetch of uri gets: a negative edition finds
+        the latest inserted one, as if the node knew all of them
+        """
+        base, edition, rest = _uskParts(uri)
+        if base is None or edition >= 0 or base not in self.editions:
+            return uri
+        return "%s/%d%s" % (base, self.editions[base], rest)
+
+
+    def webOfTrust(self, params):
+        """
+        A stub of the Web of Trust plugin, which knows the messages
+        babcom uses and answers others with an error
+        """
+        message = params.get("Message")
+        if message == "Ping":
+            return {"Message": "Pong"}
+        if message == "RandomName":
+            return {"Message": "Name", "Name": "Fake%d" % self.random.randint(0, 99999)}
+        if message == "CreateIdentity":
+            public, private = self.newKeypair()
+            identity = _b64(hashlib.sha256(public.encode("utf-8")).digest())
+            self.ownIdentities[identity] = {
+                "Nickname": params.get("Nickname", ""),
+                "RequestURI": public.replace("SSK@", "USK@") + "WebOfTrust/0",
+                "InsertURI": private.replace("SSK@", "USK@") + "WebOfTrust/0"}
+            return {"Message": "IdentityCreated", "ID": identity,
+                    "InsertURI": self.ownIdentities[identity]["InsertURI"],
+                    "RequestURI": self.ownIdentities[identity]["RequestURI"]}
+        if message == "GetOwnIdentities":
+            replies = {"Message": "OwnIdentities",
+                       "Amount": str(len(self.ownIdentities))}
+            for n, (identity, info) in enumerate(sorted(self.ownIdentities.items())):
+                replies["Identity%d" % n] = identity
+                for k, v in info.items():
+                    replies["%s%d" % (k, n)] = v
+            return replies
+        if message in ("AddContext", "RemoveContext", "SetProperty",
+                       "SetTrust", "RemoveTrust", "AddIdentity"):
+            return {"Message": message.replace("Add", "Added").replace(
+                "Remove", "Removed").replace("Set", "")}
+        return {"Message": "Error", "Description": "Unknown message %s" % message}
+
+
+
+class FakeConnection:
+    """
+    One client connection of a FakeNode, served by a reader thread and
+    a sender thread which applies the latency and bandwidth
+    """
+    def __init__(self, node, conn):
+        self.node = node
+        self.conn = conn
+        self.outgoing = queue.Queue()
+        self.watchGlobal = False
+        threading.Thread(target=self._readThread, daemon=True).start()
+        threading.Thread(target=self._sendThread, daemon=True).start()
+
+
+    def _readThread(self):
+        f = self.conn.makefile("rb")
+        try:
+            while True:
+                msg = self._readMsg(f)
+                if msg is None:
+                    break
+                self.node.received += 1
+                if self.node._chance(self.node.disconnectRate):
+                    break
+                handler = getattr(self, "_on_" + msg["header"], None)
+                if handler is None:
+                    # like the node, which does not read the identifier
+                    # of a message it does not know
+                    self.reply("ProtocolError",
+                               Code=8, CodeDescription="Unknown message name",
+                               ExtraDescription=msg["header"], Fatal="false")
+                else:
+                    handler(msg)
+        except (OSError, ValueError):
+            pass
+        self.outgoing.put(None)
+
+
+    def _readMsg(self, f):
+        """
+        Returns the next message as dict, with the payload as 'Data'
+        """
+        msg = {}
+        while True:
+            line = f.readline()
+            if not line:
+                return None
+            line = line.strip().decode("utf-8")
+            if not line:
+                continue
+            if "header" not in msg:
+                msg["header"] = line
+            elif line == "EndMessage":
+                return msg
+            elif line == "Data":
+                msg["Data"] = f.read(self._dataLength(msg))
+                return msg
+            else:
+                k, v = line.split("=", 1)
+                msg[k] = v
+
+
+    def _dataLength(self, msg):
+        """
+        Returns the length of the payload of a message, which is the sum
+        of the lengths of its direct uploads for a ClientPutComplexDir
+        """
+        if "DataLength" in msg:
+            return int(msg["DataLength"])
+        return sum(int(v) for k, v in msg.items()
+                   if k.startswith("Files.") and k.endswith(".DataLength"))
+
+
+    def _sendThread(self):
+        while True:
+            item = self.outgoing.get()
+            if item is None:
+                break
+            due, raw = item
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._send(raw)
+            except OSError:
+                break
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+    def _send(self, raw):
+        bandwidth = self.node.bandwidth
+        if not bandwidth:
+            self.conn.sendall(raw)
+            return
+        with memoryview(raw) as view:
+            for i in range(0, len(raw), sendChunkSize):
+                chunk = view[i:i + sendChunkSize]
+                self.conn.sendall(chunk)
+                time.sleep(len(chunk) / bandwidth)
+
+
+    def reply(self, header, data=None, **fields):
+        """
+        Queues a message for sending after the latency of the node
+        """
+        request = self.node.persistent.get(fields.get("Identifier"))
+        if request is not None and header in finalMessages:
+            # listings of persistent requests repeat how they ended
+            request["outcome"] = (header, fields)
+        lines = [header]
+        for k, v in fields.items():
+            if v is not None:
+                lines.append("%s=%s" % (k, v))
+        if data is not None:
+            lines.append("DataLength=%d" % len(data))
+            lines.append("Data")
+        else:
+            lines.append("EndMessage")
+        raw = ("\n".join(lines) + "\n").encode("utf-8")
+        if data is not None:
+            raw += data
+        self.outgoing.put((time.monotonic() + self.node.latency, raw))
+
+
+    # node and key management
+
+    def _on_ClientHello(self, msg):
+        self.reply("NodeHello", FCPVersion="2.0", Version="Fred,0.7,1.0,1500",
+                   Node="Fred", Build=1500, Revision="fake",
+                   ExtBuild=29, ExtRevision="fake", Testnet="false",
+                   ConnectionIdentifier=_b64(os.urandom(16)),
+                   CompressionCodecs="3 - GZIP(0), BZIP2(1), LZMA_NEW(3)")
+
+
+    def _on_GenerateSSK(self, msg):
+        public, private = self.node.newKeypair()
+        self.reply("SSKKeypair", Identifier=msg.get("Identifier"),
+                   RequestURI=public, InsertURI=private)
+
+
+    def _on_WatchGlobal(self, msg):
+        self.watchGlobal = _isTrue(msg.get("Enabled", "true"))
+
+
+    def _on_GetNode(self, msg):
+        self.reply("NodeData", Identifier=msg.get("Identifier"),
+                   myName="FakeNode", identity=_b64(b"fakenode"),
+                   version="Fred,0.7,1.0,1500", lastGoodVersion="Fred,0.7,1.0,1499",
+                   opennet="false", **{"ark.number": 1,
+                                       "physical.udp": "127.0.0.1:12345"})
+
+
+    def _on_GetConfig(self, msg):
+        self.reply("ConfigData", Identifier=msg.get("Identifier"),
+                   **{"current.fcp.port": self.node.port,
+                      "current.fcp.enabled": "true"})
+
+
+    def _on_ModifyConfig(self, msg):
+        self._on_GetConfig(msg)
+
+
+    def _on_ListPeers(self, msg):
+        for peer in self.node.peers:
+            self.reply("Peer", Identifier=msg.get("Identifier"), **peer)
+        self.reply("EndListPeers", Identifier=msg.get("Identifier"))
+
+
+    def _on_FCPPluginMessage(self, msg):
+        name = msg.get("PluginName")
+        plugin = self.node.plugins.get(name)
+        if plugin is None:
+            self.reply("ProtocolError", Identifier=msg.get("Identifier"),
+                       Code=32, CodeDescription="No such plugin", Fatal="false")
+            return
+        params = dict((k[len("Param."):], v) for k, v in msg.items()
+                      if k.startswith("Param."))
+        replies = dict(("Replies." + k, v) for k, v in plugin(params).items())
+        self.reply("FCPPluginReply", Identifier=msg.get("Identifier"),
+                   PluginName=name, **replies)
+
+
+    # inserts
+
+    def _failed(self):
+        """
+        Returns True if the request is chosen to fail
+        """
+        return self.node._chance(self.node.failureRate)
+
+
+    def _track(self, msg):
+        if msg.get("Persistence", "connection") != "connection" \
+                or _isTrue(msg.get("Global", "false")):
+            self.node.persistent[msg["Identifier"]] = msg
+
+
+    def _on_ClientPut(self, msg):
+        id = msg.get("Identifier")
+        uploadFrom = msg.get("UploadFrom", "direct")
+        if uploadFrom == "disk":
+            try:
+                with open(msg["Filename"], "rb") as f:
+                    data = f.read()
+            except OSError:
+                self.reply("ProtocolError", Identifier=id, Code=10,
+                           CodeDescription="File not found", Fatal="false")
+                return
+        elif uploadFrom == "redirect":
+            data = None
+        else:
+            data = msg.get("Data", b"")
+        self._track(msg)
+        uri = msg.get("URI", "CHK@")
+        mimetype = msg.get("Metadata.ContentType", None)
+        if uri.startswith("CHK@"):
+            uri = chkFor(data or msg.get("TargetURI", "").encode("utf-8"),
+                         mimetype, msg.get("TargetFilename", None))
+        else:
+            uri = self.node.insertEdition(self.node.requestUri(uri))
+        self.reply("URIGenerated", Identifier=id, URI=uri)
+        if _isTrue(msg.get("GetCHKOnly", "false")):
+            self.reply("PutSuccessful", Identifier=id, URI=uri)
+            return
+        if self._failed():
+            self.reply("PutFailed", Identifier=id, Code=10,
+                       CodeDescription="Insert failed", Fatal="false")
+            return
+        if data is None:
+            self.node.store[_stripUri(uri)] = ("redirect", msg["TargetURI"])
+        else:
+            self.node.store[_stripUri(uri)] = (mimetype, data)
+        self.reply("PutSuccessful", Identifier=id, URI=uri)
+
+
+    def _on_ClientPutComplexDir(self, msg):
+        id = msg.get("Identifier")
+        # collect the files, direct data is concatenated in file order
+        files = []
+        n = 0
+        while "Files.%d.Name" % n in msg:
+            files.append(dict((k[len("Files.%d." % n):], v) for k, v in msg.items()
+                              if k.startswith("Files.%d." % n)))
+            n += 1
+        payload = msg.get("Data", b"")
+        offset = 0
+        contents = []
+        for f in files:
+            uploadFrom = f.get("UploadFrom", "direct")
+            if uploadFrom == "direct":
+                length = int(f["DataLength"])
+                contents.append((f, f.get("Metadata.ContentType"), payload[offset:offset + length]))
+                offset += length
+            elif uploadFrom == "disk":
+                with open(f["Filename"], "rb") as fileobj:
+                    contents.append((f, f.get("Metadata.ContentType"), fileobj.read()))
+            else:
+                contents.append((f, "redirect", f["TargetURI"]))
+        self._track(msg)
+        uri = msg.get("URI", "CHK@")
+        if uri.startswith("CHK@"):
+            manifest = hashlib.sha256()
+            for f, mimetype, data in contents:
+                manifest.update(f["Name"].encode("utf-8"))
+                manifest.update(data if isinstance(data, bytes) else data.encode("utf-8"))
+            uri = chkFor(manifest.digest(), "manifest")
+        else:
+            uri = self.node.insertEdition(self.node.requestUri(uri))
+        self.reply("URIGenerated", Identifier=id, URI=uri)
+        if self._failed():
+            self.reply("PutFailed", Identifier=id, Code=10,
+                       CodeDescription="Insert failed", Fatal="false")
+            return
+        if not _isTrue(msg.get("GetCHKOnly", "false")):
+            for f, mimetype, data in contents:
+                self.node.store[_stripUri(uri) + "/" + f["Name"]] = (mimetype, data)
+            if "DefaultName" in msg:
+                self.node.store[_stripUri(uri)] = self.node.store[
+                    _stripUri(uri) + "/" + msg["DefaultName"]]
+        self.reply("PutSuccessful", Identifier=id, URI=uri + "/")
+
+
+    # requests
+
+    def _on_ClientGet(self, msg):
+        id = msg.get("Identifier")
+        self._track(msg)
+        uri = self.node.fetchEdition(_stripUri(msg.get("URI", "")))
+        for i in range(10): # follow redirects
+            entry = self.node.store.get(uri)
+            if entry is None or entry[0] != "redirect":
+                break
+            uri = _stripUri(entry[1])
+        if entry is None or self._failed():
+            self.reply("GetFailed", Identifier=id, Code=28,
+                       CodeDescription="All data not found",
+                       ShortCodeDescription="Data not found", Fatal="true")
+            return
+        mimetype, data = entry
+        mimetype = mimetype or "application/octet-stream"
+        self.reply("DataFound", Identifier=id, DataLength=len(data),
+                   **{"Metadata.ContentType": mimetype})
+        returnType = msg.get("ReturnType", "direct")
+        if returnType == "direct":
+            self.reply("AllData", data, Identifier=id,
+                       **{"Metadata.ContentType": mimetype})
+        elif returnType == "disk":
+            with open(msg["Filename"], "wb") as f:
+                f.write(data)
+
+
+    def _on_ListPersistentRequests(self, msg):
+        for id, request in list(self.node.persistent.items()):
+            header = {"ClientGet": "PersistentGet", "ClientPut": "PersistentPut",
+                      "ClientPutComplexDir": "PersistentPutDir"}[request["header"]]
+            self.reply(header, Identifier=id, URI=request.get("URI"),
+                       Verbosity=request.get("Verbosity", 0),
+                       PersistenceType=request.get("Persistence", "connection"),
+                       Global=request.get("Global", "false"),
+                       PriorityClass=request.get("PriorityClass", 2),
+                       ReturnType=request.get("ReturnType"),
+                       ClientToken=request.get("ClientToken"),
+                       Started="false", MaxRetries=request.get("MaxRetries", 0))
+            if "outcome" in request:
+                header, fields = request["outcome"]
+                self.reply(header, **fields)
+        self.reply("EndListPersistentRequests")
+
+
+    def _on_RemovePersistentRequest(self, msg):
+        id = msg.get("Identifier")
+        self.node.persistent.pop(id, None)
+        self.reply("PersistentRequestRemoved", Identifier=id,
+                   Global=msg.get("Global", "false"))
+
+
+    # direct disk access
+
+    def _on_TestDDARequest(self, msg):
+        directory = msg["Directory"]
+        if not os.path.isdir(directory):
+            # like the node, with the directory in place of the identifier
+            self.reply("ProtocolError", Identifier=directory, Code=8,
+                       CodeDescription="Invalid field",
+                       ExtraDescription="No such directory", Fatal="false")
+            return
+        fields = {}
+        if _isTrue(msg.get("WantReadDirectory", "false")):
+            fields["ReadFilename"] = os.path.join(directory, "DDACheck-%s.tmp" % _b64(os.urandom(6)))
+            content = _b64(os.urandom(12))
+            try:
+                with open(fields["ReadFilename"], "w") as f:
+                    f.write(content)
+            except OSError:
+                pass
+        if _isTrue(msg.get("WantWriteDirectory", "false")):
+            fields["WriteFilename"] = os.path.join(directory, "DDACheck-%s.tmp" % _b64(os.urandom(6)))
+            fields["ContentToWrite"] = _b64(os.urandom(12))
+        self.node.ddaTests[directory] = (
+            fields.get("ReadFilename"), fields.get("ReadFilename") and content,
+            fields.get("WriteFilename"), fields.get("ContentToWrite"))
+        self.reply("TestDDAReply", Directory=directory, **fields)
+
+
+    def _on_TestDDAResponse(self, msg):
+        directory = msg["Directory"]
+        readFilename, content, writeFilename, toWrite = self.node.ddaTests.pop(
+            directory, (None, None, None, None))
+        readAllowed = readFilename is not None and msg.get("ReadContent") == content
+        if readFilename is not None:
+            try:
+                os.remove(readFilename)
+            except OSError:
+                pass
+        writeAllowed = False
+        if writeFilename is not None:
+            try:
+                with open(writeFilename) as f:
+                    writeAllowed = f.read() == toWrite
+            except OSError:
+                pass
+        self.reply("TestDDAComplete", Directory=directory,
+                   ReadDirectoryAllowed=str(readAllowed).lower(),
+                   WriteDirectoryAllowed=str(writeAllowed).lower())
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate a Freenet node on an FCP port.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9481)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds to delay each reply")
+    parser.add_argument("--bandwidth", type=float, default=None,
+                        help="bytes per second to send payloads with")
+    parser.add_argument("--failure-rate", type=float, default=0,
+                        help="probability with which gets and puts fail")
+    parser.add_argument("--disconnect-rate", type=float, default=0,
+                        help="probability with which a message drops the connection")
+    args = parser.parse_args()
+    node = FakeNode(args.host, args.port, latency=args.latency,
+                    bandwidth=args.bandwidth, failureRate=args.failure_rate,
+                    disconnectRate=args.disconnect_rate)
+    print("FakeNode listening on %s:%d" % (node.host, node.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        node.shutdown()
+
+
+if __name__ == "__main__":
+    main()
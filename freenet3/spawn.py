@@ -78,17 +78,21 @@ node.storeType=ram
     logging.info("Check its status at the local web url http://127.0.0.1:%s", fproxy_port)
     wait_until_online(fcp_port)
     logging.info("Started Freenet.")
-    with fcp.FCPNode(port=fcp_port) as n:
+    with fcp.node.pooledNode(port=fcp_port) as n:
         logging.info("Build is %s", n.nodeBuild)
-        n.shutdown()
 
 
 def wait_until_online(fcp_port):
+    """
+    Wait until the node accepts FCP connections on fcp_port.
+
+    The first connection which gets through stays open in the pool of
+    fcp.node.pooledNode() for the callers which talk to the node next.
+    """
     while True:
         try:
-            n = fcp.FCPNode(port=fcp_port)
-            n.shutdown()
-            return
+            with fcp.node.pooledNode(port=fcp_port):
+                return
         except ConnectionRefusedError as e:
             time.sleep(5)
 
@@ -203,8 +207,8 @@ def spawn_node(fcp_port=None, web_port=None, transient=False):
     spawndir = _get_spawn_dir(fcp_port)
     if os.path.isdir(spawndir) and os.path.isfile(os.path.join(spawndir, "run.sh")):
         try:
-            with fcp.FCPNode(port=fcp_port) as n:
-                n.shutdown() # close the fcp connection
+            with fcp.node.pooledNode(port=fcp_port):
+                pass # the node is running already
         except ConnectionRefusedError:
             _run_spawn(spawndir)
             wait_until_online(fcp_port)
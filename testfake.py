@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+Tests against the simulated node fcp3.testing.FakeNode, which need no
+running freenet node, unlike test.py:
+
+    python3 testfake.py
+
+Each feature of the client library which needs a node to talk to has
+its doctests here.
+"""
+
+import asyncio, os, tempfile, threading, time
+import fcp3 as fcp
+from fcp3 import sitemgr, freenetfs
+from fcp3.aio import AsyncFCPNode
+from fcp3.node import FCPNode, FCPNodePool, FileData, ConcatData
+from fcp3.testing import FakeNode
+
+latency = 0.05
+fake = FakeNode(latency=latency)
+node = FCPNode(host=fake.host, port=fake.port, verbosity=fcp.FATAL)
+workdir = tempfile.mkdtemp()
+
+
+def _writeFile(relpath, data, root=workdir):
+    path = os.path.join(root, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def roundTrip(size):
+    '''
+    Payloads larger than the socket buffers arrive whole
+
+    >>> roundTrip(4 * 1024 * 1024)
+    True
+    '''
+    data = os.urandom(size)
+    uri = node.put("CHK@", data=data)
+    return bytes(node.get(uri)[1]) == data
+
+
+def putFromDisk(*editions):
+    '''
+    The node reads files from disk itself, and each USK insert goes to
+    the next edition, which a fetch of a negative edition finds
+
+    >>> putFromDisk(b"first", b"second")
+    (b'second', 'USK@...smoke/1')
+    '''
+    pub, priv = node.genkey(usk=True, name="smoke")
+    for data in editions:
+        path = _writeFile("smoke", data)
+        uri = node.put(priv, file=path, mimetype="text/plain")
+    return bytes(node.get(pub.replace("/0", "/-1"))[1]), uri[:4] + "..." + uri[-7:]
+
+
+def requestsInFlight(count):
+    '''
+    The manager thread waits for the node with a selector, so requests
+    in flight wait for their replies at the same time
+
+    >>> seconds, uris = requestsInFlight(20)
+    >>> len(set(uris)), seconds < 10 * latency
+    (20, True)
+    '''
+    start = time.time()
+    jobs = [node.put("CHK@", data=os.urandom(1000), **{"async": True})
+            for i in range(count)]
+    uris = [job.wait() for job in jobs]
+    return time.time() - start, uris
+
+
+def asyncDirectPut(size):
+    '''
+    The asyncio client waits for the transport to drain after each chunk
+    of a direct upload, so it never buffers the whole file
+
+    >>> most, uri = asyncDirectPut(64 * 1024 * 1024)
+    >>> most < 1024 * 1024, uri.startswith("CHK@")
+    (True, True)
+    '''
+    path = _writeFile("async%d" % size, os.urandom(size))
+    async def put():
+        async with AsyncFCPNode(host=fake.host, port=fake.port,
+                                verbosity=fcp.FATAL) as n:
+            most = 0
+            async def watch():
+                nonlocal most
+                while True:
+                    most = max(most, n.writer.transport.get_write_buffer_size())
+                    await asyncio.sleep(0)
+            watcher = asyncio.ensure_future(watch())
+            job = await n.put("CHK@", file=path, direct=True)
+            watcher.cancel()
+            return most, await job
+    return asyncio.run(put())
+
+
+def pooledNodes():
+    '''
+    The pool hands out one running node per host, port and name, and
+    replaces it once its connection is gone
+
+    >>> a, b, c = pooledNodes()
+    >>> a is b, c is a, c.nodeIsAlive
+    (True, False, True)
+    '''
+    pool = FCPNodePool(verbosity=fcp.FATAL)
+    try:
+        a = pool.acquire(host=fake.host, port=fake.port)
+        b = pool.acquire(host=fake.host, port=fake.port)
+        pool.release(a)
+        pool.release(b)
+        a.shutdown()
+        c = pool.acquire(host=fake.host, port=fake.port)
+        pool.release(c)
+        return a, b, c
+    finally:
+        pool.shutdown()
+
+
+def pooledConnect(slowLatency):
+    '''
+    A slow connect to one node does not hold up borrowing another
+
+    >>> seconds = pooledConnect(1.0)
+    >>> seconds < 0.5
+    True
+    '''
+    pool = FCPNodePool(verbosity=fcp.FATAL)
+    with pool.borrow(host=fake.host, port=fake.port):
+        pass
+    with FakeNode(latency=slowLatency) as slow:
+        connecting = threading.Thread(
+            target=lambda: pool.release(pool.acquire(host=slow.host, port=slow.port)))
+        connecting.start()
+        time.sleep(0.1)
+        start = time.time()
+        with pool.borrow(host=fake.host, port=fake.port):
+            seconds = time.time() - start
+        connecting.join()
+    pool.shutdown()
+    return seconds
+
+
+def putFile(size, truncateTo=None):
+    '''
+    Files are streamed to the node in chunks as FileData. A file which
+    shrinks before it is sent fails only its own request
+
+    >>> uri, data = putFile(300000)
+    >>> bytes(node.get(uri)[1]) == data
+    True
+    >>> putFile(300000, truncateTo=1000) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    OSError: ...shrank during upload
+    >>> node.nodeIsAlive
+    True
+    '''
+    data = os.urandom(size)
+    path = _writeFile("file%d" % size, data)
+    payload = FileData(path)
+    if truncateTo is not None:
+        os.truncate(path, truncateTo)
+    return node.put("CHK@", data=payload), data
+
+
+def batchedPuts(count):
+    '''
+    The requests of a batch are sent together when the block ends
+
+    >>> group, uris = batchedPuts(10)
+    >>> group.progress()
+    (10, 0, 10)
+    >>> len(set(uris)), all(uri.startswith("CHK@") for uri in uris)
+    (10, True)
+    '''
+    with node.batch() as group:
+        for i in range(count):
+            node.put("CHK@", data=b"%d" % i, **{"async": True})
+    uris = group.wait()
+    return group, uris
+
+
+def untaggedCommands():
+    '''
+    The node may answer ListPeers, TestDDA and GetNode without the
+    identifier, but concurrent requests from several threads still get
+    their own replies
+
+    >>> results = untaggedCommands()
+    >>> results['peers'] == len(fake.peers), results['dda'], results['node']
+    (True, False, True)
+    '''
+    results = {}
+    def peers():
+        results['peers'] = [msg['header'] for msg in node.listpeers()].count('Peer')
+    def dda():
+        results['dda'] = node.testDDA(Directory=os.path.join(workdir, "missing"),
+                                      WantReadDirectory=True)
+    def getNode():
+        results['node'] = bool(node.refstats())
+    threads = [threading.Thread(target=fn) for fn in (peers, dda, getNode)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def untaggedError():
+    '''
+    A ProtocolError without identifier fails only the oldest pending
+    untagged command, since the node answers them in order
+
+    >>> untaggedError()
+    ('failed', True)
+    '''
+    notes = node.listpeernotes(NodeIdentifier="nobody", **{"async": True})
+    getNode = node.refstats(**{"async": True})
+    try:
+        notes.wait()
+        failed = 'succeeded'
+    except fcp.FCPProtocolError:
+        failed = 'failed'
+    return failed, bool(getNode.wait())
+
+
+def insertSites(nsites, nfiles, maxconcurrent):
+    '''
+    Sites inserted at the same time share one budget of CHK requests
+    in flight, which is given back completely afterwards
+
+    >>> inFlight, budget, uris = insertSites(3, 8, 4)
+    >>> inFlight, budget, len(uris)
+    (4, 4, 3)
+    '''
+    basedir = tempfile.mkdtemp()
+    mgr = sitemgr.SiteMgr(basedir=basedir, host=fake.host, port=fake.port,
+                          verbosity=fcp.FATAL, maxconcurrent=maxconcurrent,
+                          maxConcurrentSites=nsites, maxManifestSizeBytes=100)
+    for i in range(nsites):
+        root = tempfile.mkdtemp()
+        _writeFile("index.html", b"<html>site %d</html>" % i, root)
+        for j in range(nfiles):
+            _writeFile("f%d.txt" % j, os.urandom(20000), root)
+        mgr.addSite(name="site%d" % i, dir=root, basedir=basedir)
+    inFlight = [0, 0] # now, most
+    lock = threading.Lock()
+    def done(job):
+        with lock:
+            inFlight[0] -= 1
+    genchk = mgr.node.genchk
+    def countingGenchk(**kw):
+        job = genchk(**kw)
+        if kw.get("async"):
+            with lock:
+                inFlight[0] += 1
+                inFlight[1] = max(inFlight)
+            job.addDoneCallback(done)
+        return job
+    mgr.node.genchk = countingGenchk
+    mgr.insert()
+    budget = 0
+    while mgr.insertBudget.acquire(False):
+        budget += 1
+    for i in range(budget):
+        mgr.insertBudget.release()
+    uris = [site.uriPub for site in mgr.sites]
+    mgr.node.shutdown()
+    return inFlight[1], budget, uris
+
+
+def sharedSites(nsites, nfiles):
+    '''
+    Sites inserted at the same time with the same files insert each
+    file once, and list the global queue once in all
+
+    >>> sharedSites(4, 6)
+    (6, 1)
+    '''
+    basedir = tempfile.mkdtemp()
+    mgr = sitemgr.SiteMgr(basedir=basedir, host=fake.host, port=fake.port,
+                          verbosity=fcp.FATAL, maxConcurrentSites=nsites,
+                          maxManifestSizeBytes=100)
+    contents = [os.urandom(20000) for j in range(nfiles)]
+    for i in range(nsites):
+        root = tempfile.mkdtemp()
+        _writeFile("index.html", b"<html>site %d</html>" % i, root)
+        for j, data in enumerate(contents):
+            _writeFile("f%d.txt" % j, data, root)
+        mgr.addSite(name="site%d" % i, dir=root, basedir=basedir)
+    puts = []
+    listings = []
+    node = mgr.node
+    put = node.put
+    def countingPut(uri="CHK@", **kw):
+        if kw.get("TargetFilename", "").startswith("f") \
+                and not kw.get("chkonly"):
+            puts.append(kw["TargetFilename"])
+        return put(uri, **kw)
+    node.put = countingPut
+    refresh = node.refreshPersistentRequests
+    def countingRefresh(**kw):
+        listings.append(1)
+        return refresh(**kw)
+    node.refreshPersistentRequests = countingRefresh
+    mgr.insert()
+    node.shutdown()
+    return len(puts), len(listings)
+
+
+def putConcat(truncateTo=None):
+    '''
+    ConcatData sends files and bytes as one payload, as sitemgr does
+    for the files in a manifest
+
+    >>> putConcat().startswith("CHK@")
+    True
+    >>> putConcat(truncateTo=10) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    OSError: ...shrank during upload
+    '''
+    a = _writeFile("concat/a", os.urandom(70000))
+    b = FileData(_writeFile("concat/b", os.urandom(90000)))
+    parts = [FileData(a), b"index", b]
+    if truncateTo is not None:
+        os.truncate(a, truncateTo)
+    return node._submitCmd(
+        node._getUniqueId(), "ClientPutComplexDir", URI="CHK@",
+        DefaultName="index.html",
+        **{"Files.0.Name": "a", "Files.0.UploadFrom": "direct",
+           "Files.0.DataLength": parts[0].size,
+           "Files.1.Name": "index.html", "Files.1.UploadFrom": "direct",
+           "Files.1.DataLength": len(parts[1]),
+           "Files.2.Name": "b", "Files.2.UploadFrom": "direct",
+           "Files.2.DataLength": b.size,
+           "Data": ConcatData(parts)})
+
+
+def freediskResume(nfiles, failAfter):
+    '''
+    A commit which fails halfway keeps the files inserted so far in its
+    journal, and the next commit only inserts the rest
+
+    >>> freediskResume(30, 10)
+    ('node went away', 10, 20, False)
+    '''
+    pub, priv = node.genkey()
+    root, state = tempfile.mkdtemp(), tempfile.mkdtemp()
+    for i in range(nfiles):
+        _writeFile("f%d" % i, os.urandom(3000), root)
+    disk = freenetfs.FreediskMgr(name="resume", fcpNode=node, root=root,
+                                 privateKey=priv, stateDir=state)
+    puts = []
+    put = node.put
+    def countingPut(uri="CHK@", **kw):
+        if uri == "CHK@":
+            if len(puts) == failAfter:
+                raise IOError("node went away")
+            puts.append(uri)
+        return put(uri, **kw)
+    node.put = countingPut
+    try:
+        disk.commit()
+        error = None
+    except IOError as e:
+        error = str(e)
+        journaled = len(freenetfs.CommitJournal(disk.journalPath).uris)
+        del puts[:]
+        failAfter = None
+        disk.commit()
+    finally:
+        del node.put
+    return error, journaled, len(puts), os.path.exists(disk.journalPath)
+
+
+def freediskMirror():
+    '''
+    A freedisk committed from one directory is updated into another,
+    where it keeps the files changed there since the last update
+
+    >>> first, second = freediskMirror()
+    >>> sorted(first), first['d/f1']
+    (['a', 'd/f1', 'd/f2'], b'one')
+    >>> second['a'], second['d/f1'], 'd/f2' in second, second['notes']
+    (b'changed', b'one', False, b'local')
+    '''
+    pub, priv = node.genkey()
+    src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+    _writeFile("a", b"alpha", src)
+    _writeFile("d/f1", b"one", src)
+    _writeFile("d/f2", b"two", src)
+    writer = freenetfs.FreediskMgr(name="mirror", fcpNode=node, root=src,
+                                   privateKey=priv, stateDir=tempfile.mkdtemp())
+    reader = freenetfs.FreediskMgr(name="mirror", fcpNode=node, root=dst,
+                                   publicKey=pub, stateDir=tempfile.mkdtemp())
+    writer.commit()
+    reader.update()
+    first = _readTree(dst)
+    _writeFile("a", b"changed", src)
+    os.unlink(os.path.join(src, "d", "f2"))
+    writer.commit()
+    _writeFile("notes", b"local", dst)
+    reader.update()
+    return first, _readTree(dst)
+
+
+def _readTree(root):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, root).replace(os.sep, "/")] = f.read()
+    return files
+
+
+def _base30hex(integer):
+    """Turn an integer into a simple lowercase base30hex encoding."""
+    base30 = "0123456789abcdefghijklmnopqrst"
+    b30 = []
+    while integer:
+        b30.append(base30[integer%30])
+        integer = int(integer / 30)
+    return "".join(reversed(b30))
+
+
+def _test():
+    import doctest
+    try:
+        tests = doctest.testmod()
+    finally:
+        node.shutdown()
+        fake.shutdown()
+    if tests.failed:
+        return "☹"*tests.failed + " / " + str(tests.attempted)
+    return "^_^ (" + _base30hex(tests.attempted) + ")"
+
+
+if __name__ == "__main__":
+    print(_test())